@@ -2,6 +2,8 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Chat push traffic (WebSocket at /ws/chat/, Server-Sent Events at /chat/events/)
+is served by ``chat.push.ChatPushRouter``; everything else goes to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
@@ -13,4 +15,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up, since it uses the models and settings
+from chat.push import ChatPushRouter  # noqa: E402
+
+application = ChatPushRouter(django_application)
@@ -0,0 +1,111 @@
+"""
+Response compression negotiated with Accept-Encoding.
+
+Brotli is preferred when the optional `brotli` package is installed and the
+client accepts it, gzip otherwise. Only compressible content types of at
+least RESPONSE_COMPRESSION_MIN_BYTES are touched: below that the headers
+cost more than the bytes saved. Streaming responses (the long-lived push
+channel, file downloads) pass through untouched so they still flush as they
+are written.
+
+Settings: RESPONSE_COMPRESSION_MIN_BYTES, RESPONSE_COMPRESSION_TYPES and
+RESPONSE_COMPRESSION_BROTLI_QUALITY.
+"""
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+from django.utils.text import compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_BYTES = 512
+# Content types (prefixes) worth compressing; images and archives already are
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/msgpack', 'application/javascript',
+    'application/xml', 'application/problem+json',
+)
+# Brotli's top qualities are for static assets; 4-5 is the usual choice for
+# dynamic responses, denser than gzip at a similar cost
+BROTLI_QUALITY = 5
+
+CODING_RE = _lazy_re_compile(r'\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*')
+
+
+def accepted_encodings(header):
+    """
+    {coding: q} from an Accept-Encoding header.
+    """
+    encodings = {}
+    for part in header.split(','):
+        match = CODING_RE.fullmatch(part)
+        if not match:
+            continue
+        try:
+            encodings[match[1].lower()] = float(match[2]) if match[2] else 1.0
+        except ValueError:
+            continue
+    return encodings
+
+
+def choose_encoding(header):
+    """
+    'br', 'gzip' or None for an Accept-Encoding header.
+    """
+    encodings = accepted_encodings(header)
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    quality = {coding: encodings.get(coding, encodings.get('*', 0)) for coding in offered}
+    best = max(offered, key=lambda coding: quality[coding])
+    return best if quality[best] > 0 else None
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(
+            content, quality=getattr(settings, 'RESPONSE_COMPRESSION_BROTLI_QUALITY', BROTLI_QUALITY)
+        )
+    # Level 6, with random bytes in the gzip header against BREACH, as
+    # Django's GZipMiddleware does
+    return compress_string(content, max_random_bytes=100)
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with brotli or gzip. Sits near the top of
+    MIDDLEWARE, below MetricsMiddleware, so it works on the final body.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if not response.get('Content-Type', '').startswith(
+            tuple(getattr(settings, 'RESPONSE_COMPRESSION_TYPES', COMPRESSIBLE_TYPES))
+        ):
+            return response
+        # Caches must key on the negotiated encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < getattr(settings, 'RESPONSE_COMPRESSION_MIN_BYTES', MIN_BYTES):
+            return response
+
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+        compressed = compress(response.content, encoding)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # The encoded bytes differ from the identity ones; a strong ETag
+        # would claim otherwise (ours are weak already)
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
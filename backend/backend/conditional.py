@@ -0,0 +1,61 @@
+"""
+Conditional GET for the API views.
+
+A view sums up what its response depends on in a small `state` tuple, read
+with one cheap query (an aggregate or a maintained version counter), and
+calls check_not_modified() before doing the real work:
+
+    not_modified, validators = check_not_modified(request, state, last_modified)
+    if not_modified is not None:
+        return not_modified
+    ...
+    return Response(data, headers=validators)
+
+The ETag covers the state plus everything else that shapes the response:
+the full path with its query string, the negotiated media type and, for
+private responses, the user. Last-Modified is only as precise as HTTP dates (one second), so
+clients should prefer If-None-Match, which also wins when both are sent.
+
+Only pass `last_modified` when every change moves it, deletes included. A
+Max(updated_at) over a list does not go up when a row goes away, so list
+views rely on the ETag alone.
+"""
+import hashlib
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def make_etag(request, state, private=True):
+    user_id = getattr(getattr(request, 'user', None), 'pk', None) if private else None
+    media_type = getattr(request, 'accepted_media_type', None)
+    key = repr((request.get_full_path(), media_type, user_id, state))
+    # Weak: equal content, not byte-for-byte equal encodings
+    return 'W/"%s"' % hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def check_not_modified(request, state, last_modified=None, private=True):
+    """
+    (304 response or None, validator headers) for the response to `request`
+    given `state`. `private` marks per-user data that shared caches must
+    not serve to others.
+    """
+    etag = make_etag(request, state, private)
+    headers = {
+        'ETag': etag,
+        # Clients may keep the response, but revalidate it every time
+        'Cache-Control': 'private, no-cache' if private else 'no-cache',
+    }
+    if private:
+        headers['Vary'] = 'Authorization'
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    if timestamp is not None:
+        headers['Last-Modified'] = http_date(timestamp)
+
+    if request.method not in ('GET', 'HEAD'):
+        return None, headers
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        for header, value in headers.items():
+            response[header] = value
+    return response, headers
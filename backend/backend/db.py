@@ -0,0 +1,151 @@
+"""
+Database profiles, selected with the DB_PROFILE environment variable.
+
+- sqlite (default): the local Db.sqlite3 file with WAL journaling, relaxed
+  fsync, a busy timeout, a larger page cache, mmap I/O and persistent,
+  health-checked connections.
+- sqlite-basic: the same file with SQLite's defaults and a new connection per
+  request (the old behaviour, useful for comparisons).
+- postgres: PostgreSQL with persistent, health-checked connections. Django
+  4.2 has no connection pool of its own; put PgBouncer in front of the server
+  for pooling and set DB_PGBOUNCER=1 (transaction pooling) so Django hands
+  connection reuse over to it. Needs a PostgreSQL driver (psycopg2 or
+  psycopg), which requirements.txt does not install.
+
+DB_REPLICAS adds read replicas (comma-separated): hosts for postgres, file
+paths for the SQLite profiles (e.g. a LiteFS/Litestream copy). They become the
+aliases replica_1, replica_2, ... routed by backend.routers.ReplicaRouter.
+
+DB_SHARDS (same format) adds message shards shard_1, shard_2, ... used by
+chat.sharding when CHAT_SHARDS lists them.
+"""
+import os
+from copy import deepcopy
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Applied to every new SQLite connection of a database whose settings carry them
+SQLITE_PRAGMAS = {
+    # Readers no longer block the writer and vice versa
+    'journal_mode': 'WAL',
+    # Safe with WAL: only a power loss can drop the last commits, never corrupt
+    'synchronous': 'NORMAL',
+    # Wait for the write lock instead of failing with "database is locked"
+    'busy_timeout': 5000,
+    # Negative = KiB, so about 64 MB of page cache per connection
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def sqlite_database(name, tuned=True):
+    database = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+    }
+    if tuned:
+        database.update({
+            'CONN_MAX_AGE': env_int('DB_CONN_MAX_AGE', 600),
+            'CONN_HEALTH_CHECKS': True,
+            # Seconds the driver waits on a locked database
+            'OPTIONS': {'timeout': 20},
+            'PRAGMAS': dict(SQLITE_PRAGMAS),
+        })
+    return database
+
+
+def postgres_database():
+    database = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.getenv('DB_NAME', 'chat_whisperer'),
+        'USER': os.getenv('DB_USER', 'postgres'),
+        'PASSWORD': os.getenv('DB_PASSWORD', ''),
+        'HOST': os.getenv('DB_HOST', 'localhost'),
+        'PORT': os.getenv('DB_PORT', '5432'),
+        'CONN_MAX_AGE': env_int('DB_CONN_MAX_AGE', 600),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
+    }
+    if os.getenv('DB_PGBOUNCER'):
+        # Transaction-pooling PgBouncer cannot keep server-side cursors or
+        # long-lived sessions, so let the pooler own the connections
+        database['CONN_MAX_AGE'] = 0
+        database['DISABLE_SERVER_SIDE_CURSORS'] = True
+    return database
+
+
+def copy_database(default, location):
+    database = deepcopy(default)
+    if default['ENGINE'].endswith('sqlite3'):
+        database['NAME'] = location
+    else:
+        database['HOST'] = location
+    return database
+
+
+def replica_databases(default, replicas):
+    databases = {}
+    for n, location in enumerate(replicas, start=1):
+        replica = copy_database(default, location)
+        # Tests run against the primary; a replica is just another view of it
+        replica['TEST'] = {'MIRROR': 'default'}
+        databases[f'replica_{n}'] = replica
+    return databases
+
+
+def shard_databases(default, shards):
+    return {
+        f'shard_{n}': copy_database(default, location)
+        for n, location in enumerate(shards, start=1)
+    }
+
+
+def env_list(name):
+    return [value.strip() for value in os.getenv(name, '').split(',') if value.strip()]
+
+
+def database_settings(base_dir, profile=None, replicas=None, shards=None):
+    """
+    The DATABASES setting for the given (or DB_PROFILE) profile, including any
+    replicas (default: DB_REPLICAS) and message shards (default: DB_SHARDS).
+    """
+    profile = profile or os.getenv('DB_PROFILE', 'sqlite')
+    replicas = env_list('DB_REPLICAS') if replicas is None else replicas
+    shards = env_list('DB_SHARDS') if shards is None else shards
+    if profile == 'sqlite':
+        default = sqlite_database(base_dir / 'Db.sqlite3')
+    elif profile == 'sqlite-basic':
+        default = sqlite_database(base_dir / 'Db.sqlite3', tuned=False)
+    elif profile == 'postgres':
+        default = postgres_database()
+    else:
+        raise ValueError(f"Unknown DB_PROFILE {profile!r}. Use sqlite, sqlite-basic or postgres.")
+    return {
+        'default': default,
+        **replica_databases(default, replicas),
+        **shard_databases(default, shards),
+    }
+
+
+def apply_sqlite_pragmas(connection, pragmas):
+    cursor = connection.cursor()
+    try:
+        for pragma, value in pragmas.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+    finally:
+        cursor.close()
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    # Runs once per new connection; persistent connections amortize it
+    pragmas = connection.settings_dict.get('PRAGMAS')
+    if connection.vendor == 'sqlite' and pragmas:
+        apply_sqlite_pragmas(connection.connection, pragmas)
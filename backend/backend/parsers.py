@@ -0,0 +1,49 @@
+"""
+Project-wide DRF parsers, set in REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'];
+the counterparts of backend/renderers.py.
+"""
+import orjson
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from .renderers import MessagePackRenderer, ORJSONRenderer, import_msgpack
+
+
+class ORJSONParser(BaseParser):
+    """
+    JSON parser backed by orjson. Like DRF's parser with STRICT_JSON, it
+    rejects NaN and Infinity.
+    """
+    media_type = 'application/json'
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+
+        try:
+            body = stream.read() if stream is not None else b''
+            # orjson reads UTF-8 only; other charsets go through str
+            if encoding.lower().replace('_', '-') not in ('utf-8', 'utf8'):
+                body = body.decode(encoding)
+            return orjson.loads(body)
+        except (orjson.JSONDecodeError, UnicodeDecodeError, LookupError) as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class MessagePackParser(BaseParser):
+    """
+    MessagePack request bodies (`Content-Type: application/msgpack`).
+    """
+    media_type = 'application/msgpack'
+    renderer_class = MessagePackRenderer
+
+    def __init__(self):
+        self.msgpack = import_msgpack()
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return self.msgpack.unpackb(stream.read() if stream is not None else b'', raw=False)
+        except (ValueError, self.msgpack.UnpackException) as exc:
+            raise ParseError('MessagePack parse error - %s' % str(exc))
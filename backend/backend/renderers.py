@@ -0,0 +1,71 @@
+"""
+Project-wide DRF renderers, set in REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].
+
+ORJSONRenderer produces the same JSON as DRF's JSONRenderer with its
+default settings (compact, UTF-8, `Z` for UTC datetimes) several times
+faster. MessagePackRenderer is offered to clients that send
+`Accept: application/msgpack`. It needs the optional `msgpack` package and
+is only listed in the settings when that is installed.
+"""
+import orjson
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# Everything orjson and msgpack do not know natively (Decimal, lazy
+# strings, QuerySets...) is converted the way DRF's JSON encoder does it
+encode_default = JSONEncoder().default
+
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+
+class ORJSONRenderer(BaseRenderer):
+    """
+    JSON renderer backed by orjson.
+    """
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        options = ORJSON_OPTIONS
+        # `Accept: application/json; indent=4` or the browsable API; orjson
+        # only indents by two
+        if 'indent=' in (accepted_media_type or '') or (renderer_context or {}).get('indent'):
+            options |= orjson.OPT_INDENT_2
+        ret = orjson.dumps(data, default=encode_default, option=options)
+
+        # Keep the output a strict JavaScript subset, like DRF's renderer
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+        return ret
+
+
+def import_msgpack():
+    try:
+        import msgpack
+    except ImportError as e:
+        raise ImproperlyConfigured('MessagePack support requires the "msgpack" package.') from e
+    return msgpack
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    MessagePack renderer. Values are the same as in the JSON responses
+    (datetimes as ISO 8601 strings), only the encoding is more compact.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def __init__(self):
+        self.msgpack = import_msgpack()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return self.msgpack.packb(data, default=encode_default, use_bin_type=True)
@@ -0,0 +1,145 @@
+"""
+Primary/replica routing.
+
+Reads of the hot, polled models go to one of settings.DATABASE_REPLICAS;
+everything else, and every write, goes to the primary. Reads are pinned to the
+primary for the rest of a request once it writes (or if it is not a safe
+method), and for DATABASE_STICKY_PRIMARY_SECONDS afterwards for the user who
+wrote, so replication lag never hides a user's own messages or posts.
+"""
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Models whose reads may be served by a replica
+REPLICATED_MODELS = {'chat.message', 'freedom_wall.post', 'users.user'}
+# Seconds a user's reads stay on the primary after they write
+DEFAULT_STICKY_SECONDS = 5
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RequestState:
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+# Mutable, so writes made in a thread spawned by sync_to_async still pin the request
+_request_state = ContextVar('replica_request_state', default=None)
+
+
+def primary_alias():
+    return getattr(settings, 'DATABASE_PRIMARY', DEFAULT_DB_ALIAS)
+
+
+def replica_aliases():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def sticky_seconds():
+    return getattr(settings, 'DATABASE_STICKY_PRIMARY_SECONDS', DEFAULT_STICKY_SECONDS)
+
+
+def sticky_key(user_id):
+    return f'db-primary:{user_id}'
+
+
+def token_user_id(request):
+    """
+    The user id in the request's Bearer token, without touching the database.
+    """
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+    from rest_framework_simplejwt.settings import api_settings
+
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else None
+    if raw_token is None:
+        return None
+    try:
+        return authentication.get_validated_token(raw_token).get(api_settings.USER_ID_CLAIM)
+    except (InvalidToken, TokenError):
+        return None
+
+
+def pin_to_primary():
+    """
+    Send the current request's remaining reads to the primary, e.g. to re-read
+    what another request has just committed there.
+    """
+    state = _request_state.get()
+    if state is not None:
+        state.pinned = True
+
+
+class ReplicaRouter:
+    """
+    Database router for settings.DATABASE_ROUTERS.
+    """
+
+    def db_for_read(self, model, **hints):
+        primary = primary_alias()
+        replicas = replica_aliases()
+        if not replicas or model._meta.label_lower not in REPLICATED_MODELS:
+            return primary
+        state = _request_state.get()
+        if state is not None and state.pinned:
+            return primary
+        # Reads inside a transaction must see that transaction's writes
+        if connections[primary].in_atomic_block:
+            return primary
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state.pinned = True
+            state.wrote = True
+        return primary_alias()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {primary_alias(), *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema through replication
+        if db in replica_aliases():
+            return False
+        return None
+
+
+class ReplicaPinningMiddleware:
+    """
+    Tracks per-request pinning for ReplicaRouter and the sticky-primary window.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not replica_aliases():
+            return self.get_response(request)
+
+        user_id = token_user_id(request)
+        pinned = request.method not in SAFE_METHODS
+        if not pinned and user_id is not None:
+            pinned = cache.get(sticky_key(user_id), 0) > time.time()
+
+        state = RequestState(pinned)
+        token = _request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_state.reset(token)
+
+        if state.wrote and user_id is not None:
+            window = sticky_seconds()
+            cache.set(sticky_key(user_id), time.time() + window, window)
+        return response
@@ -1,8 +1,11 @@
 from datetime import timedelta
 from pathlib import Path
+import importlib.util
 import os
 from dotenv import load_dotenv  # Optional: use this for .env support
 
+from .db import database_settings
+
 # Load environment variables from .env file (optional)
 load_dotenv()
 
@@ -24,6 +27,20 @@ print(f"ENCRYPTION_KEY: {ENCRYPTION_KEY}")
 if not ENCRYPTION_KEY:
     raise ValueError("Encryption key is not set. Please set the ENCRYPTION_KEY environment variable.")
 
+# Key ring for message encryption (MultiFernet). The first key encrypts, every key decrypts.
+# To rotate: make the new key ENCRYPTION_KEY, move the old one to ENCRYPTION_OLD_KEYS
+# (comma-separated), run `manage.py rotate_message_keys`, then drop the old key.
+ENCRYPTION_KEYS = [ENCRYPTION_KEY] + [
+    key.strip() for key in os.getenv("ENCRYPTION_OLD_KEYS", "").split(",") if key.strip()
+]
+
+# Key of the blind search index over messages (see chat/search.py). Separate from
+# ENCRYPTION_KEY so rotating that one leaves the index readable; after changing it
+# run `manage.py index_messages --rebuild`.
+CHAT_SEARCH_KEY = os.getenv("CHAT_SEARCH_KEY")
+if not CHAT_SEARCH_KEY:
+    raise ValueError("Search key is not set. Please set the CHAT_SEARCH_KEY environment variable.")
+
 # Application definition
 AUTH_USER_MODEL = 'users.User'
 
@@ -33,20 +50,48 @@ SIMPLE_JWT = {
     'ROTATE_REFRESH_TOKENS': False,
 }
 
+# JSON through orjson (backend/renderers.py); MessagePack too, for clients
+# that ask for it, when the `msgpack` package (requirements.txt) is installed
+MSGPACK_ENABLED = importlib.util.find_spec('msgpack') is not None
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
-    )
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'backend.renderers.ORJSONRenderer',
+        *(['backend.renderers.MessagePackRenderer'] if MSGPACK_ENABLED else []),
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'backend.parsers.ORJSONParser',
+        *(['backend.parsers.MessagePackParser'] if MSGPACK_ENABLED else []),
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
 }
 
+# Responses of at least this many bytes are gzip or brotli compressed (the
+# latter when the `brotli` package, in requirements.txt, is installed). See
+# backend/compression.py.
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESSION_MIN_BYTES', '512'))
+
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
     "http://localhost:3050",
 ]
 
+# Let the frontends read the chat pagination cursors and the ETag validator
+CORS_EXPOSE_HEADERS = [
+    "X-Has-More",
+    "X-Cursor-Before",
+    "X-Cursor-After",
+    "ETag",
+]
+
 CSRF_TRUSTED_ORIGINS = [
      "http://localhost:3000",
       "http://localhost:3050",
@@ -65,11 +110,16 @@ INSTALLED_APPS = [
     'rest_framework',
     'rest_framework_simplejwt',
     'corsheaders',
-    'chat'
+    'chat',
+    'metrics',
+    'stats',
    
 ]
 
 MIDDLEWARE = [
+    'metrics.middleware.MetricsMiddleware',
+    'backend.routers.ReplicaPinningMiddleware',
+    'backend.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -101,12 +151,45 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'backend.wsgi.application'
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'Db.sqlite3',
-    }
+# Optional bearer token required to scrape /metrics
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Pub/sub broker for the chat push channel (see chat/push.py).
+# Use 'chat.broker.RedisBroker' with {'url': ...} when running several processes.
+CHAT_PUSH_BROKER = os.getenv('CHAT_PUSH_BROKER', 'chat.broker.InMemoryBroker')
+CHAT_PUSH_BROKER_OPTIONS = {}
+if os.getenv('CHAT_PUSH_REDIS_URL'):
+    CHAT_PUSH_BROKER_OPTIONS['url'] = os.getenv('CHAT_PUSH_REDIS_URL')
+
+# The feed page cache and its generation counter, push tickets and the
+# sticky-primary pins all live in the default cache, so every process must
+# share it: set CACHE_REDIS_URL when running more than one. The per-process
+# default is only right for a single process (and tests).
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
 }
+if os.getenv('CACHE_REDIS_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('CACHE_REDIS_URL'),
+    }
+
+# DB_PROFILE picks the database: sqlite (tuned, default), sqlite-basic or postgres.
+# See backend/db.py for the pragmas, connection reuse and pooling options.
+DATABASES = database_settings(BASE_DIR)
+
+# Reads of messages, posts and users go to the replicas (if any); writes, and
+# reads that follow a write, stay on the primary. See backend/routers.py.
+DATABASE_ROUTERS = ['chat.sharding.ShardRouter', 'backend.routers.ReplicaRouter']
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica_')]
+DATABASE_STICKY_PRIMARY_SECONDS = int(os.getenv('DB_STICKY_PRIMARY_SECONDS', '5'))
+
+# Optional message sharding: each conversation lives on one of these aliases.
+# After changing the list run `manage.py reshard_messages`. See chat/sharding.py.
+CHAT_SHARDS = [alias for alias in DATABASES if alias.startswith('shard_')]
+# Distinct per process writing messages (0-63), keeps sharded message ids unique.
+# Required when CHAT_SHARDS is set
+CHAT_SHARD_WORKER_ID = int(os.environ['CHAT_SHARD_WORKER_ID']) if os.getenv('CHAT_SHARD_WORKER_ID') else None
 
 AUTH_PASSWORD_VALIDATORS = [
     {
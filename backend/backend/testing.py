@@ -0,0 +1,49 @@
+"""
+Test case helpers shared by the apps' test modules.
+"""
+import shutil
+import tempfile
+from pathlib import Path
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connections
+from django.test import SimpleTestCase
+
+from chat.cache import message_cache
+
+
+class ScratchDatabasesTestCase(SimpleTestCase):
+    """
+    Registers `aliases` as extra, fully migrated SQLite files for the test
+    class and empties them (and the main test database) before each test.
+    """
+    aliases = ()
+    # Resolved in setUpClass, once the aliases are registered
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        for alias in cls.aliases:
+            connections.settings[alias] = {
+                **connections.settings['default'],
+                'NAME': str(Path(cls.tmp) / f'{alias}.sqlite3'),
+            }
+            call_command('migrate', database=alias, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in cls.aliases:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        for alias in ('default', *self.aliases):
+            call_command('flush', database=alias, interactive=False, verbosity=0)
+        cache.clear()
+        message_cache.clear()
@@ -0,0 +1,354 @@
+import gzip
+import json
+import threading
+import time
+import uuid
+from decimal import Decimal
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.utils import ConnectionHandler
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from chat.cache import message_cache
+from chat.crypto import get_cipher
+from chat.models import Message
+from chat.storage import seal
+from freedom_wall.models import Post
+from users.models import User
+
+from .compression import brotli, choose_encoding
+from .db import SQLITE_PRAGMAS, database_settings
+from .renderers import ORJSONRenderer
+from .routers import ReplicaRouter
+from .testing import ScratchDatabasesTestCase
+
+# Concurrent writers in the database profile tests
+WRITERS = 8
+WRITES_PER_WRITER = 20
+
+
+class DatabaseProfileTests(SimpleTestCase):
+    """
+    The tuned SQLite profile against the old defaults, on scratch databases.
+    """
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def connections_for(self, profile):
+        base_dir = Path(self.tmp.name) / profile
+        base_dir.mkdir()
+        return ConnectionHandler(database_settings(base_dir, profile))
+
+    def write_concurrently(self, connections):
+        """
+        WRITERS threads each commit WRITES_PER_WRITER rows, one transaction
+        per row like chat sends, while this thread holds a read transaction
+        open. Returns the errors the writers hit.
+        """
+        with connections['default'].cursor() as cursor:
+            cursor.execute('CREATE TABLE message (id INTEGER PRIMARY KEY, sender INTEGER, content TEXT)')
+        errors = []
+        barrier = threading.Barrier(WRITERS + 1)
+
+        def writer(sender):
+            # ConnectionHandler gives every thread its own connection
+            connection = connections['default']
+            try:
+                barrier.wait()
+                for _ in range(WRITES_PER_WRITER):
+                    with connection.cursor() as cursor:
+                        cursor.execute('INSERT INTO message (sender, content) VALUES (%s, %s)', [sender, 'x' * 200])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(WRITERS)]
+        for thread in threads:
+            thread.start()
+        reader = connections['default']
+        with reader.cursor() as cursor:
+            # A listing in progress: its read transaction stays open while the writers run
+            cursor.execute('BEGIN')
+            cursor.execute('SELECT COUNT(*) FROM message')
+            barrier.wait()
+            for thread in threads:
+                thread.join()
+            cursor.execute('COMMIT')
+        return errors
+
+    def test_tuned_profile_writes_alongside_readers(self):
+        connections = self.connections_for('sqlite')
+        self.assertEqual(self.write_concurrently(connections), [])
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM message')
+            self.assertEqual(cursor.fetchone()[0], WRITERS * WRITES_PER_WRITER)
+        connections['default'].close()
+
+    def test_basic_profile_locks_writers_out(self):
+        # Rollback journal: no commit while a reader holds its shared lock.
+        # A short driver timeout so the writers give up quickly
+        databases = database_settings(Path(self.tmp.name), 'sqlite-basic')
+        databases['default']['OPTIONS'] = {'timeout': 0.05}
+        connections = ConnectionHandler(databases)
+        errors = self.write_concurrently(connections)
+        connections['default'].close()
+        self.assertEqual(len(errors), WRITERS)
+        self.assertTrue(all('database is locked' in str(e) for e in errors))
+
+    def test_pragmas_applied_on_connect(self):
+        connections = self.connections_for('sqlite')
+        expected = {
+            'journal_mode': 'wal',
+            'synchronous': 1,  # NORMAL
+            'busy_timeout': 5000,
+            'cache_size': -64000,
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 2,  # MEMORY
+        }
+        self.assertEqual(set(expected), set(SQLITE_PRAGMAS))
+        with connections['default'].cursor() as cursor:
+            for pragma, value in expected.items():
+                cursor.execute(f'PRAGMA {pragma}')
+                self.assertEqual(cursor.fetchone()[0], value, pragma)
+        connections['default'].close()
+
+    def test_tuned_profile_reuses_connections(self):
+        default = database_settings(Path(self.tmp.name), 'sqlite')['default']
+        self.assertEqual(default['CONN_MAX_AGE'], 600)
+        self.assertTrue(default['CONN_HEALTH_CHECKS'])
+        self.assertEqual(default['OPTIONS'], {'timeout': 20})
+
+    def test_basic_profile_keeps_sqlite_defaults(self):
+        connections = self.connections_for('sqlite-basic')
+        with connections['default'].cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'delete')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 2)  # FULL
+        connections['default'].close()
+        self.assertEqual(database_settings(Path(self.tmp.name), 'sqlite-basic')['default'].get('CONN_MAX_AGE', 0), 0)
+
+    def test_postgres_profile(self):
+        default = database_settings(Path(self.tmp.name), 'postgres')['default']
+        self.assertEqual((default['CONN_MAX_AGE'], default['OPTIONS']), (600, {}))
+        # Behind PgBouncer the pooler owns the connections
+        with mock.patch.dict('os.environ', {'DB_PGBOUNCER': '1'}):
+            default = database_settings(Path(self.tmp.name), 'postgres')['default']
+        self.assertEqual(default['CONN_MAX_AGE'], 0)
+        self.assertTrue(default['DISABLE_SERVER_SIDE_CURSORS'])
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            database_settings(Path(self.tmp.name), 'mysql')
+
+
+class ReplicaRoutingTests(ScratchDatabasesTestCase):
+    """
+    ReplicaRouter with two SQLite files standing in for the primary and a
+    replica that has not caught up yet.
+    """
+    aliases = ('primary', 'replica')
+
+    def setUp(self):
+        super().setUp()
+
+        # The same account exists on both sides, as it would after replication
+        self.alice = User.objects.db_manager('primary').create_user(
+            name='alice', email='alice@example.com', password=None
+        )
+        self.bob = User.objects.db_manager('primary').create_user(
+            name='bob', email='bob@example.com', password=None
+        )
+        for user in (self.alice, self.bob):
+            user.save(using='replica')
+
+        routing = override_settings(DATABASE_PRIMARY='primary', DATABASE_REPLICAS=['replica'])
+        routing.enable()
+        self.addCleanup(routing.disable)
+
+        self.client = APIClient()
+        self.token = str(RefreshToken.for_user(self.alice).access_token)
+
+    def authenticate(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+    def post_titles(self):
+        response = self.client.get('/freedom-wall/api/posts/')
+        self.assertEqual(response.status_code, 200)
+        return [post['title'] for post in response.json()]
+
+    def test_reads_go_to_replica(self):
+        Post.objects.using('primary').create(title='only on primary', content='x')
+        self.assertEqual(self.post_titles(), [])
+
+        Post.objects.using('replica').create(title='replicated', content='x')
+        self.assertEqual(self.post_titles(), ['replicated'])
+
+    def test_writes_go_to_primary(self):
+        self.authenticate()
+        response = self.client.post('/freedom-wall/api/posts/', {'title': 'hello', 'content': 'x'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Post.objects.using('primary').filter(title='hello').exists())
+        self.assertFalse(Post.objects.using('replica').filter(title='hello').exists())
+
+    def test_sticky_primary_after_write(self):
+        self.authenticate()
+        self.client.post('/freedom-wall/api/posts/', {'title': 'mine', 'content': 'x'}, format='json')
+
+        # The writer reads their own post despite the lagging replica...
+        self.assertEqual(self.post_titles(), ['mine'])
+
+        # ...other clients are still served by the replica
+        self.client.credentials()
+        self.assertEqual(self.post_titles(), [])
+
+        # Once the window is over the writer is back on the replica too
+        cache.clear()
+        self.authenticate()
+        self.assertEqual(self.post_titles(), [])
+
+    def test_chat_send_and_read_back(self):
+        self.authenticate()
+        response = self.client.post('/chat/api/messages/', {
+            'sender': self.alice.id, 'receiver': self.bob.id, 'content': 'hi bob',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Message.objects.using('replica').count(), 0)
+
+        response = self.client.get('/chat/api/specific-chat/', {'sender_id': self.alice.id, 'receiver_id': self.bob.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['content'] for m in response.json()], ['hi bob'])
+
+    def test_long_poll_wake_up_reads_the_primary(self):
+        def send():
+            time.sleep(0.2)
+            try:
+                # Committed on the primary only; the replica never gets it
+                Message.objects.create(
+                    sender=self.bob, receiver=self.alice, content=get_cipher().encrypt(b'are you there?').decode()
+                )
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.addCleanup(thread.join)
+
+        self.authenticate()
+        started = time.monotonic()
+        response = self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id, 'since': 0, 'wait': 5})
+        self.assertEqual([m['content'] for m in response.json()], ['are you there?'])
+        self.assertLess(time.monotonic() - started, 4)
+
+    def test_reads_inside_transaction_use_primary(self):
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(Message), 'replica')
+        with transaction.atomic(using='primary'):
+            self.assertEqual(router.db_for_read(Message), 'primary')
+        # Models that are never replicated stay on the primary
+        self.assertEqual(router.db_for_read(Group), 'primary')
+
+
+class RenderingTests(TestCase):
+    """
+    The orjson/MessagePack renderers and parsers, and response compression.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        Message.objects.bulk_create([
+            Message(sender=self.alice, receiver=self.bob, payload=seal(get_cipher(), f'message number {n}'))
+            for n in range(40)
+        ])
+
+    def test_json_matches_drf_renderer(self):
+        data = {
+            'at': timezone.now(), 'naive': timezone.now().replace(tzinfo=None), 'day': timezone.now().date(),
+            'price': Decimal('1.50'), 'id': uuid.uuid4(), 'lazy': gettext_lazy('Invalid'),
+            'text': 'café  ', 1: [None, True, 1.5],
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+
+    def test_json_requests(self):
+        response = self.client.post(
+            '/freedom-wall/api/posts/', b'{"title": NaN}', content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('JSON parse error', response.json()['detail'])
+        response = self.client.post(
+            '/freedom-wall/api/posts/', '{"title": "Grüße", "content": "x"}', content_type='application/json'
+        )
+        self.assertEqual(response.json()['title'], 'Grüße')
+
+    def test_gzip_above_threshold(self):
+        url = '/chat/api/conversation/'
+        plain = self.client.get(url, {'peer_id': self.bob.id})
+        self.assertNotIn('Content-Encoding', plain)
+        response = self.client.get(url, {'peer_id': self.bob.id}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(response.content)), plain.json())
+        self.assertLess(len(response.content), len(plain.content) / 2)
+
+        # Small bodies and refused codings stay as they are
+        response = self.client.get('/chat/api/unread/', {'peer_id': self.bob.id}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+        response = self.client.get(url, {'peer_id': self.bob.id}, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_choose_encoding(self):
+        self.assertEqual(choose_encoding('gzip;q=0.5, *;q=0'), 'gzip')
+        self.assertIsNone(choose_encoding(''))
+        self.assertIsNone(choose_encoding('deflate'))
+        if brotli is not None:
+            self.assertEqual(choose_encoding('gzip, deflate, br'), 'br')
+            self.assertEqual(choose_encoding('br;q=0.1, gzip'), 'gzip')
+
+    @skipUnless(brotli is not None, 'brotli is not installed')
+    def test_brotli(self):
+        params = {'peer_id': self.bob.id}
+        response = self.client.get('/chat/api/conversation/', params, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.content)), self.client.get('/chat/api/conversation/', params).json())
+
+    @skipUnless(settings.MSGPACK_ENABLED, 'msgpack is not installed')
+    def test_msgpack(self):
+        import msgpack
+
+        params = {'peer_id': self.bob.id}
+        response = self.client.get('/chat/api/conversation/', params, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), self.client.get('/chat/api/conversation/', params).json())
+
+        response = self.client.post(
+            '/chat/api/messages/',
+            msgpack.packb({'sender': self.alice.id, 'receiver': self.bob.id, 'content': 'packed'}),
+            content_type='application/msgpack', HTTP_ACCEPT='application/msgpack',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(msgpack.unpackb(response.content)['content'], 'packed')
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.urls import path, include
+from metrics.views import metrics
 
 
 urlpatterns = [
@@ -8,4 +9,6 @@ urlpatterns = [
      path('chat/', include('chat.urls')),
  
      path('freedom-wall/', include('freedom_wall.urls')),
+    path('stats/', include('stats.urls')),
+    path('metrics', metrics, name='metrics'),
 ]
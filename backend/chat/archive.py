@@ -0,0 +1,235 @@
+"""
+Cold storage for old messages.
+
+`manage.py archive_messages` moves messages older than CHAT_ARCHIVE_AFTER_DAYS
+out of chat_message into MessageArchiveSegment rows: runs of up to
+SEGMENT_SIZE consecutive messages of one conversation, zlib-compressed
+together. The hot table and its indexes then only hold recent history.
+
+Reads page into the archive transparently (see paginate_messages): an
+ArchiveSource is merged with the hot querysets, but it is only queried when a
+page reaches below the newest archived message (the "horizon"), or a
+`since=<id>` poll is below the highest archived id, so recent pages and polls
+never touch it.
+
+Archived messages are read-only: they cannot be edited or deleted one by one.
+"""
+import base64
+import heapq
+import json
+import zlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router
+from django.db.models import Max, Q, prefetch_related_objects
+
+from .models import Message, MessageArchiveSegment
+from .pagination import position
+from .sharding import shard_aliases, shard_for
+
+# Default age after which messages are archived
+DEFAULT_ARCHIVE_AFTER_DAYS = 180
+# Messages per compressed segment
+SEGMENT_SIZE = 500
+# Seconds the per-database horizon is cached
+HORIZON_TTL = 60
+
+
+def archive_after():
+    return timedelta(days=getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', DEFAULT_ARCHIVE_AFTER_DAYS))
+
+
+def pack(messages):
+    """
+    Compress messages (ordered by timestamp, id) into a segment payload.
+    Rows are [id, sender, receiver, timestamp, legacy token, payload (base64)];
+    segments written before the payload format have no sixth column.
+    """
+    rows = [
+        [
+            m.id, m.sender_id, m.receiver_id, m.timestamp.isoformat(), m.content,
+            base64.b64encode(m.payload).decode() if m.payload is not None else None,
+        ]
+        for m in messages
+    ]
+    return zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 9)
+
+
+def unpack(segment):
+    """
+    The segment's messages as unsaved-looking Message instances, in order.
+    """
+    messages = []
+    for message_id, sender_id, receiver_id, timestamp, content, *payload in json.loads(zlib.decompress(segment.data)):
+        message = Message(
+            id=message_id, sender_id=sender_id, receiver_id=receiver_id,
+            content=content, timestamp=datetime.fromisoformat(timestamp),
+            payload=base64.b64decode(payload[0]) if payload and payload[0] is not None else None,
+        )
+        message._state.adding = False
+        message._state.db = segment._state.db
+        messages.append(message)
+    return messages
+
+
+def horizon_key(database):
+    return f'chat-archive-bounds:{database}'
+
+
+def forget_horizon(database):
+    # Called by archive_messages; other processes pick up the change within HORIZON_TTL
+    cache.delete(horizon_key(database))
+
+
+def get_horizon(database):
+    """
+    (timestamp, id) upper bounds of the messages archived on `database`, or
+    None when there are none.
+    """
+    key = horizon_key(database)
+    horizon = cache.get(key)
+    if horizon is None:
+        newest = MessageArchiveSegment.objects.using(database).aggregate(at=Max('last_at'), id=Max('last_id'))
+        # Cache "no archive" too, as a falsy marker
+        horizon = (newest['at'], newest['id']) if newest['at'] else False
+        cache.set(key, horizon, HORIZON_TTL)
+    return horizon or None
+
+
+class ArchiveSource:
+    """
+    The archived part of a message listing: a segment filter (which
+    conversations) plus a row filter (e.g. one direction only).
+    """
+
+    def __init__(self, database, segments, predicate=None):
+        self.database = database
+        self.segments = segments
+        self.predicate = predicate
+
+    def horizon(self):
+        """
+        Timestamp of the newest archived message, or None.
+        """
+        horizon = get_horizon(self.database)
+        return horizon and horizon[0]
+
+    def newest_id(self):
+        """
+        Highest archived message id, or None.
+        """
+        horizon = get_horizon(self.database)
+        return horizon and horizon[1]
+
+    def page(self, ascending, limit, after=None, before=None, since_id=None, since_at=None):
+        """
+        Up to `limit` archived messages strictly between the `after` and
+        `before` positions (and newer than `since_*`), oldest first when
+        `ascending`, newest first otherwise.
+        """
+        segments = MessageArchiveSegment.objects.using(self.database).filter(self.segments)
+        if after:
+            segments = segments.filter(last_at__gte=after[0])
+        if since_at:
+            segments = segments.filter(last_at__gt=since_at)
+        if since_id is not None:
+            segments = segments.filter(last_id__gt=since_id)
+        if before:
+            segments = segments.filter(first_at__lte=before[0])
+        if ascending:
+            segments = segments.order_by('first_at', 'first_id')
+        else:
+            segments = segments.order_by('-last_at', '-last_id')
+
+        # Keep the best `limit` rows; segments of different conversations
+        # overlap in time, so stop only once no later segment can improve them
+        found = []
+        for segment in segments.iterator(chunk_size=4):
+            if len(found) >= limit:
+                worst = found[-1][0]
+                if ascending and (segment.first_at, segment.first_id) > worst:
+                    break
+                if not ascending and (segment.last_at, segment.last_id) < worst:
+                    break
+            for message in unpack(segment):
+                if self.predicate and not self.predicate(message):
+                    continue
+                if after and position(message) <= after:
+                    continue
+                if before and position(message) >= before:
+                    continue
+                if since_id is not None and message.id <= since_id:
+                    continue
+                if since_at and message.timestamp <= since_at:
+                    continue
+                found.append((position(message), message))
+            best = heapq.nsmallest if ascending else heapq.nlargest
+            found = best(limit, found, key=lambda item: item[0])
+
+        messages = [message for _, message in found]
+        # The listings show names; load the users in two queries, not per row
+        prefetch_related_objects(messages, 'sender', 'receiver')
+        return messages
+
+
+def archive_databases():
+    # Segments live next to the messages they came from
+    return shard_aliases() or [router.db_for_read(MessageArchiveSegment)]
+
+
+def conversation_database(user_a, user_b):
+    if shard_aliases():
+        return shard_for(user_a, user_b)
+    return router.db_for_read(MessageArchiveSegment)
+
+
+def conversation_archive(user_a, user_b, sender_id=None):
+    """
+    Archive of the chat between two users; only `sender_id`'s side if given.
+    """
+    low, high = min(user_a, user_b), max(user_a, user_b)
+    predicate = (lambda message: message.sender_id == sender_id) if sender_id is not None else None
+    return [ArchiveSource(conversation_database(low, high), Q(user_low_id=low, user_high_id=high), predicate)]
+
+
+def user_archive(user_id, field):
+    """
+    Archived messages whose `field` ('sender_id' or 'receiver_id') is the user,
+    one source per database.
+    """
+    return [
+        ArchiveSource(
+            database,
+            Q(user_low_id=user_id) | Q(user_high_id=user_id),
+            lambda message: getattr(message, field) == user_id,
+        )
+        for database in archive_databases()
+    ]
+
+
+def find_archived(user_a, user_b, message_id):
+    """
+    A single archived message of a conversation, or None.
+    """
+    low, high = min(user_a, user_b), max(user_a, user_b)
+    segments = MessageArchiveSegment.objects.using(conversation_database(low, high)).filter(
+        user_low_id=low, user_high_id=high, first_id__lte=message_id, last_id__gte=message_id
+    )
+    for segment in segments:
+        for message in unpack(segment):
+            if message.id == message_id:
+                return message
+    return None
+
+
+def newest_archived(user_a, user_b):
+    """
+    The newest archived message of a conversation, or None.
+    """
+    low, high = min(user_a, user_b), max(user_a, user_b)
+    segment = MessageArchiveSegment.objects.using(conversation_database(low, high)).filter(
+        user_low_id=low, user_high_id=high
+    ).order_by('-last_at', '-last_id').first()
+    return unpack(segment)[-1] if segment else None
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+# Events a slow subscriber may fall behind by before new ones are dropped
+SUBSCRIPTION_QUEUE_SIZE = 1000
+
+
+class BaseBroker:
+    """
+    Pub/sub interface used by the push channel.
+
+    `publish` is called from synchronous code (signal handlers) and must be
+    thread-safe. `subscribe` is called from the ASGI event loop and returns a
+    subscription with async `get()` and `close()` methods.
+    """
+
+    def publish(self, user_id, event):
+        raise NotImplementedError
+
+    def subscribe(self, user_id):
+        raise NotImplementedError
+
+
+class InMemorySubscription:
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=SUBSCRIPTION_QUEUE_SIZE)
+
+    def deliver(self, event):
+        # Runs on the subscriber's event loop
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass  # Drop rather than let one slow client grow without bound
+
+    async def get(self):
+        return await self.queue.get()
+
+    async def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker(BaseBroker):
+    """
+    Single-process broker. Good for development, a single ASGI worker and tests.
+    """
+
+    def __init__(self, **options):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def publish(self, user_id, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+
+    def subscribe(self, user_id):
+        subscription = InMemorySubscription(self, user_id)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+
+class RedisSubscription:
+    def __init__(self, client, channel):
+        self.client = client
+        self.channel = channel
+        self.pubsub = None
+
+    async def get(self):
+        if self.pubsub is None:
+            self.pubsub = self.client.pubsub()
+            await self.pubsub.subscribe(self.channel)
+        while True:
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            if message is not None:
+                return json.loads(message['data'])
+
+    async def close(self):
+        if self.pubsub is not None:
+            await self.pubsub.unsubscribe(self.channel)
+            await self.pubsub.close()
+
+
+class RedisBroker(BaseBroker):
+    """
+    Broker for multi-process deployments, backed by Redis pub/sub.
+    Requires the optional `redis` package.
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='chat:user:', **options):
+        try:
+            import redis
+            import redis.asyncio
+        except ImportError as e:
+            raise ImproperlyConfigured('RedisBroker requires the "redis" package.') from e
+        self.url = url
+        self.prefix = prefix
+        self._redis = redis
+        self._client = redis.Redis.from_url(url)
+        self._async_client = None
+
+    def channel(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    def publish(self, user_id, event):
+        self._client.publish(self.channel(user_id), json.dumps(event))
+
+    def subscribe(self, user_id):
+        if self._async_client is None:
+            self._async_client = self._redis.asyncio.Redis.from_url(self.url)
+        return RedisSubscription(self._async_client, self.channel(user_id))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """
+    Return the process-wide broker configured by CHAT_PUSH_BROKER.
+    """
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                broker_class = import_string(
+                    getattr(settings, 'CHAT_PUSH_BROKER', 'chat.broker.InMemoryBroker')
+                )
+                _broker = broker_class(**getattr(settings, 'CHAT_PUSH_BROKER_OPTIONS', {}))
+    return _broker
@@ -0,0 +1,108 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .storage import unseal
+
+# Default memory budget for decrypted plaintext, in bytes
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+# Rough per-entry bookkeeping cost (key, digest, tuple, OrderedDict node)
+ENTRY_OVERHEAD = 200
+
+
+def token_digest(token):
+    """
+    Short digest of a ciphertext (payload bytes or legacy token str). Part of
+    the cache key so a row whose content changed (edit, key rotation) can
+    never be served a stale plaintext.
+    """
+    if isinstance(token, str):
+        token = token.encode()
+    return hashlib.blake2b(token, digest_size=16).digest()
+
+
+class DecryptedMessageCache:
+    """
+    Process-local LRU cache of decrypted message content, bounded by bytes.
+
+    Entries are keyed by message id and checked against a digest of the
+    ciphertext they were decrypted from.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # message id -> (digest, plaintext, size)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, message_id, token):
+        digest = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is not None and entry[0] == digest:
+                self._entries.move_to_end(message_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, message_id, token, plaintext):
+        size = sys.getsizeof(plaintext) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return  # Never worth evicting everything for one huge message
+
+        digest = token_digest(token)
+        with self._lock:
+            old = self._entries.pop(message_id, None)
+            if old is not None:
+                self.current_bytes -= old[2]
+            self._entries[message_id] = (digest, plaintext, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, message_id):
+        with self._lock:
+            entry = self._entries.pop(message_id, None)
+            if entry is not None:
+                self.current_bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def decrypt(self, cipher, message_id, token):
+        """
+        Return the plaintext for `token`, decrypting only on a cache miss.
+        """
+        plaintext = self.get(message_id, token)
+        if plaintext is None:
+            plaintext = unseal(cipher, token)
+            self.put(message_id, token, plaintext)
+        return plaintext
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# Shared by the views, the serializer and the push events
+message_cache = DecryptedMessageCache(
+    getattr(settings, 'CHAT_DECRYPT_CACHE_BYTES', DEFAULT_MAX_BYTES)
+)
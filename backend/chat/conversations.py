@@ -0,0 +1,208 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.utils import timezone
+
+from .archive import newest_archived
+from .models import Conversation, Message
+from .sharding import message_database, messages_between
+
+# Chats whose unread messages are counted by one query in count_unread_many;
+# each is one OR branch, which keeps well under SQLite's expression depth limit
+UNREAD_BATCH_SIZE = 200
+
+
+def pair(user_a, user_b):
+    return min(user_a, user_b), max(user_a, user_b)
+
+
+def touched():
+    # Row updates go through QuerySet.update, which skips auto_now
+    return {'version': F('version') + 1, 'updated_at': timezone.now()}
+
+
+def latest_message(user_low, user_high):
+    """
+    Newest message between two users, served by the (sender, receiver, timestamp)
+    index, or from the archive once all the hot messages are gone.
+    """
+    latest = messages_between(user_low, user_high).filter(
+        Q(sender_id=user_low, receiver_id=user_high) | Q(sender_id=user_high, receiver_id=user_low)
+    ).order_by('-timestamp', '-id').first()
+    return latest or newest_archived(user_low, user_high)
+
+
+def record_new_messages(messages):
+    """
+    Fold newly created messages into their Conversation rows: bump the count,
+    the receiving side's unread counter and, if newer, the last message.
+    One locked row update per conversation, however many messages there are.
+    """
+    grouped = defaultdict(list)
+    for message in messages:
+        grouped[pair(message.sender_id, message.receiver_id)].append(message)
+
+    for (user_low, user_high), pair_messages in grouped.items():
+        newest = max(pair_messages, key=lambda message: (message.timestamp, message.id))
+        to_low = sum(1 for message in pair_messages if message.receiver_id == user_low)
+        to_high = len(pair_messages) - to_low
+
+        with transaction.atomic():
+            conversation, _ = Conversation.objects.select_for_update().get_or_create(
+                user_low_id=user_low, user_high_id=user_high
+            )
+            updates = {
+                'message_count': F('message_count') + len(pair_messages),
+                'unread_low': F('unread_low') + to_low,
+                'unread_high': F('unread_high') + to_high,
+                **touched(),
+            }
+            if conversation.last_message_at is None or newest.timestamp >= conversation.last_message_at:
+                updates['last_message'] = newest
+                updates['last_message_at'] = newest.timestamp
+            Conversation.objects.filter(pk=conversation.pk).update(**updates)
+
+
+def record_deleted_message(message):
+    """
+    Take a deleted message back out of its Conversation row.
+    """
+    user_low, user_high = pair(message.sender_id, message.receiver_id)
+    with transaction.atomic():
+        conversation = Conversation.objects.select_for_update().filter(
+            user_low_id=user_low, user_high_id=user_high
+        ).first()
+        if conversation is None:
+            return
+
+        side = 'low' if message.receiver_id == user_low else 'high'
+        updates = touched()
+        if conversation.message_count > 0:
+            updates['message_count'] = F('message_count') - 1
+        # Only messages above the receiver's watermark were counted as unread
+        if message.id > getattr(conversation, f'last_read_{side}') and getattr(conversation, f'unread_{side}') > 0:
+            updates[f'unread_{side}'] = F(f'unread_{side}') - 1
+
+        # The last_message FK is nulled by SET_NULL before post_delete runs
+        if conversation.last_message_id in (None, message.id):
+            latest = latest_message(user_low, user_high)
+            updates['last_message'] = latest
+            updates['last_message_at'] = latest.timestamp if latest else None
+
+        # Kept when the last message goes, with the read watermarks on it
+        Conversation.objects.filter(pk=conversation.pk).update(**updates)
+
+
+def record_edited_message(message):
+    """
+    An edit changes nothing in the summary but what the listings show.
+    """
+    user_low, user_high = pair(message.sender_id, message.receiver_id)
+    Conversation.objects.filter(user_low_id=user_low, user_high_id=user_high).update(**touched())
+
+
+def record_renamed_user(user_id):
+    """
+    The listings show both participants' names, so a rename changes every
+    chat the user is in.
+    """
+    Conversation.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id)).update(**touched())
+
+
+def pair_state(user_a, user_b):
+    """
+    (state, last modified) of the chat between two users, for conditional GET.
+    """
+    user_low, user_high = pair(user_a, user_b)
+    row = Conversation.objects.filter(user_low_id=user_low, user_high_id=user_high).values_list(
+        'id', 'version', 'updated_at'
+    ).first()
+    if row is None:
+        return None, None
+    return row[:2], row[2]
+
+
+def user_state(user_id):
+    """
+    (state, last modified) of everything in a user's chats, for conditional
+    GET. One aggregate over their Conversation rows; the id and count change
+    when a conversation appears or goes away. Last modified is always None:
+    a conversation going away (with a user) moves no timestamp.
+    """
+    state = Conversation.objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id)).aggregate(
+        count=Count('id'), newest=Max('id'), version=Sum('version'),
+    )
+    return (state['count'], state['newest'], state['version']), None
+
+
+def count_unread(user_id, peer_id, last_read_id):
+    """
+    Messages from `peer_id` to `user_id` above the watermark. An index range
+    count on (sender, receiver, id), so the cost grows with the unread
+    messages only, not with the history.
+    """
+    return messages_between(user_id, peer_id).filter(
+        sender_id=peer_id, receiver_id=user_id, id__gt=last_read_id
+    ).count()
+
+
+def count_unread_many(watermarks):
+    """
+    count_unread for many chats at once: {(user_id, peer_id): unread} for
+    {(user_id, peer_id): last_read_id}. One query grouped by (sender,
+    receiver) per UNREAD_BATCH_SIZE chats on each message database, instead
+    of a count per chat.
+    """
+    by_database = defaultdict(list)
+    for (user_id, peer_id), last_read_id in watermarks.items():
+        by_database[message_database(user_id, peer_id)].append((user_id, peer_id, last_read_id))
+
+    unread = dict.fromkeys(watermarks, 0)
+    for database, chats in by_database.items():
+        for start in range(0, len(chats), UNREAD_BATCH_SIZE):
+            ranges = Q(*[
+                Q(sender_id=peer_id, receiver_id=user_id, id__gt=last_read_id)
+                for user_id, peer_id, last_read_id in chats[start:start + UNREAD_BATCH_SIZE]
+            ], _connector=Q.OR)
+            rows = (
+                Message.objects.using(database).filter(ranges)
+                .values_list('receiver_id', 'sender_id').annotate(count=Count('id')).order_by()
+            )
+            for user_id, peer_id, count in rows:
+                unread[user_id, peer_id] = count
+    return unread
+
+
+def mark_read(user_id, peer_id, message_id=None):
+    """
+    Move `user_id`'s read watermark in the chat with `peer_id` up to
+    `message_id` (default: the newest message) and refresh their unread count.
+
+    One row update however many messages were read. The watermark never moves
+    backwards and never past the newest message. Returns the Conversation, or
+    None when the two users have never exchanged messages.
+    """
+    user_low, user_high = pair(user_id, peer_id)
+    side = 'low' if user_id == user_low else 'high'
+
+    with transaction.atomic():
+        conversation = Conversation.objects.select_for_update().filter(
+            user_low_id=user_low, user_high_id=user_high
+        ).first()
+        if conversation is None:
+            return None
+
+        newest = conversation.last_message_id or 0
+        watermark = newest if message_id is None else min(message_id, newest)
+        current = getattr(conversation, f'last_read_{side}')
+        if watermark > current:
+            unread = count_unread(user_id, peer_id, watermark)
+            Conversation.objects.filter(pk=conversation.pk).update(**{
+                f'last_read_{side}': watermark,
+                f'unread_{side}': unread,
+                **touched(),
+            })
+            setattr(conversation, f'last_read_{side}', watermark)
+            setattr(conversation, f'unread_{side}', unread)
+    return conversation
@@ -0,0 +1,179 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from metrics.instrument import record_crypto
+
+from .cache import message_cache
+from .storage import rotate, seal, stored_ciphertext, unseal
+
+# Batches smaller than this are handled inline; the pool only pays off for large pages
+PARALLEL_THRESHOLD = 64
+# Number of tokens handed to one worker at a time
+CHUNK_SIZE = 32
+
+logger = logging.getLogger(__name__)
+
+_cipher = None
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class InstrumentedCipher:
+    """
+    Thin proxy over MultiFernet that reports each operation's time to the
+    metrics subsystem.
+    """
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+
+    def encrypt(self, data):
+        start = time.perf_counter()
+        try:
+            return self.cipher.encrypt(data)
+        finally:
+            record_crypto('encrypt', time.perf_counter() - start)
+
+    def decrypt(self, token, ttl=None):
+        start = time.perf_counter()
+        try:
+            return self.cipher.decrypt(token, ttl)
+        finally:
+            record_crypto('decrypt', time.perf_counter() - start)
+
+    def rotate(self, token):
+        start = time.perf_counter()
+        try:
+            return self.cipher.rotate(token)
+        finally:
+            record_crypto('rotate', time.perf_counter() - start)
+
+
+def get_cipher():
+    """
+    The process-wide cipher for message content.
+
+    It is a MultiFernet over settings.ENCRYPTION_KEYS: the first key encrypts,
+    every key in the ring can decrypt, so keys can be rotated without downtime.
+    """
+    global _cipher
+    if _cipher is None:
+        keys = getattr(settings, 'ENCRYPTION_KEYS', None) or [settings.ENCRYPTION_KEY]
+        _cipher = InstrumentedCipher(MultiFernet([Fernet(key) for key in keys]))
+    return _cipher
+
+
+@receiver(setting_changed)
+def reset_cipher(setting, **kwargs):
+    global _cipher
+    if setting in ('ENCRYPTION_KEY', 'ENCRYPTION_KEYS'):
+        _cipher = None
+
+
+def get_executor():
+    """
+    Shared thread pool for crypto work. The `cryptography` backend releases the
+    GIL inside OpenSSL, so chunks really do run on several cores.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = getattr(settings, 'CHAT_CRYPTO_WORKERS', None) or min(8, os.cpu_count() or 1)
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-crypto')
+    return _executor
+
+
+def _decrypt_chunk(cipher, tokens):
+    results = []
+    for token in tokens:
+        try:
+            results.append(unseal(cipher, token))
+        except Exception as e:
+            # One bad row should not fail the whole page
+            logger.warning("Error decrypting content: %s", e)
+            results.append(None)
+    return results
+
+
+def _encrypt_chunk(cipher, plaintexts):
+    return [seal(cipher, plaintext) for plaintext in plaintexts]
+
+
+def _rotate_chunk(cipher, tokens):
+    results = []
+    for token in tokens:
+        try:
+            results.append(rotate(cipher, token))
+        except (InvalidToken, ValueError):
+            results.append(None)  # Not readable with any key in the ring
+    return results
+
+
+def _run_batched(function, cipher, items):
+    threshold = getattr(settings, 'CHAT_PARALLEL_CRYPTO_THRESHOLD', PARALLEL_THRESHOLD)
+    if len(items) < threshold:
+        return function(cipher, items)
+
+    chunks = [items[i:i + CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+    # Each chunk runs in a copy of the caller's context so its crypto time is
+    # attributed to the right request
+    contexts = [contextvars.copy_context() for _ in chunks]
+    results = []
+    # map() yields in submission order, so the output lines up with `items`
+    for chunk_result in get_executor().map(
+        lambda context, chunk: context.run(function, cipher, chunk), contexts, chunks
+    ):
+        results.extend(chunk_result)
+    return results
+
+
+def decrypt_batch(cipher, tokens):
+    """
+    Decrypt a list of stored ciphertexts (payload bytes or legacy token str),
+    keeping their order. Ones that fail to decrypt come back as None.
+    """
+    return _run_batched(_decrypt_chunk, cipher, list(tokens))
+
+
+def encrypt_batch(cipher, plaintexts):
+    """
+    Encrypt a list of strings into payloads (see chat/storage.py), keeping
+    their order.
+    """
+    return _run_batched(_encrypt_chunk, cipher, list(plaintexts))
+
+
+def rotate_batch(cipher, tokens):
+    """
+    Re-encrypt stored ciphertexts under the primary key of a MultiFernet,
+    keeping their order. Legacy tokens come back as payloads; ones no key can
+    decrypt come back as None.
+    """
+    return _run_batched(_rotate_chunk, cipher, list(tokens))
+
+
+def decrypt_messages(cipher, messages):
+    """
+    Decrypted content for each message, in order. Cached plaintexts are reused
+    and only the misses are decrypted, as one batch.
+    """
+    stored = [stored_ciphertext(message) for message in messages]
+    contents = [message_cache.get(message.id, token) for message, token in zip(messages, stored)]
+    missing = [i for i, content in enumerate(contents) if content is None]
+    if missing:
+        decrypted = decrypt_batch(cipher, [stored[i] for i in missing])
+        for i, plaintext in zip(missing, decrypted):
+            contents[i] = plaintext
+            if plaintext is not None:
+                message_cache.put(messages[i].id, stored[i], plaintext)
+    return contents
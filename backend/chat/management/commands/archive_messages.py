@@ -0,0 +1,89 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from django.db.models import Q
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from chat.archive import SEGMENT_SIZE, archive_after, forget_horizon, pack
+from chat.models import Message, MessageArchiveSegment
+from chat.sharding import shard_aliases
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than CHAT_ARCHIVE_AFTER_DAYS (or --older-than-days) "
+        "into compressed per-conversation archive segments. The chat listings keep "
+        "serving them; the hot table and its indexes shrink. Safe to rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=float, default=None,
+                            help='Archive messages older than this. Default: CHAT_ARCHIVE_AFTER_DAYS.')
+        parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE,
+                            help='Messages packed into one compressed segment.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many messages would be archived.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between segments to leave room for live traffic.')
+
+    def handle(self, *args, **options):
+        age = archive_after() if options['older_than_days'] is None else timedelta(days=options['older_than_days'])
+        cutoff = timezone.now() - age
+
+        archived = segments = 0
+        for database in shard_aliases() or [router.db_for_write(Message)]:
+            database_archived, database_segments = self.archive(database, cutoff, options)
+            archived += database_archived
+            segments += database_segments
+            forget_horizon(database)
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Would archive {archived} messages older than {cutoff}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Archived {archived} messages into {segments} segments"))
+
+    def archive(self, database, cutoff, options):
+        messages = Message.objects.using(database).filter(timestamp__lt=cutoff)
+        if options['dry_run']:
+            return messages.count(), 0
+
+        # Conversations with something to archive, listed once
+        pairs = list(
+            messages
+            .annotate(low=Least('sender_id', 'receiver_id'), high=Greatest('sender_id', 'receiver_id'))
+            .values_list('low', 'high')
+            .distinct()
+            .order_by()
+        )
+
+        archived = segments = 0
+        for low, high in pairs:
+            conversation = messages.filter(
+                Q(sender_id=low, receiver_id=high) | Q(sender_id=high, receiver_id=low)
+            ).order_by('timestamp', 'id')
+            while True:
+                batch = list(conversation[:options['segment_size']])
+                if not batch:
+                    break
+                with transaction.atomic(using=database):
+                    MessageArchiveSegment.objects.using(database).create(
+                        user_low_id=low,
+                        user_high_id=high,
+                        first_id=batch[0].id,
+                        first_at=batch[0].timestamp,
+                        last_id=batch[-1].id,
+                        last_at=batch[-1].timestamp,
+                        message_count=len(batch),
+                        data=pack(batch),
+                    )
+                    # Raw delete: no signals, the Conversation summary still counts them
+                    Message.objects.using(database).filter(id__in=[m.id for m in batch])._raw_delete(database)
+                archived += len(batch)
+                segments += 1
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+        return archived, segments
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+
+from chat.crypto import get_cipher
+from chat.models import Message
+from chat.sharding import shard_aliases
+from chat.storage import convert_batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert messages still stored as base64 tokens in Message.content to the "
+        "binary payload format (see chat/storage.py). Migration 0008 does this once; "
+        "run this after a rolling deploy to pick up rows written by the old release. "
+        "Safe to rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows converted and written per transaction.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches to leave room for live traffic.')
+
+    def handle(self, *args, **options):
+        cipher = get_cipher()
+        converted = 0
+        for database in shard_aliases() or [router.db_for_write(Message)]:
+            converted += self.compact(cipher, database, options)
+        self.stdout.write(self.style.SUCCESS(f"Converted {converted} messages"))
+
+    def compact(self, cipher, database, options):
+        messages = Message.objects.using(database)
+        converted = last_id = 0
+        while True:
+            batch = list(
+                messages.filter(id__gt=last_id, payload__isnull=True)
+                .order_by('id').only('id', 'content', 'payload')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            changed = convert_batch(cipher, batch)
+            with transaction.atomic(using=database):
+                messages.bulk_update(changed, ['payload', 'content'])
+            converted += len(changed)
+            last_id = batch[-1].id
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        return converted
@@ -0,0 +1,72 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import router
+
+from chat.archive import archive_databases, unpack
+from chat.crypto import decrypt_messages, get_cipher
+from chat.models import Message, MessageArchiveSegment, MessageSearchToken
+from chat.search import index_messages
+from chat.sharding import shard_aliases
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the blind search index (see chat/search.py) for existing messages, "
+        "archived ones included. New and edited messages are indexed as they are "
+        "saved. Safe to rerun; use --rebuild after changing CHAT_SEARCH_KEY."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Messages decrypted and indexed per batch.')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume the hot messages after this id (printed after every batch).')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Drop the whole index first.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches to leave room for live traffic.')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            MessageSearchToken.objects.all().delete()
+            self.stdout.write("Dropped the search index")
+
+        cipher = get_cipher()
+        indexed = 0
+        for database in shard_aliases() or [router.db_for_write(Message)]:
+            indexed += self.index_hot(cipher, database, options)
+        for database in archive_databases():
+            indexed += self.index_archive(cipher, database, options)
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} messages"))
+
+    def index_hot(self, cipher, database, options):
+        messages = Message.objects.using(database)
+        indexed = 0
+        last_id = options['start_after']
+        while True:
+            batch = list(
+                messages.filter(id__gt=last_id).order_by('id')
+                .only('id', 'sender_id', 'receiver_id', 'content', 'payload')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            index_messages(batch, decrypt_messages(cipher, batch))
+            indexed += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"{database}: indexed {indexed} messages (last id {last_id})")
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        return indexed
+
+    def index_archive(self, cipher, database, options):
+        indexed = 0
+        for segment in MessageArchiveSegment.objects.using(database).order_by('id').iterator(chunk_size=10):
+            batch = unpack(segment)
+            index_messages(batch, decrypt_messages(cipher, batch))
+            indexed += len(batch)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        if indexed:
+            self.stdout.write(f"{database}: indexed {indexed} archived messages")
+        return indexed
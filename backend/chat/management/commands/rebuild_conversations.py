@@ -0,0 +1,117 @@
+from itertools import chain
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.functions import Greatest, Least
+
+from chat.conversations import count_unread_many
+from chat.archive import archive_databases
+from chat.models import Conversation, MessageArchiveSegment
+from chat.sharding import message_querysets
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Conversation summary table from the Message history and archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Conversation rows inserted per query.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # One grouped pass over the messages of each shard, streamed rather than
+        # loaded at once. A pair never spans shards, so the groups do not overlap
+        pairs = [
+            queryset
+            .annotate(low=Least('sender_id', 'receiver_id'), high=Greatest('sender_id', 'receiver_id'))
+            .values('low', 'high')
+            .annotate(
+                count=Count('id'),
+                last_id=Max('id'),
+                last_at=Max('timestamp'),
+                to_low=Count('id', filter=Q(receiver_id=F('low'))),
+                to_high=Count('id', filter=Q(receiver_id=F('high'))),
+            )
+            .order_by()
+            for queryset in message_querysets()
+        ]
+
+        # Archived messages still count, but are taken as read
+        archived = {
+            (row['user_low'], row['user_high']): row
+            for database in archive_databases()
+            for row in MessageArchiveSegment.objects.using(database)
+            .values('user_low', 'user_high')
+            .annotate(count=Sum('message_count'), last_id=Max('last_id'), last_at=Max('last_at'))
+            .order_by()
+        }
+
+        total = 0
+        with transaction.atomic():
+            # Read watermarks are user state, not derived data: carry them over
+            watermarks = {
+                (low, high): (read_low, read_high)
+                for low, high, read_low, read_high in Conversation.objects.filter(
+                    Q(last_read_low__gt=0) | Q(last_read_high__gt=0)
+                ).values_list('user_low_id', 'user_high_id', 'last_read_low', 'last_read_high').iterator()
+            }
+            unread = count_unread_many({
+                chat: last_read_id
+                for (low, high), (read_low, read_high) in watermarks.items()
+                for chat, last_read_id in (((low, high), read_low), ((high, low), read_high))
+                if last_read_id
+            })
+            Conversation.objects.all().delete()
+            batch = []
+            rows = chain.from_iterable(shard_pairs.iterator(chunk_size=batch_size) for shard_pairs in pairs)
+            for row in rows:
+                read_low, read_high = watermarks.pop((row['low'], row['high']), (0, 0))
+                old = archived.pop((row['low'], row['high']), None)
+                batch.append(Conversation(
+                    user_low_id=row['low'],
+                    user_high_id=row['high'],
+                    last_message_id=row['last_id'],
+                    last_message_at=row['last_at'],
+                    message_count=row['count'] + (old['count'] if old else 0),
+                    last_read_low=read_low,
+                    last_read_high=read_high,
+                    # Without a watermark every received message is unread
+                    unread_low=unread[row['low'], row['high']] if read_low else row['to_low'],
+                    unread_high=unread[row['high'], row['low']] if read_high else row['to_high'],
+                ))
+                if len(batch) >= batch_size:
+                    Conversation.objects.bulk_create(batch)
+                    total += len(batch)
+                    batch = []
+            # Conversations whose whole history is archived
+            for (low, high), row in archived.items():
+                read_low, read_high = watermarks.pop((low, high), (0, 0))
+                batch.append(Conversation(
+                    user_low_id=low,
+                    user_high_id=high,
+                    last_message_id=row['last_id'],
+                    last_message_at=row['last_at'],
+                    message_count=row['count'],
+                    last_read_low=read_low,
+                    last_read_high=read_high,
+                ))
+                if len(batch) >= batch_size:
+                    Conversation.objects.bulk_create(batch)
+                    total += len(batch)
+                    batch = []
+            # Chats emptied by deletes keep their row for the watermarks
+            for (low, high), (read_low, read_high) in watermarks.items():
+                batch.append(Conversation(
+                    user_low_id=low, user_high_id=high, last_read_low=read_low, last_read_high=read_high,
+                ))
+                if len(batch) >= batch_size:
+                    Conversation.objects.bulk_create(batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                Conversation.objects.bulk_create(batch)
+                total += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} conversations"))
@@ -0,0 +1,112 @@
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+
+from chat.archive import forget_horizon
+from chat.models import Message, MessageArchiveSegment
+from chat.sharding import shard_aliases, shard_for
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages to the shard their (sender, receiver) pair hashes to under "
+        "the current CHAT_SHARDS. Run it after adding shards, or once after "
+        "switching an unsharded database to sharded mode. Ids are kept, so "
+        "Conversation rows, read watermarks and cursors stay valid. Safe to rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Messages read from a source database per batch.')
+        parser.add_argument('--source', action='append', dest='sources',
+                            help='Database alias to move messages out of (repeatable). '
+                                 'Default: the main database and every shard.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many messages would move where.')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches to leave room for live traffic.')
+
+    def handle(self, *args, **options):
+        shards = shard_aliases()
+        if not shards:
+            raise CommandError("CHAT_SHARDS is not set, there is nothing to reshard to.")
+
+        sources = options['sources'] or [router.db_for_write(Message)] + shards
+        sources = list(dict.fromkeys(sources))  # Main database may also be a shard
+        moved = defaultdict(int)
+        for source in sources:
+            self.reshard(source, options, moved)
+            self.reshard_archive(source, options)
+
+        for (source, target), count in sorted(moved.items()):
+            self.stdout.write(f"{source} -> {target}: {count}")
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(f"{verb} {sum(moved.values())} messages"))
+
+    def reshard(self, source, options, moved):
+        batch_size = options['batch_size']
+        last_id = 0
+
+        while True:
+            batch = list(Message.objects.using(source).filter(id__gt=last_id).order_by('id')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            by_target = defaultdict(list)
+            for message in batch:
+                target = shard_for(message.sender_id, message.receiver_id)
+                if target != source:
+                    by_target[target].append(message)
+
+            for target, messages in by_target.items():
+                moved[(source, target)] += len(messages)
+                if not options['dry_run']:
+                    self.move(messages, source, target)
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+    def move(self, messages, source, target):
+        copies = [
+            Message(id=m.id, sender_id=m.sender_id, receiver_id=m.receiver_id,
+                    content=m.content, payload=m.payload)
+            for m in messages
+        ]
+        ids = [m.id for m in messages]
+        with transaction.atomic(using=target), transaction.atomic(using=source):
+            # A rerun after a crash between the two commits finds rows already there
+            Message.objects.using(target).bulk_create(copies, ignore_conflicts=True)
+            # bulk_create stamps auto_now_add fields with the current time; restore them
+            for copy, message in zip(copies, messages):
+                copy.timestamp = message.timestamp
+            Message.objects.using(target).bulk_update(copies, ['timestamp'])
+            # Raw delete: no signals, so the Conversation rows are left as they are
+            Message.objects.using(source).filter(id__in=ids)._raw_delete(source)
+
+    def reshard_archive(self, source, options):
+        # Archive segments follow their conversation; there are few, move them one by one
+        segments = MessageArchiveSegment.objects.using(source)
+        moving = [
+            (pk, shard_for(low, high))
+            for pk, low, high in segments.values_list('pk', 'user_low_id', 'user_high_id')
+            if shard_for(low, high) != source
+        ]
+        if options['dry_run']:
+            if moving:
+                self.stdout.write(f"{source}: would move {len(moving)} archive segments")
+            return
+        for pk, target in moving:
+            segment = segments.get(pk=pk)
+            created_at = segment.created_at
+            with transaction.atomic(using=target), transaction.atomic(using=source):
+                segments.filter(pk=pk)._raw_delete(source)
+                segment.pk = None
+                segment.save(using=target, force_insert=True)
+                MessageArchiveSegment.objects.using(target).filter(pk=segment.pk).update(created_at=created_at)
+            forget_horizon(target)
+        if moving:
+            forget_horizon(source)
+            self.stdout.write(f"{source}: moved {len(moving)} archive segments")
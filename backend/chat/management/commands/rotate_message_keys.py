@@ -0,0 +1,88 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from django.db.models import Q
+
+from chat.crypto import get_cipher, rotate_batch
+from chat.models import Message
+from chat.sharding import shard_aliases
+from chat.storage import stored_ciphertext
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-encrypt message content with the primary key of ENCRYPTION_KEYS. "
+        "Works in id-ordered batches with constant memory and can be resumed "
+        "with --start-after."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rows re-encrypted and written per transaction.')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume after this message id (printed after every batch).')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches to leave room for live traffic.')
+        parser.add_argument('--shard', action='append', dest='shards',
+                            help='With CHAT_SHARDS: only rotate this shard (repeatable). Default: all.')
+
+    def handle(self, *args, **options):
+        cipher = get_cipher()
+        # None: the unsharded Message table, routed as usual
+        databases = options['shards'] or shard_aliases() or [None]
+        rotated = failed = 0
+        for database in databases:
+            if database is not None:
+                self.stdout.write(f"Shard {database}")
+            shard_rotated, shard_failed = self.rotate(cipher, database, options)
+            rotated += shard_rotated
+            failed += shard_failed
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {rotated} rotated, {failed} skipped"))
+
+    def rotate(self, cipher, database, options):
+        batch_size = options['batch_size']
+        last_id = options['start_after']
+        # Read from where the writes go, so a lagging replica cannot undo a batch
+        database = database or router.db_for_write(Message)
+        messages = Message.objects.using(database)
+        rotated = failed = 0
+
+        while True:
+            # Only id and the ciphertext are loaded, one batch at a time
+            batch = list(
+                messages.filter(id__gt=last_id).order_by('id').only('id', 'content', 'payload')[:batch_size]
+            )
+            if not batch:
+                break
+
+            old_tokens = [stored_ciphertext(message) for message in batch]
+            tokens = rotate_batch(cipher, old_tokens)
+            changed = []
+            for message, old_token, token in zip(batch, old_tokens, tokens):
+                if token is None:
+                    failed += 1
+                    self.stderr.write(f"Message {message.id} cannot be decrypted with any key, skipped")
+                    continue
+                changed.append((message.id, old_token, token))
+
+            # Short transactions keep the write lock from being held for long.
+            # A row is only rewritten if it still holds what was read: one
+            # edited meanwhile is already under the primary key and kept.
+            with transaction.atomic(using=database):
+                for message_id, old_token, token in changed:
+                    if isinstance(old_token, bytes):
+                        unchanged = Q(payload=old_token)
+                    else:
+                        unchanged = Q(payload__isnull=True, content=old_token)
+                    # Legacy rows are converted to payloads on the way, like set_payload does
+                    rotated += messages.filter(unchanged, pk=message_id).update(payload=token, content='')
+
+            last_id = batch[-1].id
+            self.stdout.write(f"Rotated {rotated} messages (last id {last_id})")
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        return rotated, failed
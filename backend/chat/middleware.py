@@ -1,51 +1,93 @@
-from cryptography.fernet import Fernet
-from django.utils.deprecation import MiddlewareMixin
-from django.conf import settings
 import json
+import logging
+
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+
+from .crypto import get_cipher
+
+logger = logging.getLogger(__name__)
+
+# Only requests under these path prefixes are touched by the middleware
+DEFAULT_ROUTES = ('/chat/',)
+# Bodies larger than this (or of unknown length) are left for DRF to stream-parse
+DEFAULT_MAX_BODY = 1024 * 1024
+
+# Attribute used to hand the parsed JSON body to chat.parsers.SharedJSONParser
+PARSED_BODY_ATTR = '_chat_parsed_json'
+
 
 class MessageEncryptionMiddleware(MiddlewareMixin):
     def __init__(self, get_response):
-        # Initialize the cipher with the encryption key from settings
-        self.key = settings.ENCRYPTION_KEY
-        self.cipher = Fernet(self.key)
+        self.routes = tuple(getattr(settings, 'CHAT_ENCRYPTION_ROUTES', DEFAULT_ROUTES))
+        self.max_body = getattr(settings, 'CHAT_ENCRYPTION_MAX_BODY', DEFAULT_MAX_BODY)
+        # Verbose tracing of plaintext/ciphertext is opt-in and goes to the logger
+        self.trace = getattr(settings, 'CHAT_ENCRYPTION_TRACE', False)
         super().__init__(get_response)
 
+    @property
+    def cipher(self):
+        # Shared cipher service (see chat.crypto.get_cipher)
+        return get_cipher()
+
+    def is_chat_route(self, request):
+        return request.path_info.startswith(self.routes)
+
     def process_request(self, request):
-        # Check if the request content type is JSON
-        if request.content_type == 'application/json' and request.body:
+        # Non-chat endpoints (admin, users, freedom wall) are not touched at all
+        if not self.is_chat_route(request) or request.content_type != 'application/json':
+            return
+
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return
+        # Empty, streamed or large bodies are left to DRF's parser, so they are
+        # never buffered here
+        if not content_length or content_length > self.max_body:
+            return
+
+        try:
+            # Decode the incoming request body into JSON, once
+            request_data = json.loads(request.body)
+        except ValueError:
+            return  # Let DRF report the parse error
+
+        if isinstance(request_data, dict) and 'message' in request_data:
+            encrypted_content = request_data['message']
+            if self.trace:
+                logger.debug("Encrypted message in request: %s", encrypted_content)
             try:
-                # Decode the incoming request body into JSON
-                request_data = json.loads(request.body.decode('utf-8'))
-                
-                if 'message' in request_data:
-                    encrypted_content = request_data['message']
-                    print(f"Encrypted message in request: {encrypted_content}")  # Debugging
-                    
-                    # Decrypt the message content
-                    decrypted_content = self.cipher.decrypt(encrypted_content.encode()).decode('utf-8')
-                    print(f"Decrypted message: {decrypted_content}")  # Debugging
-                    
-                    # Replace the encrypted message with the decrypted content
-                    request.data = request_data
-                    request.data['message'] = decrypted_content
+                # Replace the encrypted message with the decrypted content
+                request_data['message'] = self.cipher.decrypt(encrypted_content.encode()).decode('utf-8')
+                if self.trace:
+                    logger.debug("Decrypted message: %s", request_data['message'])
             except Exception as e:
-                print(f"Error processing request: {e}")  # Error handling for decryption failure
+                logger.warning("Error decrypting message in request: %s", e)
+
+        # DRF picks this up instead of parsing the body a second time
+        setattr(request, PARSED_BODY_ATTR, request_data)
 
     def process_response(self, request, response):
+        if not self.is_chat_route(request):
+            return response
+
         # Check if the response has the 'message' field and is JSON
         if hasattr(response, 'data') and isinstance(response.data, dict) and 'message' in response.data:
             message_content = response.data['message']
-            print(f"Original message before decryption: {message_content}")  # Debugging
-            
+            if self.trace:
+                logger.debug("Original message before encryption: %s", message_content)
+
             # Encrypt the message content before returning it (for response encryption)
             try:
                 encrypted_content = self.cipher.encrypt(message_content.encode('utf-8')).decode('utf-8')
-                print(f"Encrypted message in response: {encrypted_content}")  # Debugging
-                
+                if self.trace:
+                    logger.debug("Encrypted message in response: %s", encrypted_content)
+
                 # Set the encrypted message back in the response
                 response.data['message'] = encrypted_content
             except Exception as e:
-                print(f"Error encrypting message in response: {e}")
+                logger.warning("Error encrypting message in response: %s", e)
                 response.data['message'] = "Error encrypting message"
-        
+
         return response
@@ -0,0 +1,120 @@
+import base64
+import zlib
+
+from cryptography.fernet import Fernet, MultiFernet
+from django.conf import settings
+from django.db import migrations, transaction
+
+# Rows read and written per batch, keeps memory and lock time bounded
+BATCH_SIZE = 1000
+
+# The payload format as of this migration (see chat/storage.py), copied so
+# later changes to the app code cannot change what this migration does
+FORMAT_RAW = 1
+FORMAT_ZLIB = 2
+COMPRESS_MIN_BYTES = 256
+# Fernet overhead is 57 bytes plus padding to 16
+FERNET_OVERHEAD = 57
+
+
+def get_cipher():
+    keys = getattr(settings, 'ENCRYPTION_KEYS', None) or [settings.ENCRYPTION_KEY]
+    return MultiFernet([Fernet(key) for key in keys])
+
+
+def compress_min_bytes():
+    return getattr(settings, 'CHAT_COMPRESS_MIN_BYTES', COMPRESS_MIN_BYTES)
+
+
+def seal(cipher, plaintext):
+    data = plaintext.encode()
+    version = FORMAT_RAW
+    if len(data) >= compress_min_bytes():
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            data, version = compressed, FORMAT_ZLIB
+    return bytes([version]) + base64.urlsafe_b64decode(cipher.encrypt(data))
+
+
+def unseal(cipher, payload):
+    payload = bytes(payload)
+    version = payload[0]
+    if version not in (FORMAT_RAW, FORMAT_ZLIB):
+        raise ValueError(f'Unknown message payload format {version}')
+    data = cipher.decrypt(base64.urlsafe_b64encode(payload[1:]))
+    if version == FORMAT_ZLIB:
+        data = zlib.decompress(data)
+    return data.decode()
+
+
+def convert(cipher, token):
+    """
+    Payload for a legacy token. Short plaintexts only need re-framing; long
+    ones are decrypted so they can be compressed.
+    """
+    raw = base64.urlsafe_b64decode(token.encode())
+    if len(raw) - FERNET_OVERHEAD < compress_min_bytes():
+        return bytes([FORMAT_RAW]) + raw
+    return seal(cipher, cipher.decrypt(token.encode()).decode())
+
+
+def convert_messages(apps, schema_editor):
+    """
+    Move every legacy row to the binary payload format, in id-ordered batches.
+    """
+    Message = apps.get_model('chat', 'Message')
+    database = schema_editor.connection.alias
+    messages = Message.objects.using(database)
+    cipher = get_cipher()
+    last_id = 0
+    while True:
+        batch = list(
+            messages.filter(id__gt=last_id, payload__isnull=True).order_by('id').only('id', 'content', 'payload')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        changed = []
+        for message in batch:
+            if message.content:
+                message.payload = convert(cipher, message.content)
+                message.content = ''
+                changed.append(message)
+        with transaction.atomic(using=database):
+            messages.bulk_update(changed, ['payload', 'content'])
+        last_id = batch[-1].id
+
+
+def restore_tokens(apps, schema_editor):
+    """
+    Back to base64 tokens in `content`, so the previous release can read them.
+    """
+    Message = apps.get_model('chat', 'Message')
+    database = schema_editor.connection.alias
+    messages = Message.objects.using(database)
+    cipher = get_cipher()
+    last_id = 0
+    while True:
+        batch = list(
+            messages.filter(id__gt=last_id, payload__isnull=False).order_by('id').only('id', 'payload')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for message in batch:
+            message.content = cipher.encrypt(unseal(cipher, message.payload).encode()).decode()
+            message.payload = None
+        with transaction.atomic(using=database):
+            messages.bulk_update(batch, ['payload', 'content'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    # One transaction per batch rather than one for the whole table
+    atomic = False
+
+    dependencies = [
+        ('chat', '0007_message_payload'),
+    ]
+
+    operations = [
+        migrations.RunPython(convert_messages, restore_tokens),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0008_convert_message_payload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.BigIntegerField()),
+                ('message_id', models.BigIntegerField()),
+                ('peer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['message_id'], name='chat_search_message_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='messagesearchtoken',
+            constraint=models.UniqueConstraint(fields=('user', 'token', 'message_id'), name='chat_search_token_uniq'),
+        ),
+    ]
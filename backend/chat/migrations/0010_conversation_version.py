@@ -0,0 +1,23 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_search_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
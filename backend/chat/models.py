@@ -2,10 +2,129 @@ from django.db import models
 from django.conf import settings
 
 class Message(models.Model):
-    sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="sent_messages")
-    receiver = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="received_messages")
-    content = models.TextField()
+    # No database-level FK constraints: with CHAT_SHARDS the users live on
+    # another database than the messages (see chat/sharding.py)
+    sender = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="sent_messages", db_constraint=False
+    )
+    receiver = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="received_messages", db_constraint=False
+    )
+    # Encrypted content, see chat/storage.py. `payload` holds the current
+    # binary format; `content` only the base64 token of rows not converted yet
+    content = models.TextField(blank=True, default='')
+    payload = models.BinaryField(null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Backs the keyset pagination of conversation and sender listings
+            models.Index(fields=['sender', 'receiver', 'timestamp'], name='chat_msg_sender_recv_ts_idx'),
+            models.Index(fields=['receiver', 'timestamp'], name='chat_msg_receiver_ts_idx'),
+            # Unread counts: messages from a peer above a read watermark
+            models.Index(fields=['sender', 'receiver', 'id'], name='chat_msg_sender_recv_id_idx'),
+        ]
+
     def __str__(self):
         return f"{self.sender} to {self.receiver} at {self.timestamp}"
+
+
+class Conversation(models.Model):
+    """
+    Denormalized summary of the chat between two users, one row per pair.
+    Kept up to date from the Message signals (see chat/conversations.py).
+    `user_low` always holds the smaller of the two user ids.
+    """
+    user_low = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    user_high = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    # May point to a message on a shard, hence no database-level constraint
+    last_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name="+", db_constraint=False
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.PositiveIntegerField(default=0)
+    # Messages received by each side that they have not read yet
+    unread_low = models.PositiveIntegerField(default=0)
+    unread_high = models.PositiveIntegerField(default=0)
+    # Read watermarks: id of the newest message each side has read.
+    # Only ever moves forward (see chat.conversations.mark_read)
+    last_read_low = models.BigIntegerField(default=0)
+    last_read_high = models.BigIntegerField(default=0)
+    # Bumped by every change the two users can see (messages, edits, reads);
+    # the chat listings derive their ETags from it
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='chat_conversation_pair_uniq'),
+        ]
+        indexes = [
+            # Inbox: a user's conversations by recency, from either side of the pair
+            models.Index(fields=['user_low', '-last_message_at'], name='chat_conv_low_recent_idx'),
+            models.Index(fields=['user_high', '-last_message_at'], name='chat_conv_high_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_low} and {self.user_high}"
+
+    def peer_id(self, user_id):
+        return self.user_high_id if user_id == self.user_low_id else self.user_low_id
+
+    def unread_for(self, user_id):
+        return self.unread_low if user_id == self.user_low_id else self.unread_high
+
+    def last_read_for(self, user_id):
+        return self.last_read_low if user_id == self.user_low_id else self.last_read_high
+
+
+class MessageArchiveSegment(models.Model):
+    """
+    A run of consecutive old messages of one conversation, compressed together
+    by `manage.py archive_messages` (see chat/archive.py). Stored on the same
+    database as the pair's hot messages; `user_low` is the smaller user id.
+    """
+    user_low = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+", db_constraint=False)
+    user_high = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+", db_constraint=False)
+    # (timestamp, id) position of the first and last message in the segment
+    first_id = models.BigIntegerField()
+    first_at = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    last_at = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Paging a conversation (or a user's side of it) into the archive
+            models.Index(fields=['user_low', 'user_high', 'last_at'], name='chat_archive_pair_last_idx'),
+            models.Index(fields=['user_high', 'last_at'], name='chat_archive_high_last_idx'),
+            # Newest archived message, the point below which reads consult the archive
+            models.Index(fields=['last_at'], name='chat_archive_last_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.message_count} messages of {self.user_low_id} and {self.user_high_id} up to {self.last_at}"
+
+
+class MessageSearchToken(models.Model):
+    """
+    One word of a message, as a keyed hash, for one of its participants
+    (see chat/search.py). Lives on the main database whatever shard or
+    archive segment holds the message, hence a plain `message_id`.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    peer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    token = models.BigIntegerField()
+    message_id = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            # Also the search index: a user's rows for a token, by message id
+            models.UniqueConstraint(fields=['user', 'token', 'message_id'], name='chat_search_token_uniq'),
+        ]
+        indexes = [
+            # Re-indexing and deleting a message
+            models.Index(fields=['message_id'], name='chat_search_message_idx'),
+        ]
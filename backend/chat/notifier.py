@@ -0,0 +1,128 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Longest a long-poll request may be held open, in seconds
+MAX_WAIT_SECONDS = 25
+
+
+def conversation_key(user_a, user_b):
+    """
+    Notifier key for the chat between two users, regardless of direction.
+    """
+    return ('conversation', min(user_a, user_b), max(user_a, user_b))
+
+
+def sender_key(user_id):
+    return ('sender', user_id)
+
+
+def receiver_key(user_id):
+    return ('receiver', user_id)
+
+
+def message_keys(message):
+    """
+    Every key a newly saved message should wake up.
+    """
+    return [
+        conversation_key(message.sender_id, message.receiver_id),
+        sender_key(message.sender_id),
+        receiver_key(message.receiver_id),
+    ]
+
+
+def get_wait_seconds(request):
+    """
+    Read the `wait` query param (long-poll timeout), capped by the settings.
+    Raises ValueError for bad input.
+    """
+    wait = request.query_params.get('wait')
+    if not wait:
+        return 0
+
+    wait = float(wait)
+    if wait < 0:
+        raise ValueError('wait must not be negative')
+    return min(wait, getattr(settings, 'CHAT_LONG_POLL_MAX_SECONDS', MAX_WAIT_SECONDS))
+
+
+class Listener:
+    """
+    A single waiting request. It is woken when any of its keys is notified.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self._event = threading.Event()
+
+    def wake(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        """
+        Block until woken or until `timeout` seconds pass.
+        Returns True if woken, False on timeout.
+        """
+        if timeout <= 0:
+            return False
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+
+class MessageNotifier:
+    """
+    In-process registry of long-poll listeners, keyed by conversation/user.
+
+    Listeners register *before* running their query so a message saved between
+    the query and the wait is never missed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+    @contextmanager
+    def listen(self, keys):
+        listener = Listener(keys)
+        with self._lock:
+            for key in keys:
+                self._listeners.setdefault(key, set()).add(listener)
+        try:
+            yield listener
+        finally:
+            with self._lock:
+                for key in keys:
+                    waiting = self._listeners.get(key)
+                    if waiting is not None:
+                        waiting.discard(listener)
+                        if not waiting:
+                            del self._listeners[key]
+
+    def notify(self, keys):
+        with self._lock:
+            listeners = set()
+            for key in keys:
+                listeners.update(self._listeners.get(key, ()))
+        for listener in listeners:
+            listener.wake()
+
+    def wait_for_page(self, keys, wait, fetch, refetch=None):
+        """
+        Run `fetch()` and, while it returns no messages, wait up to `wait`
+        seconds for a notification on `keys` and try again with `refetch()`
+        (`fetch()` if not given). Both must return (messages, headers).
+        """
+        deadline = time.monotonic() + wait
+        with self.listen(keys) as listener:
+            messages, headers = fetch()
+            while not messages and listener.wait(deadline - time.monotonic()):
+                messages, headers = (refetch or fetch)()
+        return messages, headers
+
+
+# Shared by the views and the post_save signal handler
+notifier = MessageNotifier()
@@ -0,0 +1,162 @@
+import base64
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+# Page size used when the client does not send a `limit`
+DEFAULT_PAGE_SIZE = 50
+# Hard cap so a single request can never load a whole conversation
+MAX_PAGE_SIZE = 200
+
+
+def encode_position(timestamp, row_id):
+    """
+    Build an opaque cursor string from a (timestamp, id) position.
+    """
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def encode_cursor(message):
+    return encode_position(message.timestamp, message.id)
+
+
+def decode_cursor(cursor):
+    """
+    Turn a cursor string back into a (timestamp, id) tuple.
+    Raises ValueError if the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, message_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def get_page_size(request):
+    """
+    Read the `limit` query param, falling back to the default and capping it.
+    """
+    max_size = getattr(settings, 'CHAT_MAX_PAGE_SIZE', MAX_PAGE_SIZE)
+    limit = request.query_params.get('limit')
+    if not limit:
+        return min(getattr(settings, 'CHAT_PAGE_SIZE', DEFAULT_PAGE_SIZE), max_size)
+
+    limit = int(limit)  # Raises ValueError for bad input
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, max_size)
+
+
+def parse_since_value(since):
+    """
+    `since` is either the last seen message id or an ISO timestamp.
+    Returns (message_id, None) or (None, timestamp).
+    Raises ValueError if it is neither.
+    """
+    if since.isdigit():
+        return int(since), None
+    try:
+        timestamp = datetime.fromisoformat(since)
+    except ValueError as e:
+        raise ValueError('since must be a message id or an ISO timestamp') from e
+    if settings.USE_TZ and timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return None, timestamp
+
+
+def parse_since(since):
+    """
+    Q filter selecting only messages newer than `since` (see parse_since_value).
+    """
+    message_id, timestamp = parse_since_value(since)
+    if message_id is not None:
+        return Q(id__gt=message_id)
+    return Q(timestamp__gt=timestamp)
+
+
+def position(message):
+    return message.timestamp, message.id
+
+
+def paginate_messages(request, queryset, archive=()):
+    """
+    Keyset-paginate a Message queryset on (timestamp, id).
+
+    - no cursor: the most recent page
+    - `before=<cursor>`: the page of messages older than the cursor
+    - `after=<cursor>`: the page of messages newer than the cursor
+    - `since=<id or timestamp>`: the oldest page of messages newer than that
+
+    `queryset` may also be a list of querysets (one per message shard): each
+    one is paged the same way and the pages are merged on (timestamp, id).
+    `archive` sources (chat.archive.ArchiveSource) are merged in too, but only
+    read when the page reaches below their horizon.
+
+    Returns (messages, headers). Messages are always in ascending order and the
+    headers carry the cursors needed to fetch the neighbouring pages.
+    Raises ValueError for bad `limit`, `before` or `after` values.
+    """
+    querysets = queryset if isinstance(queryset, (list, tuple)) else [queryset]
+    limit = get_page_size(request)
+    before = request.query_params.get('before')
+    after = request.query_params.get('after')
+    since = request.query_params.get('since')
+
+    if before and (after or since):
+        raise ValueError('before cannot be combined with after or since')
+
+    if after or since:
+        filters = Q()
+        after_position = since_id = since_at = None
+        if after:
+            after_position = decode_cursor(after)
+            timestamp, message_id = after_position
+            filters &= Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+        if since:
+            since_id, since_at = parse_since_value(since)
+            filters &= parse_since(since)
+        # Fetch one extra row to know whether another page exists
+        pages = [list(qs.filter(filters).order_by('timestamp', 'id')[:limit + 1]) for qs in querysets]
+        # Newest timestamp bound; polls above the horizon skip the archive
+        lower = max((bound for bound in (after_position and after_position[0], since_at) if bound), default=None)
+        for source in archive:
+            horizon = source.horizon()
+            # Everything archived is older than the horizon, and no newer than its highest id
+            if horizon and (lower is None or lower <= horizon) and (since_id is None or since_id < source.newest_id()):
+                pages.append(source.page(
+                    True, limit + 1, after=after_position, since_id=since_id, since_at=since_at
+                ))
+        messages = list(islice(heapq.merge(*pages, key=position), limit + 1))
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+    else:
+        filters = Q()
+        before_position = None
+        if before:
+            before_position = decode_cursor(before)
+            timestamp, message_id = before_position
+            filters = Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        pages = [list(qs.filter(filters).order_by('-timestamp', '-id')[:limit + 1]) for qs in querysets]
+        messages = list(islice(heapq.merge(*pages, key=position, reverse=True), limit + 1))
+        for source in archive:
+            horizon = source.horizon()
+            # A full page of hot messages newer than the horizon cannot contain archived ones
+            if horizon and (len(messages) <= limit or messages[-1].timestamp <= horizon):
+                pages.append(source.page(False, limit + 1, before=before_position))
+                messages = list(islice(heapq.merge(*pages, key=position, reverse=True), limit + 1))
+        has_more = len(messages) > limit
+        # Newest-first from the index, flipped back to chat order
+        messages = messages[:limit][::-1]
+
+    headers = {'X-Has-More': 'true' if has_more else 'false'}
+    if messages:
+        headers['X-Cursor-Before'] = encode_cursor(messages[0])
+        headers['X-Cursor-After'] = encode_cursor(messages[-1])
+
+    return messages, headers
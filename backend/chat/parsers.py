@@ -0,0 +1,18 @@
+from backend.parsers import ORJSONParser
+
+from .middleware import PARSED_BODY_ATTR
+
+
+class SharedJSONParser(ORJSONParser):
+    """
+    JSON parser that reuses the body already parsed by
+    MessageEncryptionMiddleware instead of decoding it again.
+    Falls back to normal parsing when the middleware skipped the request.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = (parser_context or {}).get('request')
+        django_request = getattr(request, '_request', None)
+        if django_request is not None and hasattr(django_request, PARSED_BODY_ATTR):
+            return getattr(django_request, PARSED_BODY_ATTR)
+        return super().parse(stream, media_type, parser_context)
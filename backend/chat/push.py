@@ -0,0 +1,206 @@
+import asyncio
+import json
+import secrets
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from .broker import get_broker
+
+WEBSOCKET_PATH = '/ws/chat/'
+EVENTS_PATH = '/chat/events/'
+# Comment line sent on idle SSE streams so proxies do not close them
+SSE_HEARTBEAT_SECONDS = 15
+# Seconds a push ticket can be redeemed for
+DEFAULT_TICKET_SECONDS = 30
+
+
+def ticket_key(ticket):
+    return f'chat-push-ticket:{ticket}'
+
+
+def issue_ticket(user_id):
+    """
+    A single-use ticket that opens one push connection for `user_id`.
+
+    Browsers cannot set headers on WebSocket/EventSource, so they pass the
+    ticket as `?ticket=` instead of putting the JWT itself in the URL, where
+    it would end up in access logs. Tickets are kept in the default cache,
+    which must be shared when the API and the push channel run in different
+    processes.
+    """
+    ticket = secrets.token_urlsafe(32)
+    cache.set(ticket_key(ticket), user_id, getattr(settings, 'CHAT_PUSH_TICKET_SECONDS', DEFAULT_TICKET_SECONDS))
+    return ticket
+
+
+def redeem_ticket(ticket):
+    """
+    The user id a ticket was issued for, or None. A ticket works only once.
+    """
+    user_id = cache.get(ticket_key(ticket))
+    # Of two connections racing with one ticket, only the one whose delete
+    # removed it gets in
+    if user_id is None or not cache.delete(ticket_key(ticket)):
+        return None
+    return user_id
+
+
+def get_token(scope):
+    """
+    Read the JWT access token from the Authorization header.
+    """
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode().split()
+            if len(parts) == 2 and parts[0] == 'Bearer':
+                return parts[1]
+    return None
+
+
+def get_ticket(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query['ticket'][0] if query.get('ticket') else None
+
+
+def _authenticate(raw_token=None, ticket=None):
+    # Same validation as the REST endpoints (simplejwt)
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError, AuthenticationFailed
+    from users.models import User
+
+    if raw_token is None:
+        user_id = redeem_ticket(ticket)
+        return User.objects.filter(pk=user_id, is_active=True).first() if user_id is not None else None
+
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return None
+
+
+async def authenticate(scope):
+    """
+    The user a push connection is for: from a Bearer token (non-browser
+    clients) or a `?ticket=` from issue_ticket.
+    """
+    raw_token = get_token(scope)
+    ticket = get_ticket(scope)
+    if not raw_token and not ticket:
+        return None
+    return await sync_to_async(_authenticate)(raw_token, ticket)
+
+
+async def next_events(subscription, receive, timeout=None):
+    """
+    Wait for a broker event or a client message, or both.
+    Returns a list of ('event', data) and ('client', message) in the order to
+    handle them, or [('timeout', None)].
+    """
+    event_task = asyncio.ensure_future(subscription.get())
+    receive_task = asyncio.ensure_future(receive())
+    done, pending = await asyncio.wait(
+        [event_task, receive_task], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    if not done:
+        return [('timeout', None)]
+    if receive_task in done and receive_task.result()['type'].endswith('.disconnect'):
+        # A disconnect wins over an event that arrived at the same time
+        return [('client', receive_task.result())]
+    # The event is already off the queue: hand it over before the client's frame
+    events = [('event', event_task.result())] if event_task in done else []
+    if receive_task in done:
+        events.append(('client', receive_task.result()))
+    return events
+
+
+async def websocket_endpoint(scope, receive, send):
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+
+    user = await authenticate(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': 4401})
+        return
+
+    await send({'type': 'websocket.accept'})
+    subscription = get_broker().subscribe(user.id)
+    try:
+        while True:
+            for kind, data in await next_events(subscription, receive):
+                if kind == 'event':
+                    await send({'type': 'websocket.send', 'text': json.dumps(data)})
+                elif data['type'] == 'websocket.disconnect':
+                    return
+                # Anything the client sends is ignored; this channel is push-only
+    finally:
+        await subscription.close()
+
+
+def cors_headers(scope):
+    # The push channel bypasses Django's middleware, so mirror CORS here
+    for name, value in scope.get('headers', []):
+        if name == b'origin' and value.decode() in getattr(settings, 'CORS_ALLOWED_ORIGINS', []):
+            return [(b'access-control-allow-origin', value), (b'vary', b'Origin')]
+    return []
+
+
+async def sse_endpoint(scope, receive, send):
+    user = await authenticate(scope)
+    if user is None:
+        await send({
+            'type': 'http.response.start',
+            'status': 401,
+            'headers': [(b'content-type', b'application/json')] + cors_headers(scope),
+        })
+        await send({'type': 'http.response.body', 'body': b'{"detail": "Authentication required"}'})
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ] + cors_headers(scope),
+    })
+    subscription = get_broker().subscribe(user.id)
+    try:
+        while True:
+            for kind, data in await next_events(subscription, receive, SSE_HEARTBEAT_SECONDS):
+                if kind == 'timeout':
+                    await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+                elif kind == 'event':
+                    body = f"event: {data['type']}\ndata: {json.dumps(data)}\n\n".encode()
+                    await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+                elif data['type'] == 'http.disconnect':
+                    return
+    finally:
+        await subscription.close()
+
+
+class ChatPushRouter:
+    """
+    ASGI router that serves the chat push channel and hands everything else
+    to Django:
+
+    - WebSocket at /ws/chat/
+    - Server-Sent Events at /chat/events/ (fallback for clients without WebSocket)
+    """
+
+    def __init__(self, django_app):
+        self.django_app = django_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'websocket' and scope['path'] == WEBSOCKET_PATH:
+            return await websocket_endpoint(scope, receive, send)
+        if scope['type'] == 'http' and scope['path'] == EVENTS_PATH and scope['method'] == 'GET':
+            return await sse_endpoint(scope, receive, send)
+        return await self.django_app(scope, receive, send)
@@ -0,0 +1,132 @@
+"""
+Blind keyword index over encrypted messages.
+
+Every word of a message is normalized (NFKC, casefolded) and turned into a
+keyed HMAC, truncated to a signed 64-bit integer. The tokens are stored in
+MessageSearchToken, once for each participant, so a search is an indexed
+lookup of the user's tokens; only the matching page is decrypted. Without
+the key the tokens reveal nothing about the words, but equal words give
+equal tokens, so the index does show which messages share a word.
+
+The table lives on the main database next to Conversation, also when the
+messages are sharded or archived. The signals keep it current; existing
+messages are indexed with `manage.py index_messages`.
+"""
+import hashlib
+import hmac
+import re
+import unicodedata
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import router, transaction
+from django.db.models import Count
+from django.dispatch import receiver
+
+from .models import MessageSearchToken
+
+# Shorter words are not indexed
+MIN_WORD_LENGTH = 2
+# Distinct words indexed per message, caps the rows a huge message costs
+MAX_WORDS_PER_MESSAGE = 256
+# Words considered per query
+MAX_QUERY_WORDS = 8
+
+WORD_RE = re.compile(r'\w+')
+
+_key = None
+
+
+def search_key():
+    """
+    HMAC key of the index: CHAT_SEARCH_KEY. Not derived from the encryption
+    key, which rotate_message_keys replaces; changing it means running
+    `index_messages --rebuild`.
+    """
+    global _key
+    if _key is None:
+        key = getattr(settings, 'CHAT_SEARCH_KEY', None)
+        if not key:
+            raise ImproperlyConfigured('CHAT_SEARCH_KEY must be set to index and search messages.')
+        _key = key.encode()
+    return _key
+
+
+@receiver(setting_changed)
+def reset_search_key(setting, **kwargs):
+    global _key
+    if setting == 'CHAT_SEARCH_KEY':
+        _key = None
+
+
+def words(text):
+    """
+    Distinct normalized words of `text`, in order of first appearance.
+    """
+    normalized = unicodedata.normalize('NFKC', text).casefold()
+    found = dict.fromkeys(word for word in WORD_RE.findall(normalized) if len(word) >= MIN_WORD_LENGTH)
+    return list(found)
+
+
+def blind_token(word):
+    digest = hmac.new(search_key(), word.encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def index_messages(messages, plaintexts):
+    """
+    (Re)build the tokens of saved messages from their plaintexts. Messages
+    whose plaintext is None (undecryptable) lose their tokens.
+    """
+    ids = [message.id for message in messages]
+    rows = []
+    for message, plaintext in zip(messages, plaintexts):
+        if plaintext is None:
+            continue
+        tokens = [blind_token(word) for word in words(plaintext)[:MAX_WORDS_PER_MESSAGE]]
+        # Both sides search their own rows; a note to self needs only one
+        for user_id, peer_id in {(message.sender_id, message.receiver_id), (message.receiver_id, message.sender_id)}:
+            rows.extend(
+                MessageSearchToken(user_id=user_id, peer_id=peer_id, token=token, message_id=message.id)
+                for token in tokens
+            )
+    database = router.db_for_write(MessageSearchToken)
+    with transaction.atomic(using=database):
+        MessageSearchToken.objects.using(database).filter(message_id__in=ids).delete()
+        MessageSearchToken.objects.using(database).bulk_create(rows, batch_size=1000)
+
+
+def unindex_messages(message_ids):
+    MessageSearchToken.objects.filter(message_id__in=list(message_ids)).delete()
+
+
+def search(user_id, query, peer_id=None, before=None, limit=50):
+    """
+    ([(message id, peer id), ...], has more) for the user's messages holding
+    every word of `query`, newest first, below the `before` id if given.
+    """
+    query_words = words(query)[:MAX_QUERY_WORDS]
+    if not query_words:
+        return [], False
+    tokens = MessageSearchToken.objects.filter(
+        user_id=user_id, token__in=[blind_token(word) for word in query_words]
+    )
+    if peer_id is not None:
+        tokens = tokens.filter(peer_id=peer_id)
+    if before is not None:
+        tokens = tokens.filter(message_id__lt=before)
+    # A message matches when it has a row for every query word
+    hits = list(
+        tokens.values('message_id', 'peer_id')
+        .annotate(matches=Count('id'))
+        .filter(matches=len(query_words))
+        .order_by('-message_id')
+        .values_list('message_id', 'peer_id')[:limit + 1]
+    )
+    return hits[:limit], len(hits) > limit
+
+
+def matches(query, plaintext):
+    # Drops the rare message that only matched through a truncated-HMAC collision
+    return plaintext is not None and set(words(query)[:MAX_QUERY_WORDS]) <= set(words(plaintext))
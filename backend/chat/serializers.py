@@ -1,42 +1,55 @@
+import logging
+
 from rest_framework import serializers
 from .models import Message
-from cryptography.fernet import Fernet
-from django.conf import settings
+from .cache import message_cache
+from .crypto import get_cipher
+from .sharding import new_message_id
+from .storage import seal, set_payload, stored_ciphertext
+
+logger = logging.getLogger(__name__)
+
 
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ['id', 'sender', 'receiver', 'content', 'timestamp']
+        # The model allows a blank `content` (converted rows), the API does not
+        extra_kwargs = {'content': {'required': True, 'allow_blank': False}}
 
-    def __init__(self, *args, **kwargs):
-        # Initialize the cipher with the encryption key from settings
-        self.cipher = Fernet(settings.ENCRYPTION_KEY)
-        super().__init__(*args, **kwargs)
+    @property
+    def cipher(self):
+        # Shared cipher service, so many=True does not build a Fernet per call
+        return get_cipher()
 
     def to_representation(self, instance):
         # Get the original serialized data
         data = super().to_representation(instance)
 
-        # Decrypt the 'content' field before returning it
-        encrypted_content = data.get('content')
-        if encrypted_content:
+        # Decrypt the stored content (either storage format) before returning it
+        stored = stored_ciphertext(instance)
+        if stored:
             try:
-                decrypted_content = self.cipher.decrypt(encrypted_content.encode()).decode('utf-8')
-                data['content'] = decrypted_content
+                data['content'] = message_cache.decrypt(self.cipher, instance.id, stored)
             except Exception as e:
                 data['content'] = None  # Handle decryption failure
-                print(f"Error decrypting content: {e}")
+                logger.warning("Error decrypting content: %s", e)
         
         return data
 
-    def to_internal_value(self, data):
-        # Encrypt the 'content' field before saving it to the database
-        content = data.get('content')
-        if content:
-            try:
-                encrypted_content = self.cipher.encrypt(content.encode('utf-8')).decode('utf-8')
-                data['content'] = encrypted_content
-            except Exception as e:
-                raise serializers.ValidationError(f"Error encrypting content: {e}")
-        
-        return super().to_internal_value(data)
+    def create(self, validated_data):
+        # Saved through the instance so the shard router can see the pair;
+        # QuerySet.create would pick the database before the fields are set
+        content = validated_data.pop('content')
+        message = Message(id=new_message_id(), payload=seal(self.cipher, content), **validated_data)
+        message.save(force_insert=True)
+        # The plaintext is known, so readers never need to decrypt it
+        message_cache.put(message.id, message.payload, content)
+        return message
+
+    def update(self, instance, validated_data):
+        # Content is encrypted here, never stored as given
+        if 'content' in validated_data:
+            set_payload(instance, seal(self.cipher, validated_data.pop('content')))
+            message_cache.invalidate(instance.id)
+        return super().update(instance, validated_data)
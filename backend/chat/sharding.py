@@ -0,0 +1,242 @@
+"""
+Optional hash sharding of the Message table.
+
+With settings.CHAT_SHARDS set to a list of database aliases, every message is
+stored on the shard picked by a stable hash of its unordered (sender, receiver)
+pair, so a whole conversation lives on one shard. Everything else (users,
+posts, Conversation summaries) stays on the main database.
+
+- Per-conversation reads go straight to the pair's shard.
+- Cross-conversation reads (messages by sender/receiver) fan out to every
+  shard and merge the pages (see chat.pagination.paginate_messages).
+- Message ids are generated here instead of by each shard's autoincrement so
+  they stay unique and time-ordered across shards.
+- `manage.py reshard_messages` moves rows after shards are added or when an
+  unsharded database is switched over.
+
+Without CHAT_SHARDS every helper falls back to normal routing.
+"""
+import hashlib
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+
+from .models import Message
+
+# Sharded message ids: seconds since ID_EPOCH << 20 | worker << 14 | sequence.
+# Small enough to stay exact as a JavaScript number (< 2**53) for ~270 years
+ID_EPOCH = 1704067200  # 2024-01-01 UTC
+WORKER_BITS = 6
+SEQUENCE_BITS = 14
+
+
+def shard_aliases():
+    return list(getattr(settings, 'CHAT_SHARDS', []))
+
+
+def is_sharded():
+    return bool(shard_aliases())
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping & Veach). When a shard is added only about
+    1/buckets of the keys move, all of them to the new shard.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_for(user_a, user_b):
+    """
+    The shard alias holding the conversation between two users.
+    The same for both directions and across processes and restarts.
+    """
+    shards = shard_aliases()
+    low, high = min(user_a, user_b), max(user_a, user_b)
+    digest = hashlib.blake2b(f'{low}:{high}'.encode(), digest_size=8).digest()
+    return shards[jump_hash(int.from_bytes(digest, 'big'), len(shards))]
+
+
+def message_database(user_a, user_b):
+    """
+    Database alias to write the conversation between two users to.
+    """
+    if is_sharded():
+        return shard_for(user_a, user_b)
+    return router.db_for_write(Message)
+
+
+def messages_between(user_a, user_b):
+    """
+    Message manager for the conversation between two users (either direction).
+    """
+    if is_sharded():
+        return Message.objects.using(shard_for(user_a, user_b))
+    return Message.objects.all()
+
+
+def message_querysets():
+    """
+    One Message queryset per shard, for queries that span conversations.
+    """
+    if is_sharded():
+        return [Message.objects.using(alias) for alias in shard_aliases()]
+    return [Message.objects.all()]
+
+
+def with_users(queryset):
+    """
+    Load sender and receiver with the messages. Users live on the main
+    database, so sharded querysets cannot join them in.
+    """
+    if is_sharded():
+        return queryset.prefetch_related('sender', 'receiver')
+    return queryset.select_related('sender', 'receiver')
+
+
+def get_message(pk):
+    """
+    The message with this id on whichever shard holds it.
+    Raises Message.DoesNotExist like Message.objects.get.
+    """
+    for queryset in message_querysets():
+        message = queryset.filter(pk=pk).first()
+        if message is not None:
+            return message
+    raise Message.DoesNotExist(f'Message {pk} does not exist')
+
+
+def get_messages(ids):
+    """
+    {id: Message} for the given ids, looked up on every shard.
+    """
+    ids = list(ids)
+    found = {}
+    for queryset in message_querysets():
+        if not ids:
+            break
+        found.update(queryset.in_bulk(ids))
+        ids = [message_id for message_id in ids if message_id not in found]
+    return found
+
+
+class MessageIdGenerator:
+    """
+    Time-ordered 53-bit ids, unique across processes as long as each process
+    sharing the shards has its own CHAT_SHARD_WORKER_ID (0-63).
+    """
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._second = 0
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            second = max(int(time.time()) - ID_EPOCH, self._second)
+            if second == self._second:
+                self._sequence += 1
+                if self._sequence >= 1 << SEQUENCE_BITS:
+                    # Sequence exhausted: borrow the next second, ids stay increasing
+                    second += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._second = second
+            return (second << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+_generator = None
+
+
+def new_message_id():
+    """
+    Id for a new message, or None to let the database assign one (unsharded).
+    """
+    global _generator
+    if not is_sharded():
+        return None
+    if _generator is None:
+        worker_id = getattr(settings, 'CHAT_SHARD_WORKER_ID', None)
+        # A fallback such as the pid would let two processes hand out the same ids
+        if not isinstance(worker_id, int) or not 0 <= worker_id < 1 << WORKER_BITS:
+            raise ImproperlyConfigured(
+                f"CHAT_SHARD_WORKER_ID must be set to an integer from 0 to {(1 << WORKER_BITS) - 1}, "
+                f"different for every process writing messages, when CHAT_SHARDS is set."
+            )
+        _generator = MessageIdGenerator(worker_id)
+    return _generator.next_id()
+
+
+def bulk_create_messages(messages, batch_size=None):
+    """
+    bulk_create for messages that may belong to different shards.
+    Returns the messages, in order, with their ids set.
+    """
+    if not is_sharded():
+        return Message.objects.bulk_create(messages, batch_size=batch_size)
+
+    by_shard = defaultdict(list)
+    for message in messages:
+        message.id = new_message_id()
+        by_shard[shard_for(message.sender_id, message.receiver_id)].append(message)
+    for alias, shard_messages in by_shard.items():
+        with transaction.atomic(using=alias):
+            Message.objects.using(alias).bulk_create(shard_messages, batch_size=batch_size)
+    return messages
+
+
+def messages_atomic(messages):
+    """
+    A transaction on the main database and on every shard `messages` go to,
+    so an error before the end of the block writes none of them. The shards
+    commit one after another (not two-phase), the main database last: its
+    on_commit callbacks run only once every shard has committed.
+    """
+    aliases = [DEFAULT_DB_ALIAS]
+    if is_sharded():
+        shards = {shard_for(message.sender_id, message.receiver_id) for message in messages}
+        aliases += sorted(shards - {DEFAULT_DB_ALIAS})
+    stack = ExitStack()
+    for alias in aliases:
+        stack.enter_context(transaction.atomic(using=alias))
+    return stack
+
+
+class ShardRouter:
+    """
+    Routes Message instances to their shard. Querysets are routed explicitly
+    with the helpers above, since a bare query does not know its pair.
+    """
+
+    def shard_of(self, message):
+        if message._state.db in shard_aliases():
+            return message._state.db
+        return shard_for(message.sender_id, message.receiver_id)
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        # Related lookups from a message (its sender, ...) carry it as a hint too
+        if is_sharded() and model is Message and isinstance(instance, Message):
+            return self.shard_of(instance)
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Messages point at users across databases; there is no DB constraint
+        if is_sharded() and (isinstance(obj1, Message) or isinstance(obj2, Message)):
+            return True
+        return None
+
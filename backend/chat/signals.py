@@ -0,0 +1,155 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
+from django.dispatch import receiver, Signal
+
+from .broker import get_broker
+from .cache import message_cache
+from .crypto import get_cipher, decrypt_messages
+from .storage import stored_ciphertext
+from .conversations import record_new_messages, record_deleted_message, record_edited_message, record_renamed_user
+from .models import Message, MessageArchiveSegment
+from .notifier import notifier, message_keys
+from .search import index_messages, unindex_messages
+from .sharding import is_sharded, message_querysets
+
+# Sent after MessageViewSet.bulk_send inserts a batch with bulk_create, which
+# skips post_save. Receivers get `messages`, a list of saved Message instances.
+messages_bulk_created = Signal()
+
+
+def message_event(event_type, message):
+    """
+    Build the payload pushed to the sender and receiver over WebSocket/SSE.
+    """
+    data = {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'receiver_id': message.receiver_id,
+        'timestamp': message.timestamp.isoformat() if message.timestamp else None,
+    }
+    if event_type != 'message.deleted':
+        try:
+            data['content'] = message_cache.decrypt(get_cipher(), message.id, stored_ciphertext(message))
+        except Exception:
+            data['content'] = None  # Same fallback as MessageSerializer
+    return {'type': event_type, 'message': data}
+
+
+def publish_message_event(event_type, message):
+    event = message_event(event_type, message)
+    user_ids = {message.sender_id, message.receiver_id}
+
+    def publish():
+        broker = get_broker()
+        for user_id in user_ids:
+            broker.publish(user_id, event)
+
+    transaction.on_commit(publish)
+
+
+@receiver(post_save, sender=Message)
+def wake_long_polls(sender, instance, created, **kwargs):
+    # Only new messages matter to waiting clients, and only once they are
+    # committed so the woken request can actually read them
+    if created:
+        keys = message_keys(instance)
+        transaction.on_commit(lambda: notifier.notify(keys))
+
+
+@receiver(messages_bulk_created)
+def wake_long_polls_bulk(sender, messages, **kwargs):
+    keys = set()
+    for message in messages:
+        keys.update(message_keys(message))
+    transaction.on_commit(lambda: notifier.notify(keys))
+
+
+@receiver(post_save, sender=Message)
+def push_saved_message(sender, instance, created, **kwargs):
+    publish_message_event('message.created' if created else 'message.updated', instance)
+
+
+@receiver(messages_bulk_created)
+def push_bulk_created_messages(sender, messages, **kwargs):
+    for message in messages:
+        publish_message_event('message.created', message)
+
+
+@receiver(post_delete, sender=Message)
+def push_deleted_message(sender, instance, **kwargs):
+    publish_message_event('message.deleted', instance)
+
+
+@receiver(post_delete, sender=Message)
+def forget_deleted_message(sender, instance, **kwargs):
+    # Covers deletes that do not go through delete_message (admin, cascades)
+    message_cache.invalidate(instance.id)
+
+
+@receiver(post_save, sender=Message)
+def update_conversation(sender, instance, created, raw=False, **kwargs):
+    # Edits change neither the count nor the ordering; the preview follows the FK
+    if raw:
+        return
+    if created:
+        record_new_messages([instance])
+    else:
+        record_edited_message(instance)
+
+
+@receiver(messages_bulk_created)
+def update_conversations_bulk(sender, messages, **kwargs):
+    record_new_messages(messages)
+
+
+@receiver(post_delete, sender=Message)
+def remove_from_conversation(sender, instance, **kwargs):
+    record_deleted_message(instance)
+
+
+@receiver(post_save, sender=Message)
+def index_saved_message(sender, instance, raw=False, **kwargs):
+    # New and edited messages alike; the plaintext is usually cached already
+    if not raw:
+        index_messages([instance], decrypt_messages(get_cipher(), [instance]))
+
+
+@receiver(messages_bulk_created)
+def index_bulk_created_messages(sender, messages, **kwargs):
+    index_messages(messages, decrypt_messages(get_cipher(), messages))
+
+
+@receiver(post_delete, sender=Message)
+def unindex_deleted_message(sender, instance, **kwargs):
+    unindex_messages([instance.id])
+
+
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def remember_chat_name(sender, instance, raw, using, update_fields=None, **kwargs):
+    # The conditional GET validators must change when a listed name does
+    if raw or instance._state.adding or (update_fields is not None and 'name' not in update_fields):
+        return
+    instance._chat_old_name = (
+        sender._default_manager.using(using).filter(pk=instance.pk).values_list('name', flat=True).first()
+    )
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def touch_conversations_on_rename(sender, instance, raw, **kwargs):
+    old_name = instance.__dict__.pop('_chat_old_name', None)
+    if old_name is not None and old_name != instance.name:
+        record_renamed_user(instance.pk)
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def delete_sharded_messages(sender, instance, **kwargs):
+    # The ORM cascade only reaches the user's own database, not the shards
+    if not is_sharded():
+        return
+    for queryset in message_querysets():
+        # Raw delete: the user's Conversation rows are cascaded anyway
+        queryset.filter(Q(sender_id=instance.pk) | Q(receiver_id=instance.pk))._raw_delete(queryset.db)
+        segments = MessageArchiveSegment.objects.using(queryset.db)
+        segments.filter(Q(user_low_id=instance.pk) | Q(user_high_id=instance.pk))._raw_delete(queryset.db)
@@ -0,0 +1,122 @@
+"""
+At-rest format of message content.
+
+Messages used to store a base64 Fernet token in `Message.content`. They now
+store `Message.payload`: one format byte followed by the raw (base64-decoded)
+Fernet token, which is about 25% smaller. Plaintext of CHAT_COMPRESS_MIN_BYTES
+or more is zlib-compressed before it is encrypted, when that helps.
+
+    FORMAT_RAW   0x01 + token(utf-8 plaintext)
+    FORMAT_ZLIB  0x02 + token(zlib(utf-8 plaintext))
+
+Rows written before the change keep their token in `content` (with `payload`
+NULL) until migration 0008 or `manage.py compact_messages` converts them;
+every read accepts both. Everything that touches stored content goes
+through this module.
+"""
+import base64
+import zlib
+
+from django.conf import settings
+
+FORMAT_RAW = 1
+FORMAT_ZLIB = 2
+# Plaintext shorter than this is never worth compressing
+COMPRESS_MIN_BYTES = 256
+
+
+def stored_ciphertext(message):
+    """
+    What the message holds: payload bytes in the new format, or the legacy
+    token string.
+    """
+    if message.payload is not None:
+        return bytes(message.payload)  # memoryview on some backends
+    return message.content
+
+
+def set_payload(message, payload):
+    message.payload = payload
+    message.content = ''
+
+
+def seal(cipher, plaintext):
+    """
+    Encrypt a plaintext string into a payload.
+    """
+    data = plaintext.encode()
+    version = FORMAT_RAW
+    if len(data) >= getattr(settings, 'CHAT_COMPRESS_MIN_BYTES', COMPRESS_MIN_BYTES):
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            data, version = compressed, FORMAT_ZLIB
+    return bytes([version]) + base64.urlsafe_b64decode(cipher.encrypt(data))
+
+
+def split(payload):
+    """
+    (format, Fernet token) of a payload. Raises ValueError for unknown formats.
+    """
+    version = payload[0]
+    if version not in (FORMAT_RAW, FORMAT_ZLIB):
+        raise ValueError(f'Unknown message payload format {version}')
+    return version, base64.urlsafe_b64encode(payload[1:])
+
+
+def unseal(cipher, stored):
+    """
+    Decrypt either format back to the plaintext string.
+    """
+    if isinstance(stored, str):
+        return cipher.decrypt(stored.encode()).decode()
+    version, token = split(bytes(stored))
+    data = cipher.decrypt(token)
+    if version == FORMAT_ZLIB:
+        data = zlib.decompress(data)
+    return data.decode()
+
+
+def rotate(cipher, stored):
+    """
+    Re-encrypt under the primary key without touching the plaintext format.
+    Legacy tokens come back as payloads.
+    """
+    if isinstance(stored, str):
+        return bytes([FORMAT_RAW]) + base64.urlsafe_b64decode(cipher.rotate(stored.encode()))
+    version, token = split(bytes(stored))
+    return bytes([version]) + base64.urlsafe_b64decode(cipher.rotate(token))
+
+
+def convert(cipher, token):
+    """
+    Payload for a legacy token. Short plaintexts only need re-framing; long
+    ones are decrypted so they can be compressed.
+    """
+    raw = base64.urlsafe_b64decode(token.encode())
+    # Fernet overhead is 57 bytes plus padding to 16; anything shorter stays raw
+    if len(raw) - 57 < getattr(settings, 'CHAT_COMPRESS_MIN_BYTES', COMPRESS_MIN_BYTES):
+        return bytes([FORMAT_RAW]) + raw
+    return seal(cipher, unseal(cipher, token))
+
+
+def export_token(stored):
+    """
+    (Fernet token string, compressed) for clients that decrypt themselves.
+    """
+    if isinstance(stored, str):
+        return stored, False
+    version, token = split(bytes(stored))
+    return token.decode(), version == FORMAT_ZLIB
+
+
+def convert_batch(cipher, messages):
+    """
+    Move legacy rows (Message instances with `payload` NULL) to the new format
+    in place. Returns the messages that changed.
+    """
+    changed = []
+    for message in messages:
+        if message.payload is None and message.content:
+            set_payload(message, convert(cipher, message.content))
+            changed.append(message)
+    return changed
@@ -1,3 +1,1495 @@
-from django.test import TestCase
+import asyncio
+import json
+import sys
+import threading
+import time
+import zlib
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from backend.testing import ScratchDatabasesTestCase
+from stats.counters import get_counters
+from users.models import User
+
+from . import archive, push, sharding, views
+from .broker import InMemoryBroker
+from .cache import ENTRY_OVERHEAD, DecryptedMessageCache, message_cache
+from .crypto import _run_batched, decrypt_batch, encrypt_batch, get_cipher, rotate_batch
+from .middleware import PARSED_BODY_ATTR, MessageEncryptionMiddleware
+from .models import Conversation, Message, MessageArchiveSegment, MessageSearchToken
+from .parsers import SharedJSONParser
+from .push import ChatPushRouter
+from .search import blind_token, words
+from .serializers import MessageSerializer
+from .sharding import jump_hash, shard_for
+from .storage import FORMAT_RAW, FORMAT_ZLIB, seal, set_payload, stored_ciphertext, unseal
+
+
+class PaginationTests(TestCase):
+    """
+    Keyset pagination of the chat listings on (timestamp, id).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.ids = [self.send(f'message {n}') for n in range(7)]
+        self.params = {'sender_id': self.alice.id, 'receiver_id': self.bob.id, 'limit': 3}
+
+    def send(self, content):
+        response = self.client.post('/chat/api/messages/', {
+            'sender': self.alice.id, 'receiver': self.bob.id, 'content': content,
+        }, format='json')
+        return response.json()['id']
+
+    def page(self, **params):
+        response = self.client.get('/chat/api/messages/messages/', {**self.params, **params})
+        self.assertEqual(response.status_code, 200)
+        return [m['id'] for m in response.json()], response
+
+    def test_walks_back_with_before_cursors(self):
+        ids, response = self.page()
+        self.assertEqual(ids, self.ids[-3:])
+        self.assertEqual(response['X-Has-More'], 'true')
+
+        seen = ids
+        while response['X-Has-More'] == 'true':
+            ids, response = self.page(before=response['X-Cursor-Before'])
+            seen = ids + seen
+        self.assertEqual(seen, self.ids)
+        self.assertEqual(len(ids), 1)
+
+    def test_after_cursor_round_trips(self):
+        ids, response = self.page(before=self.page()[1]['X-Cursor-Before'])
+        self.assertEqual(ids, self.ids[1:4])
+        ids, response = self.page(after=response['X-Cursor-After'])
+        self.assertEqual(ids, self.ids[4:7])
+        self.assertEqual(response['X-Has-More'], 'false')
+
+        # Nothing newer yet: empty page, no cursors
+        ids, response = self.page(after=response['X-Cursor-After'])
+        self.assertEqual(ids, [])
+        self.assertNotIn('X-Cursor-After', response)
+
+    def test_equal_timestamps_are_split_by_id(self):
+        Message.objects.filter(id__in=self.ids).update(timestamp=timezone.now())
+        ids, response = self.page()
+        seen = ids
+        while response['X-Has-More'] == 'true':
+            ids, response = self.page(before=response['X-Cursor-Before'])
+            seen = ids + seen
+        self.assertEqual(seen, self.ids)
+
+    def test_limit_is_capped(self):
+        with self.settings(CHAT_MAX_PAGE_SIZE=2):
+            ids, _ = self.page(limit=100)
+        self.assertEqual(ids, self.ids[-2:])
+
+    def test_bad_parameters_answer_400(self):
+        first = self.page()[1]['X-Cursor-Before']
+        for params in [
+            {'before': 'not a cursor'},
+            {'after': 'bm90IGEgY3Vyc29y'},
+            {'limit': 'ten'},
+            {'limit': 0},
+            {'before': first, 'after': first},
+        ]:
+            response = self.client.get('/chat/api/messages/messages/', {**self.params, **params})
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('detail', response.json())
+
+
+class ConversationTests(TestCase):
+    """
+    The conversation endpoint: both directions of a chat, merged in order.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob', 'carol')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+
+    def send(self, sender, receiver, content):
+        self.client.force_authenticate(sender)
+        response = self.client.post('/chat/api/messages/', {
+            'sender': sender.id, 'receiver': receiver.id, 'content': content,
+        }, format='json')
+        return response.json()['id']
+
+    def test_merges_both_directions_in_order(self):
+        ids = [
+            self.send(self.alice, self.bob, 'hi bob'),
+            self.send(self.bob, self.alice, 'hi alice'),
+            self.send(self.alice, self.bob, 'how are you'),
+        ]
+        self.send(self.alice, self.carol, 'hi carol')
+        self.send(self.carol, self.bob, 'hi bob, from carol')
+
+        self.client.force_authenticate(self.bob)
+        response = self.client.get('/chat/api/conversation/', {'peer_id': self.alice.id})
+        self.assertEqual(response.status_code, 200)
+        messages = response.json()
+        self.assertEqual([m['id'] for m in messages], ids)
+        self.assertEqual([m['content'] for m in messages], ['hi bob', 'hi alice', 'how are you'])
+        self.assertEqual([m['sender_id'] for m in messages], [self.alice.id, self.bob.id, self.alice.id])
+
+    def test_pages_across_directions(self):
+        ids = []
+        for n in range(5):
+            sender, receiver = (self.alice, self.bob) if n % 2 == 0 else (self.bob, self.alice)
+            ids.append(self.send(sender, receiver, f'message {n}'))
+
+        self.client.force_authenticate(self.alice)
+        params = {'peer_id': self.bob.id, 'limit': 2}
+        response = self.client.get('/chat/api/conversation/', params)
+        seen = [m['id'] for m in response.json()]
+        while response['X-Has-More'] == 'true':
+            response = self.client.get('/chat/api/conversation/', {**params, 'before': response['X-Cursor-Before']})
+            seen = [m['id'] for m in response.json()] + seen
+        self.assertEqual(seen, ids)
+
+    def test_peer_id_is_validated(self):
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(self.client.get('/chat/api/conversation/').status_code, 400)
+        self.assertEqual(self.client.get('/chat/api/conversation/', {'peer_id': 'bob'}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id}).status_code, 401)
+
+
+class DecryptedMessageCacheTests(TestCase):
+    """
+    The byte-bounded LRU cache of decrypted content, and its use by the listings.
+    """
+
+    def test_evicts_least_recently_used(self):
+        size = sys.getsizeof('x' * 10) + ENTRY_OVERHEAD
+        lru = DecryptedMessageCache(max_bytes=size * 2)
+        lru.put(1, 'token 1', 'x' * 10)
+        lru.put(2, 'token 2', 'y' * 10)
+        self.assertEqual(lru.get(1, 'token 1'), 'x' * 10)
+        lru.put(3, 'token 3', 'z' * 10)
+
+        self.assertIsNone(lru.get(2, 'token 2'))
+        self.assertEqual(lru.get(1, 'token 1'), 'x' * 10)
+        self.assertEqual(lru.get(3, 'token 3'), 'z' * 10)
+        self.assertEqual(lru.stats(), {
+            'entries': 2, 'bytes': size * 2, 'max_bytes': size * 2, 'hits': 3, 'misses': 1, 'evictions': 1,
+        })
+
+    def test_changed_ciphertext_misses(self):
+        lru = DecryptedMessageCache()
+        lru.put(1, 'old token', 'old')
+        self.assertIsNone(lru.get(1, 'new token'))
+        lru.put(1, 'new token', 'new')
+        self.assertEqual(lru.get(1, 'new token'), 'new')
+        lru.invalidate(1)
+        self.assertIsNone(lru.get(1, 'new token'))
+        self.assertEqual(lru.stats()['bytes'], 0)
+
+    def test_oversized_entries_are_not_cached(self):
+        lru = DecryptedMessageCache(max_bytes=1000)
+        lru.put(1, 'small', 'x')
+        lru.put(2, 'huge', 'x' * 2000)
+        self.assertIsNone(lru.get(2, 'huge'))
+        self.assertEqual(lru.get(1, 'small'), 'x')
+
+    def test_listings_decrypt_once(self):
+        alice, bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+        message_cache.clear()
+        client = APIClient()
+        client.force_authenticate(alice)
+        message = client.post('/chat/api/messages/', {
+            'sender': alice.id, 'receiver': bob.id, 'content': 'hello',
+        }, format='json').json()
+
+        for _ in range(2):
+            response = client.get('/chat/api/conversation/', {'peer_id': bob.id})
+            self.assertEqual(response.json()[0]['content'], 'hello')
+        self.assertGreaterEqual(message_cache.stats()['hits'], 1)
+
+        client.patch(f"/chat/api/messages/{message['id']}/update/", {'content': 'edited'}, format='json')
+        response = client.get('/chat/api/conversation/', {'peer_id': bob.id})
+        self.assertEqual(response.json()[0]['content'], 'edited')
+
+        # The counters are for admins only
+        self.assertEqual(client.get('/chat/api/cache-stats/').status_code, 403)
+        client.force_authenticate(User.objects.create_superuser(name='root', email='root@example.com', password=None))
+        self.assertEqual(client.get('/chat/api/cache-stats/').json()['entries'], message_cache.stats()['entries'])
+
+    def test_undecryptable_content_is_logged(self):
+        alice = User.objects.create_user(name='alice', email='alice@example.com', password=None)
+        message = Message.objects.create(sender=alice, receiver=alice, content='not a token')
+        with self.assertLogs('chat.serializers', 'WARNING'):
+            self.assertIsNone(MessageSerializer(message).data['content'])
+
+
+class ParallelCryptoTests(SimpleTestCase):
+    """
+    Batch encryption and decryption, inline and on the crypto thread pool.
+    """
+
+    def test_batches_keep_their_order(self):
+        plaintexts = [f'message {n}' for n in range(200)]
+        for threshold in (1000, 10):
+            with self.settings(CHAT_PARALLEL_CRYPTO_THRESHOLD=threshold):
+                payloads = encrypt_batch(get_cipher(), plaintexts)
+                self.assertEqual(decrypt_batch(get_cipher(), payloads), plaintexts)
+
+    def test_pool_runs_large_batches(self):
+        threads = set()
+
+        def chunk(cipher, items):
+            threads.add(threading.current_thread().name)
+            return items
+
+        with self.settings(CHAT_PARALLEL_CRYPTO_THRESHOLD=10):
+            self.assertEqual(_run_batched(chunk, None, list(range(100))), list(range(100)))
+            self.assertTrue(all(name.startswith('chat-crypto') for name in threads))
+            threads.clear()
+            _run_batched(chunk, None, list(range(5)))
+            self.assertEqual(threads, {threading.current_thread().name})
+
+    def test_bad_tokens_decrypt_to_none(self):
+        payloads = encrypt_batch(get_cipher(), ['first', 'second'])
+        with self.assertLogs('chat.crypto', 'WARNING'):
+            contents = decrypt_batch(get_cipher(), [payloads[0], 'not a token', payloads[1]])
+        self.assertEqual(contents, ['first', None, 'second'])
+
+
+class KeyRotationTests(TestCase):
+    """
+    The MultiFernet key ring and rotate_message_keys.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+
+    def setUp(self):
+        message_cache.clear()
+        self.old_key, self.new_key = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+
+    def send(self, content, legacy=False):
+        if legacy:
+            return Message.objects.create(
+                sender=self.alice, receiver=self.bob, content=get_cipher().encrypt(content.encode()).decode()
+            )
+        return Message.objects.create(sender=self.alice, receiver=self.bob, payload=seal(get_cipher(), content))
+
+    def rotate(self):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('rotate_message_keys', batch_size=2, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def contents(self):
+        return [unseal(get_cipher(), stored_ciphertext(message)) for message in Message.objects.order_by('id')]
+
+    def test_rotates_rows_encrypted_with_the_old_key(self):
+        with self.settings(ENCRYPTION_KEYS=[self.old_key]):
+            ids = [self.send('payload 1').id, self.send('legacy', legacy=True).id, self.send('payload 2').id]
+
+        # The new key encrypts, the old one still decrypts
+        with self.settings(ENCRYPTION_KEYS=[self.new_key, self.old_key]):
+            self.assertEqual(self.contents(), ['payload 1', 'legacy', 'payload 2'])
+            stdout, _ = self.rotate()
+        self.assertIn('Done: 3 rotated, 0 skipped', stdout)
+
+        # Readable without the old key, legacy rows converted
+        with self.settings(ENCRYPTION_KEYS=[self.new_key]):
+            self.assertEqual(self.contents(), ['payload 1', 'legacy', 'payload 2'])
+        self.assertFalse(Message.objects.filter(id__in=ids, payload__isnull=True).exists())
+
+    def test_unreadable_rows_are_skipped(self):
+        with self.settings(ENCRYPTION_KEYS=[self.old_key]):
+            self.send('lost')
+        with self.settings(ENCRYPTION_KEYS=[self.new_key]):
+            kept = self.send('kept')
+            stdout, stderr = self.rotate()
+            self.assertIn('Done: 1 rotated, 1 skipped', stdout)
+            self.assertIn('cannot be decrypted', stderr)
+            self.assertEqual(unseal(get_cipher(), stored_ciphertext(Message.objects.get(pk=kept.pk))), 'kept')
+
+    def test_edits_made_during_a_batch_are_kept(self):
+        with self.settings(ENCRYPTION_KEYS=[self.old_key]):
+            first, second = self.send('first'), self.send('second')
+
+        def rotate_and_edit(cipher, tokens):
+            rotated = rotate_batch(cipher, tokens)
+            # The sender edits while the batch is being re-encrypted
+            set_payload(second, seal(cipher, 'edited'))
+            second.save()
+            return rotated
+
+        with self.settings(ENCRYPTION_KEYS=[self.new_key, self.old_key]):
+            with mock.patch('chat.management.commands.rotate_message_keys.rotate_batch', rotate_and_edit):
+                stdout, _ = self.rotate()
+            self.assertIn('Done: 1 rotated', stdout)
+        with self.settings(ENCRYPTION_KEYS=[self.new_key]):
+            self.assertEqual(self.contents(), ['first', 'edited'])
+
+
+class MessageEncryptionMiddlewareTests(SimpleTestCase):
+    """
+    MessageEncryptionMiddleware and the parser reusing the body it parsed.
+    """
+
+    def setUp(self):
+        self.middleware = MessageEncryptionMiddleware(lambda request: HttpResponse())
+        self.factory = RequestFactory()
+
+    def post(self, path, data):
+        return self.factory.post(path, json.dumps(data), content_type='application/json')
+
+    def test_decrypts_the_message_field_once(self):
+        token = get_cipher().encrypt(b'secret').decode()
+        request = self.post('/chat/api/bulk-send/', {'message': token, 'other': 1})
+        self.middleware.process_request(request)
+        self.assertEqual(getattr(request, PARSED_BODY_ATTR), {'message': 'secret', 'other': 1})
+
+        # The parser hands that over without reading the stream
+        parser_context = {'request': Request(request)}
+        self.assertEqual(
+            SharedJSONParser().parse(None, 'application/json', parser_context), {'message': 'secret', 'other': 1}
+        )
+
+    def test_skips_other_routes_and_large_bodies(self):
+        request = self.post('/freedom-wall/api/posts/', {'title': 'x'})
+        self.middleware.process_request(request)
+        self.assertFalse(hasattr(request, PARSED_BODY_ATTR))
+
+        with self.settings(CHAT_ENCRYPTION_MAX_BODY=10):
+            middleware = MessageEncryptionMiddleware(lambda request: HttpResponse())
+        request = self.post('/chat/api/bulk-send/', {'content': 'longer than ten bytes'})
+        middleware.process_request(request)
+        self.assertFalse(hasattr(request, PARSED_BODY_ATTR))
+
+        # Without the middleware's result the parser reads the body itself
+        parser_context = {'request': Request(request)}
+        self.assertEqual(
+            SharedJSONParser().parse(BytesIO(request.body), 'application/json', parser_context),
+            {'content': 'longer than ten bytes'},
+        )
+
+    def test_encrypts_the_message_field_of_responses(self):
+        request = self.factory.get('/chat/api/inbox/')
+        response = self.middleware.process_response(request, Response({'message': 'hello'}))
+        self.assertEqual(get_cipher().decrypt(response.data['message'].encode()), b'hello')
+
+        request = self.factory.get('/users/api/me/')
+        response = self.middleware.process_response(request, Response({'message': 'hello'}))
+        self.assertEqual(response.data['message'], 'hello')
+
+
+class BulkSendTests(TestCase):
+    """
+    bulk-send: many messages per request, reported item by item.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob', 'carol')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def bulk_send(self, messages):
+        return self.client.post('/chat/api/bulk-send/', {'messages': messages}, format='json')
+
+    def test_sends_every_message(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.bulk_send([
+                {'receiver': self.bob.id, 'content': 'hi bob'},
+                {'receiver': self.carol.id, 'content': 'hi carol'},
+                {'receiver': self.bob.id, 'content': 'again'},
+            ])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 3)
+        ids = [result['id'] for result in response.json()['results']]
+
+        response = self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id})
+        self.assertEqual([(m['id'], m['content']) for m in response.json()], [(ids[0], 'hi bob'), (ids[2], 'again')])
+        # The Conversation summaries follow bulk sends too
+        conversation = Conversation.objects.get(user_low=self.alice, user_high=self.bob)
+        self.assertEqual((conversation.message_count, conversation.last_message_id), (2, ids[2]))
+
+    def test_reports_failures_by_index(self):
+        response = self.bulk_send([
+            {'receiver': self.bob.id, 'content': 'ok'},
+            {'receiver': 'bob', 'content': 'bad receiver'},
+            {'receiver': 999999, 'content': 'no such user'},
+            {'receiver': self.bob.id, 'content': ''},
+            'not an object',
+        ])
+        self.assertEqual(response.status_code, 207)
+        body = response.json()
+        self.assertEqual((body['created'], body['failed']), (1, 4))
+        self.assertEqual([result['status'] for result in body['results']], ['created'] + ['error'] * 4)
+        self.assertEqual(
+            [result.get('detail') for result in body['results'][1:]],
+            ['Invalid receiver format', 'Receiver not found', 'Content is required', 'Item must be an object'],
+        )
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_rejects_bad_batches(self):
+        self.assertEqual(self.bulk_send([]).status_code, 400)
+        self.assertEqual(self.bulk_send([{'receiver': 999999, 'content': 'x'}]).status_code, 400)
+        with self.settings(CHAT_BULK_SEND_MAX=2):
+            response = self.bulk_send([{'receiver': self.bob.id, 'content': 'x'}] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+class InboxTests(TestCase):
+    """
+    The Conversation summary table behind the inbox, and rebuild_conversations.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol, cls.dave = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob', 'carol', 'dave')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+
+    def send(self, sender, receiver, content):
+        self.client.force_authenticate(sender)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/chat/api/messages/', {
+                'sender': sender.id, 'receiver': receiver.id, 'content': content,
+            }, format='json')
+        return response.json()['id']
+
+    def inbox(self, user, **params):
+        self.client.force_authenticate(user)
+        response = self.client.get('/chat/api/inbox/', params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_most_recent_first_with_previews(self):
+        self.send(self.alice, self.bob, 'hi bob')
+        self.send(self.carol, self.alice, 'hi alice')
+        last = self.send(self.bob, self.alice, 'hi again')
+
+        entries = self.inbox(self.alice).json()
+        self.assertEqual([entry['peer_name'] for entry in entries], ['bob', 'carol'])
+        self.assertEqual(entries[0]['last_message_id'], last)
+        self.assertEqual(entries[0]['last_message'], 'hi again')
+        self.assertEqual((entries[0]['message_count'], entries[0]['unread']), (2, 1))
+        self.assertEqual(entries[1]['unread'], 1)
+
+    def test_pages_with_a_cursor(self):
+        for peer in (self.bob, self.carol, self.dave):
+            self.send(peer, self.alice, f'from {peer.name}')
+        # Same last_message_at for two of them: the id breaks the tie
+        Conversation.objects.filter(user_low=self.alice).exclude(user_high=self.dave).update(
+            last_message_at=timezone.now()
+        )
+
+        response = self.inbox(self.alice, limit=2)
+        peers = [entry['peer_name'] for entry in response.json()]
+        self.assertEqual(response['X-Has-More'], 'true')
+        response = self.inbox(self.alice, limit=2, before=response['X-Cursor-Before'])
+        peers += [entry['peer_name'] for entry in response.json()]
+        self.assertEqual(response['X-Has-More'], 'false')
+        self.assertEqual(sorted(peers), ['bob', 'carol', 'dave'])
+
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(self.client.get('/chat/api/inbox/', {'before': 'nope'}).status_code, 400)
+
+    def test_deleting_every_message_keeps_the_watermarks(self):
+        first = self.send(self.bob, self.alice, 'one')
+        second = self.send(self.bob, self.alice, 'two')
+        self.client.force_authenticate(self.alice)
+        self.client.post('/chat/api/mark-read/', {'peer_id': self.bob.id}, format='json')
+
+        self.client.force_authenticate(self.bob)
+        for message_id in (second, first):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.client.delete(f'/chat/api/messages/{message_id}/delete/').status_code, 204)
+
+        conversation = Conversation.objects.get(user_low=self.alice, user_high=self.bob)
+        self.assertEqual((conversation.message_count, conversation.last_message_id), (0, None))
+        self.assertEqual(conversation.last_read_for(self.alice.id), second)
+        # Nothing to show, so no inbox entry
+        self.assertEqual(self.inbox(self.alice).json(), [])
+
+        # New messages start unread above the old watermark
+        self.send(self.bob, self.alice, 'three')
+        self.assertEqual(self.inbox(self.alice).json()[0]['unread'], 1)
+
+    def test_rebuild(self):
+        for n in range(3):
+            self.send(self.bob, self.alice, f'bob {n}')
+            self.send(self.carol, self.alice, f'carol {n}')
+        self.send(self.alice, self.dave, 'hi dave')
+        read = self.send(self.bob, self.alice, 'bob 3')
+        self.send(self.bob, self.alice, 'bob 4')
+        self.client.force_authenticate(self.alice)
+        self.client.post('/chat/api/mark-read/', {'peer_id': self.bob.id, 'message_id': read}, format='json')
+        self.client.post('/chat/api/mark-read/', {'peer_id': self.carol.id}, format='json')
+        before = {row['peer_id']: row for row in self.inbox(self.alice).json()}
+        Conversation.objects.update(message_count=0, unread_low=7, unread_high=7)
+
+        # One grouped query counts the unread messages of every chat with a watermark
+        with CaptureQueriesContext(connection) as queries:
+            call_command('rebuild_conversations', stdout=StringIO())
+        self.assertEqual(sum('COUNT' in query['sql'] and 'chat_message' in query['sql'] for query in queries), 2)
+
+        after = {row['peer_id']: row for row in self.inbox(self.alice).json()}
+        for peer_id, row in before.items():
+            for field in ('message_count', 'unread', 'last_read_id', 'last_message_id'):
+                self.assertEqual(after[peer_id][field], row[field], (peer_id, field))
+        self.assertEqual((after[self.bob.id]['unread'], after[self.carol.id]['unread']), (1, 0))
+
+
+class ReadWatermarkTests(TestCase):
+    """
+    Read watermarks: mark-read, unread counts and read receipts.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob', 'carol')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+        self.ids = [self.send(self.bob, self.alice, f'message {n}') for n in range(5)]
+        self.client.force_authenticate(self.alice)
+
+    def send(self, sender, receiver, content):
+        self.client.force_authenticate(sender)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/chat/api/messages/', {
+                'sender': sender.id, 'receiver': receiver.id, 'content': content,
+            }, format='json')
+        self.client.force_authenticate(self.alice)
+        return response.json()['id']
+
+    def mark_read(self, **data):
+        return self.client.post('/chat/api/mark-read/', {'peer_id': self.bob.id, **data}, format='json')
+
+    def unread(self):
+        return self.client.get('/chat/api/unread/', {'peer_id': self.bob.id}).json()
+
+    def test_unread_counts_follow_mark_read(self):
+        self.assertEqual(self.unread()['unread'], 5)
+
+        response = self.mark_read(message_id=self.ids[1])
+        self.assertEqual(response.json(), {'peer_id': self.bob.id, 'last_read_id': self.ids[1], 'unread': 3})
+        self.assertEqual(self.unread()['unread'], 3)
+
+        # Messages alice sends are never unread for her
+        self.send(self.alice, self.bob, 'reply')
+        self.assertEqual(self.unread()['unread'], 3)
+        self.send(self.bob, self.alice, 'more')
+        self.assertEqual(self.unread()['unread'], 4)
+
+        self.assertEqual(self.mark_read().json()['unread'], 0)
+        entry = self.client.get('/chat/api/inbox/').json()[0]
+        self.assertEqual((entry['unread'], entry['last_read_id']), (0, entry['last_message_id']))
+
+    def test_watermark_only_moves_forward_and_up_to_the_newest(self):
+        self.mark_read(message_id=self.ids[3])
+        self.assertEqual(self.mark_read(message_id=self.ids[0]).json()['last_read_id'], self.ids[3])
+        self.assertEqual(self.mark_read(message_id=self.ids[-1] + 1000).json()['last_read_id'], self.ids[-1])
+
+    def test_read_receipts(self):
+        self.mark_read(message_id=self.ids[2])
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get('/chat/api/inbox/').json()[0]['peer_last_read_id'], self.ids[2])
+        response = self.client.get('/chat/api/unread/', {'peer_id': self.alice.id}).json()
+        self.assertEqual((response['unread'], response['peer_last_read_id']), (0, self.ids[2]))
+
+    def test_bad_requests(self):
+        self.assertEqual(self.mark_read(message_id='last').status_code, 400)
+        self.assertEqual(self.client.post('/chat/api/mark-read/', {}, format='json').status_code, 400)
+        response = self.client.post('/chat/api/mark-read/', {'peer_id': self.carol.id}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get('/chat/api/unread/', {'peer_id': 'bob'}).status_code, 400)
+
+
+class LongPollTests(ScratchDatabasesTestCase):
+    """
+    `since` and `wait`: a long poll is woken by a message committed by
+    another request. Not a TestCase, the sends have to really commit.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send_later(self, delay, content):
+        def send():
+            time.sleep(delay)
+            try:
+                with transaction.atomic():
+                    Message.objects.create(
+                        sender=self.bob, receiver=self.alice, content=get_cipher().encrypt(content.encode()).decode()
+                    )
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_since_returns_only_newer_messages(self):
+        first = self.client.post('/chat/api/messages/', {
+            'sender': self.alice.id, 'receiver': self.bob.id, 'content': 'first',
+        }, format='json').json()
+        second = self.client.post('/chat/api/messages/', {
+            'sender': self.alice.id, 'receiver': self.bob.id, 'content': 'second',
+        }, format='json').json()
+
+        params = {'peer_id': self.bob.id}
+        response = self.client.get('/chat/api/conversation/', {**params, 'since': first['id']})
+        self.assertEqual([m['id'] for m in response.json()], [second['id']])
+        response = self.client.get('/chat/api/conversation/', {**params, 'since': first['timestamp']})
+        self.assertEqual([m['id'] for m in response.json()], [second['id']])
+        response = self.client.get('/chat/api/conversation/', {**params, 'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_wait_is_woken_by_a_new_message(self):
+        self.send_later(0.2, 'are you there?')
+        started = time.monotonic()
+        response = self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id, 'since': 0, 'wait': 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['content'] for m in response.json()], ['are you there?'])
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_wait_times_out_empty(self):
+        started = time.monotonic()
+        response = self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id, 'since': 0, 'wait': 0.2})
+        self.assertEqual(response.json(), [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_bad_wait_answers_400(self):
+        for wait in ('soon', -1):
+            response = self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id, 'wait': wait})
+            self.assertEqual(response.status_code, 400, wait)
+
+
+class PushTests(ScratchDatabasesTestCase):
+    """
+    The WebSocket/SSE push channel, driven as an ASGI app with the in-memory
+    broker. Not a TestCase, authentication and sends run on other threads.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+        self.app = ChatPushRouter(None)
+
+    def send_to_alice(self, content):
+        try:
+            with transaction.atomic():
+                Message.objects.create(
+                    sender=self.bob, receiver=self.alice, content=get_cipher().encrypt(content.encode()).decode()
+                )
+        finally:
+            connections.close_all()
+
+    def run_app(self, scope, connect, disconnect, content='hi alice'):
+        """
+        Run the app until it has pushed one event (or refused the
+        connection) and return everything it sent.
+        """
+        sent = []
+        pushed = asyncio.Event()
+        calls = 0
+
+        async def receive():
+            nonlocal calls
+            calls += 1
+            if calls == 1 and connect:
+                return {'type': connect}
+            if calls <= 2:
+                # Subscribed by now: send a message, which pushes an event
+                await sync_to_async(self.send_to_alice, thread_sensitive=False)(content)
+            await pushed.wait()
+            return {'type': disconnect}
+
+        async def send(message):
+            sent.append(message)
+            if message['type'] in ('websocket.send', 'websocket.close') or message.get('status') == 401 or (
+                message.get('body', b'').startswith(b'event:')
+            ):
+                pushed.set()
+
+        async def run():
+            await asyncio.wait_for(self.app(scope, receive, send), 5)
+
+        asyncio.run(run())
+        return sent
+
+    def websocket(self, query_string=b'', headers=()):
+        scope = {'type': 'websocket', 'path': '/ws/chat/', 'query_string': query_string, 'headers': list(headers)}
+        return self.run_app(scope, 'websocket.connect', 'websocket.disconnect')
+
+    def ticket(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        response = client.post('/chat/api/push-ticket/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['ticket']
+
+    def test_websocket_receives_new_messages(self):
+        sent = self.websocket(b'ticket=' + self.ticket().encode())
+        self.assertEqual(sent[0], {'type': 'websocket.accept'})
+        event = json.loads(sent[1]['text'])
+        self.assertEqual(event['type'], 'message.created')
+        self.assertEqual(event['message']['content'], 'hi alice')
+        self.assertEqual(event['message']['sender_id'], self.bob.id)
+
+    def test_websocket_accepts_bearer_header(self):
+        token = str(RefreshToken.for_user(self.alice).access_token)
+        sent = self.websocket(headers=[(b'authorization', f'Bearer {token}'.encode())])
+        self.assertEqual(sent[0], {'type': 'websocket.accept'})
+        self.assertEqual(json.loads(sent[1]['text'])['type'], 'message.created')
+
+    def test_tickets_work_once_and_tokens_stay_out_of_urls(self):
+        ticket = self.ticket()
+        self.websocket(b'ticket=' + ticket.encode())
+        self.assertEqual(self.websocket(b'ticket=' + ticket.encode()), [{'type': 'websocket.close', 'code': 4401}])
+
+        token = str(RefreshToken.for_user(self.alice).access_token)
+        self.assertEqual(self.websocket(b'token=' + token.encode()), [{'type': 'websocket.close', 'code': 4401}])
+
+    def test_racing_connections_redeem_a_ticket_once(self):
+        ticket = self.ticket()
+        # Both read the ticket before either deletes it
+        with mock.patch.object(push.cache, 'get', return_value=self.alice.id):
+            self.assertEqual(push.redeem_ticket(ticket), self.alice.id)
+            self.assertIsNone(push.redeem_ticket(ticket))
+
+    def test_event_and_client_frame_at_once(self):
+        broker = InMemoryBroker()
+
+        async def receive():
+            return {'type': 'websocket.receive', 'text': 'ping'}
+
+        async def run():
+            subscription = broker.subscribe(1)
+            broker.publish(1, {'type': 'message.created'})
+            await asyncio.sleep(0)
+            events = await push.next_events(subscription, receive)
+            await subscription.close()
+            return events
+
+        # The event was taken off the queue, so it is delivered too
+        self.assertEqual(asyncio.run(run()), [
+            ('event', {'type': 'message.created'}), ('client', {'type': 'websocket.receive', 'text': 'ping'}),
+        ])
+
+    def test_server_sent_events(self):
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': '/chat/events/',
+            'query_string': b'ticket=' + self.ticket().encode(), 'headers': [],
+        }
+        sent = self.run_app(scope, None, 'http.disconnect')
+        self.assertEqual(sent[0]['status'], 200)
+        event, data = sent[1]['body'].decode().split('\n')[:2]
+        self.assertEqual(event, 'event: message.created')
+        self.assertEqual(json.loads(data.removeprefix('data: '))['message']['content'], 'hi alice')
+
+        scope['query_string'] = b''
+        self.assertEqual(self.run_app(scope, None, 'http.disconnect')[0]['status'], 401)
+
+    def test_broker_fans_out_per_user(self):
+        broker = InMemoryBroker()
+
+        async def run():
+            alice, also_alice, bob = broker.subscribe(1), broker.subscribe(1), broker.subscribe(2)
+            broker.publish(1, {'type': 'ping'})
+            events = [await asyncio.wait_for(s.get(), 1) for s in (alice, also_alice)]
+            await alice.close()
+            broker.publish(1, {'type': 'pong'})
+            events.append(await asyncio.wait_for(also_alice.get(), 1))
+            self.assertTrue(bob.queue.empty())
+            await also_alice.close()
+            await bob.close()
+            return events
+
+        self.assertEqual(asyncio.run(run()), [{'type': 'ping'}, {'type': 'ping'}, {'type': 'pong'}])
+        self.assertEqual(broker._subscriptions, {})
+
+
+@override_settings(CHAT_SHARD_WORKER_ID=1)
+class ShardingTests(ScratchDatabasesTestCase):
+    """
+    Messages hash-sharded over three SQLite files; users and Conversation rows
+    stay on the main test database.
+    """
+    aliases = ('shard_1', 'shard_2', 'shard_3')
+
+    def setUp(self):
+        super().setUp()
+        self.users = [
+            User.objects.create_user(name=f'user{n}', email=f'user{n}@example.com', password=None)
+            for n in range(8)
+        ]
+        self.alice = self.users[0]
+        self.peers = self.users[1:]
+
+        sharding = override_settings(CHAT_SHARDS=list(self.aliases))
+        sharding.enable()
+        self.addCleanup(sharding.disable)
+
+        self.client = APIClient()
+        self.login(self.alice)
+
+    def login(self, user):
+        token = RefreshToken.for_user(user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def send(self, sender, receiver, content):
+        self.login(sender)
+        response = self.client.post('/chat/api/messages/', {
+            'sender': sender.id, 'receiver': receiver.id, 'content': content,
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def shard_counts(self):
+        return {alias: Message.objects.using(alias).count() for alias in self.aliases}
+
+    def test_conversation_lives_on_one_shard(self):
+        bob = self.peers[0]
+        self.send(self.alice, bob, 'hi bob')
+        self.send(bob, self.alice, 'hi alice')
+
+        shard = shard_for(self.alice.id, bob.id)
+        self.assertEqual(shard, shard_for(bob.id, self.alice.id))
+        expected = {alias: 2 if alias == shard else 0 for alias in self.aliases}
+        self.assertEqual(self.shard_counts(), expected)
+        self.assertEqual(Message.objects.using('default').count(), 0)
+
+        self.login(self.alice)
+        response = self.client.get('/chat/api/conversation/', {'peer_id': bob.id})
+        self.assertEqual([m['content'] for m in response.json()], ['hi bob', 'hi alice'])
+        self.assertEqual(response.json()[0]['receiver'], 'user1')
+
+        inbox = self.client.get('/chat/api/inbox/').json()
+        self.assertEqual(inbox[0]['last_message'], 'hi alice')
+        self.assertEqual(inbox[0]['message_count'], 2)
+        self.assertEqual(inbox[0]['unread'], 1)
+
+    def test_bulk_send_writes_all_shards_or_none(self):
+        message_cache.clear()
+        messages = [{'receiver': peer.id, 'content': f'hi {peer.name}'} for peer in self.peers]
+        self.assertGreater(len({shard_for(self.alice.id, peer.id) for peer in self.peers}), 1)
+        with mock.patch.object(views.messages_bulk_created, 'send', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post('/chat/api/bulk-send/', {'messages': messages}, format='json')
+        self.assertEqual(sum(self.shard_counts().values()), 0)
+        self.assertEqual(message_cache.stats()['entries'], 0)
+
+        response = self.client.post('/chat/api/bulk-send/', {'messages': messages}, format='json')
+        self.assertEqual(response.json()['created'], len(self.peers))
+        self.assertEqual(sum(self.shard_counts().values()), len(self.peers))
+        self.assertEqual(message_cache.stats()['entries'], len(self.peers))
+
+    def test_stats_count_what_the_shard_commits(self):
+        bob = self.peers[0]
+        before = get_counters()['messages']
+        with transaction.atomic(using=shard_for(self.alice.id, bob.id)):
+            self.send(self.alice, bob, 'rolled back')
+            transaction.set_rollback(True, using=shard_for(self.alice.id, bob.id))
+        self.assertEqual(get_counters()['messages'], before)
+        self.send(self.alice, bob, 'kept')
+        self.assertEqual(get_counters()['messages'], before + 1)
+
+    def test_messages_by_sender_merge_across_shards(self):
+        sent = [self.send(self.alice, peer, f'message {n}') for n, peer in enumerate(self.peers * 2)]
+        self.assertGreater(sum(1 for count in self.shard_counts().values() if count), 1)
+
+        # Walk the pages backwards; the merged history is in send order
+        self.login(self.alice)
+        seen = []
+        params = {'sender_id': self.alice.id, 'limit': 4}
+        while True:
+            response = self.client.get('/chat/api/messages-by-sender/', params)
+            seen = [m['id'] for m in response.json()] + seen
+            if response['X-Has-More'] != 'true':
+                break
+            params['before'] = response['X-Cursor-Before']
+        self.assertEqual(seen, sent)
+
+        response = self.client.get('/chat/api/messages-by-receiver/', {'receiver_id': self.peers[2].id})
+        self.assertEqual([m['content'] for m in response.json()], ['message 2', 'message 9'])
+
+    def test_bulk_send_update_and_delete(self):
+        response = self.client.post('/chat/api/bulk-send/', {'messages': [
+            {'receiver': peer.id, 'content': f'to {peer.name}'} for peer in self.peers
+        ]}, format='json')
+        self.assertEqual(response.status_code, 201)
+        ids = [result['id'] for result in response.json()['results']]
+        self.assertEqual(len(set(ids)), len(self.peers))
+        for peer, message_id in zip(self.peers, ids):
+            self.assertTrue(Message.objects.using(shard_for(self.alice.id, peer.id)).filter(id=message_id).exists())
+        self.assertEqual(Conversation.objects.count(), len(self.peers))
+
+        bob = self.peers[0]
+        response = self.client.put(f'/chat/api/messages/{ids[0]}/update/', {'content': 'edited'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/chat/api/specific-chat/', {'sender_id': self.alice.id, 'receiver_id': bob.id})
+        self.assertEqual([m['content'] for m in response.json()], ['edited'])
+
+        response = self.client.delete(f'/chat/api/messages/{ids[0]}/delete/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(sum(self.shard_counts().values()), len(self.peers) - 1)
+        conversation = Conversation.objects.get(user_low=self.alice, user_high=bob)
+        self.assertEqual((conversation.message_count, conversation.last_message_id), (0, None))
+
+    def test_router_routes_find_sharded_messages(self):
+        ids = [self.send(self.alice, peer, f'hi {peer.name}') for peer in self.peers]
+        self.login(self.alice)
+
+        response = self.client.get('/chat/api/messages/')
+        self.assertEqual([m['id'] for m in response.json()], ids)
+
+        self.assertEqual(self.client.get(f'/chat/api/messages/{ids[2]}/').json()['content'], f'hi {self.peers[2].name}')
+        response = self.client.patch(f'/chat/api/messages/{ids[2]}/', {'content': 'edited'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(f'/chat/api/messages/{ids[2]}/').json()['content'], 'edited')
+
+        self.assertEqual(self.client.delete(f'/chat/api/messages/{ids[2]}/').status_code, 204)
+        self.assertEqual(self.client.get(f'/chat/api/messages/{ids[2]}/').status_code, 404)
+        self.assertEqual(self.client.get('/chat/api/messages/nope/').status_code, 404)
+        self.assertEqual(sum(self.shard_counts().values()), len(self.peers) - 1)
+
+    def test_worker_id_is_required(self):
+        for worker_id in (None, 64):
+            with override_settings(CHAT_SHARD_WORKER_ID=worker_id), mock.patch.object(sharding, '_generator', None):
+                with self.assertRaisesMessage(ImproperlyConfigured, 'CHAT_SHARD_WORKER_ID'):
+                    sharding.new_message_id()
+
+    def test_rebuild_conversations(self):
+        for peer in self.peers:
+            for n in range(3):
+                self.send(peer, self.alice, f'{n}')
+        self.login(self.alice)
+        for peer in self.peers[:4]:
+            self.client.post('/chat/api/mark-read/', {'peer_id': peer.id}, format='json')
+        self.send(self.peers[0], self.alice, 'unread')
+        expected = sorted(Conversation.objects.values_list('user_high', 'message_count', 'unread_low', 'last_read_low'))
+
+        Conversation.objects.update(message_count=0, unread_low=0)
+        call_command('rebuild_conversations', stdout=StringIO())
+        self.assertEqual(
+            sorted(Conversation.objects.values_list('user_high', 'message_count', 'unread_low', 'last_read_low')),
+            expected,
+        )
+        self.assertEqual(Conversation.objects.get(user_high=self.peers[0]).unread_low, 1)
+
+    def test_reshard_from_unsharded_database(self):
+        with override_settings(CHAT_SHARDS=[]):
+            for peer in self.peers:
+                self.send(self.alice, peer, f'to {peer.name}')
+        before = {m.id: m.timestamp for m in Message.objects.using('default')}
+
+        call_command('reshard_messages', verbosity=0, stdout=StringIO())
+        self.assertEqual(Message.objects.using('default').count(), 0)
+        for peer in self.peers:
+            message = Message.objects.using(shard_for(self.alice.id, peer.id)).get(receiver=peer)
+            self.assertEqual(message.timestamp, before[message.id])
+
+        # Nothing left to move
+        out = StringIO()
+        call_command('reshard_messages', stdout=out)
+        self.assertIn('Moved 0 messages', out.getvalue())
+
+        self.login(self.alice)
+        response = self.client.get('/chat/api/messages-by-sender/', {'sender_id': self.alice.id})
+        self.assertEqual(sorted(m['id'] for m in response.json()), sorted(before))
+
+    def test_adding_a_shard_only_moves_to_the_new_shard(self):
+        with override_settings(CHAT_SHARDS=['shard_1', 'shard_2']):
+            for peer in self.peers:
+                self.send(self.alice, peer, f'to {peer.name}')
+            old = self.shard_counts()
+
+        call_command('reshard_messages', verbosity=0, stdout=StringIO())
+        new = self.shard_counts()
+        self.assertEqual(sum(new.values()), len(self.peers))
+        self.assertLessEqual(new['shard_1'], old['shard_1'])
+        self.assertLessEqual(new['shard_2'], old['shard_2'])
+
+    def test_jump_hash_is_consistent(self):
+        for key in range(1000):
+            before, after = jump_hash(key, 4), jump_hash(key, 5)
+            self.assertIn(after, (before, 4))
+
+
+class ArchiveTests(TestCase):
+    """
+    archive_messages and the listings paging from the hot table into the archive.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob', 'carol')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, sender, receiver, content, days_ago=0, minutes=0):
+        message = Message.objects.create(
+            sender=sender, receiver=receiver, content=get_cipher().encrypt(content.encode()).decode()
+        )
+        timestamp = timezone.now() - timedelta(days=days_ago) + timedelta(minutes=minutes)
+        Message.objects.filter(pk=message.pk).update(timestamp=timestamp)
+        return message.id
+
+    def make_history(self):
+        ids = []
+        for n in range(20):
+            sender, receiver = (self.alice, self.bob) if n % 2 == 0 else (self.bob, self.alice)
+            ids.append(self.send(sender, receiver, f'old {n}', days_ago=400, minutes=n))
+        for n in range(10):
+            ids.append(self.send(self.alice, self.bob, f'new {n}', minutes=n))
+        return ids
+
+    def archive(self):
+        call_command('archive_messages', older_than_days=180, segment_size=8, stdout=StringIO())
+
+    def walk_back(self, url, params):
+        seen = []
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            seen = response.json() + seen
+            if response['X-Has-More'] != 'true':
+                return seen
+            params = {**params, 'before': response['X-Cursor-Before']}
+
+    def test_old_messages_move_to_compressed_segments(self):
+        self.make_history()
+        self.archive()
+
+        self.assertEqual(Message.objects.count(), 10)
+        self.assertEqual(list(MessageArchiveSegment.objects.values_list('message_count', flat=True)), [8, 8, 4])
+        segment = MessageArchiveSegment.objects.order_by('first_at').first()
+        self.assertEqual((segment.user_low_id, segment.user_high_id), (self.alice.id, self.bob.id))
+
+        # Rerunning finds nothing left to archive
+        out = StringIO()
+        call_command('archive_messages', older_than_days=180, stdout=out)
+        self.assertIn('Archived 0 messages', out.getvalue())
+
+    def test_listings_page_back_into_the_archive(self):
+        ids = self.make_history()
+        self.archive()
+
+        seen = self.walk_back('/chat/api/conversation/', {'peer_id': self.bob.id, 'limit': 7})
+        self.assertEqual([m['id'] for m in seen], ids)
+        self.assertEqual(seen[0]['content'], 'old 0')
+        self.assertEqual(seen[0]['sender'], 'alice')
+
+        # One direction only
+        seen = self.walk_back('/chat/api/specific-chat/', {
+            'sender_id': self.bob.id, 'receiver_id': self.alice.id, 'limit': 3,
+        })
+        self.assertEqual([m['content'] for m in seen], [f'old {n}' for n in range(1, 20, 2)])
+
+        # Forward from the oldest message
+        response = self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id, 'since': ids[0], 'limit': 25})
+        self.assertEqual([m['id'] for m in response.json()], ids[1:26])
+        self.assertEqual(response['X-Has-More'], 'true')
+        response = self.client.get('/chat/api/conversation/', {
+            'peer_id': self.bob.id, 'after': response['X-Cursor-After'], 'limit': 25,
+        })
+        self.assertEqual([m['id'] for m in response.json()], ids[26:])
+
+    def test_cross_conversation_listing_merges_archives(self):
+        ids = self.make_history()
+        carol_ids = [self.send(self.alice, self.carol, f'carol {n}', days_ago=300) for n in range(3)]
+        self.archive()
+
+        seen = self.walk_back('/chat/api/messages-by-sender/', {'sender_id': self.alice.id, 'limit': 4})
+        sent = [i for n, i in enumerate(ids) if n >= 20 or n % 2 == 0]
+        self.assertEqual(sorted(m['id'] for m in seen), sorted(sent + carol_ids))
+        timestamps = [m['timestamp'] for m in seen]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_recent_pages_skip_the_archive(self):
+        self.make_history()
+        self.archive()
+        self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id, 'limit': 5})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id, 'limit': 5})
+        self.assertEqual(len(response.json()), 5)
+        self.assertFalse(any('chat_messagearchivesegment' in q['sql'] for q in queries.captured_queries))
+
+    def test_id_polls_skip_archived_segments(self):
+        ids = self.make_history()
+        self.archive()
+        params = {'peer_id': self.bob.id, 'limit': 50}
+        self.client.get('/chat/api/conversation/', params)
+
+        # Above the highest archived id: the archive is not read at all
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/chat/api/conversation/', {**params, 'since': ids[20]})
+        self.assertEqual([m['id'] for m in response.json()], ids[21:])
+        self.assertFalse(any('chat_messagearchivesegment' in q['sql'] for q in queries.captured_queries))
+
+        # Inside the archive: only segments past the id are unpacked
+        with mock.patch('chat.archive.unpack', wraps=archive.unpack) as unpack:
+            response = self.client.get('/chat/api/conversation/', {**params, 'since': ids[17]})
+        self.assertEqual([m['id'] for m in response.json()], ids[18:])
+        self.assertEqual(unpack.call_count, 1)
+
+    def test_inbox_preview_from_archive(self):
+        self.send(self.carol, self.alice, 'long ago', days_ago=300)
+        self.archive()
+
+        inbox = self.client.get('/chat/api/inbox/').json()
+        self.assertEqual(inbox[0]['peer_id'], self.carol.id)
+        self.assertEqual(inbox[0]['last_message'], 'long ago')
+        self.assertEqual(inbox[0]['message_count'], 1)
+
+
+@override_settings(CHAT_COMPRESS_MIN_BYTES=256)
+class StorageFormatTests(TestCase):
+    """
+    Binary payloads, compression and reading rows in the legacy token format.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+
+    def setUp(self):
+        message_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def legacy(self, content):
+        # A row as the previous release wrote it
+        return Message.objects.create(
+            sender=self.alice, receiver=self.bob, content=get_cipher().encrypt(content.encode()).decode()
+        )
+
+    def test_compresses_above_the_threshold(self):
+        cipher = get_cipher()
+        short, long = 'hello', 'all work and no play ' * 40
+        self.assertEqual(seal(cipher, short)[0], FORMAT_RAW)
+        self.assertEqual(seal(cipher, long)[0], FORMAT_ZLIB)
+        self.assertEqual(unseal(cipher, seal(cipher, short)), short)
+        self.assertEqual(unseal(cipher, seal(cipher, long)), long)
+
+        legacy_size = len(cipher.encrypt(long.encode()))
+        self.assertLess(len(seal(cipher, long)), legacy_size / 5)
+        # Raw bytes beat base64 even without compression
+        self.assertLess(len(seal(cipher, short)), len(cipher.encrypt(short.encode())))
+
+    def test_api_writes_payloads(self):
+        response = self.client.post('/chat/api/messages/', {'sender': self.alice.id, 'receiver': self.bob.id, 'content': 'hi bob'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        message = Message.objects.get()
+        self.assertEqual(message.content, '')
+        self.assertEqual(unseal(get_cipher(), message.payload), 'hi bob')
+
+    def test_reads_accept_both_formats(self):
+        self.legacy('from the old release')
+        self.client.post('/chat/api/messages/', {'sender': self.alice.id, 'receiver': self.bob.id, 'content': 'x' * 1000}, format='json')
+        message_cache.clear()
+
+        contents = [m['content'] for m in self.client.get('/chat/api/conversation/', {'peer_id': self.bob.id}).json()]
+        self.assertEqual(contents, ['from the old release', 'x' * 1000])
+
+        raw = self.client.get('/chat/api/conversation-messages/', {
+            'sender_id': self.alice.id, 'receiver_id': self.bob.id,
+        }).json()
+        self.assertEqual([m['compressed'] for m in raw], [False, True])
+        self.assertEqual(zlib.decompress(get_cipher().decrypt(raw[1]['content'].encode())), b'x' * 1000)
+
+    def test_compact_converts_legacy_rows(self):
+        old = [self.legacy('short'), self.legacy('long ' * 100)]
+        call_command('compact_messages', batch_size=1, stdout=StringIO())
+
+        for message in old:
+            message.refresh_from_db()
+            self.assertEqual(message.content, '')
+        self.assertEqual(old[0].payload[0], FORMAT_RAW)
+        self.assertEqual(old[1].payload[0], FORMAT_ZLIB)
+        self.assertEqual(unseal(get_cipher(), old[1].payload), 'long ' * 100)
+
+
+class SearchTests(TestCase):
+    """
+    The blind keyword index and the search action.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob', 'carol')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, receiver, content):
+        response = self.client.post('/chat/api/messages/', {
+            'sender': self.alice.id, 'receiver': receiver.id, 'content': content,
+        }, format='json')
+        return response.json()['id']
+
+    def search(self, **params):
+        response = self.client.get('/chat/api/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_tokens_are_keyed_and_normalized(self):
+        self.assertEqual(words('Café, CAFÉ and ｃａｆｅ!'), ['café', 'and', 'cafe'])
+        token = blind_token('cafe')
+        self.assertEqual(blind_token('cafe'), token)
+        with override_settings(CHAT_SEARCH_KEY='another key'):
+            self.assertNotEqual(blind_token('cafe'), token)
+
+    def test_tokens_survive_key_rotation(self):
+        token = blind_token('cafe')
+        new_key = Fernet.generate_key().decode()
+        with override_settings(ENCRYPTION_KEY=new_key, ENCRYPTION_KEYS=[new_key, settings.ENCRYPTION_KEY]):
+            self.assertEqual(blind_token('cafe'), token)
+        with override_settings(CHAT_SEARCH_KEY=None):
+            with self.assertRaises(ImproperlyConfigured):
+                blind_token('cafe')
+
+    def test_search_finds_all_words_newest_first(self):
+        first = self.send(self.bob, 'Lunch at noon?')
+        second = self.send(self.carol, 'lunch tomorrow at the usual place')
+        self.send(self.bob, 'dinner at eight')
+
+        self.assertEqual([m['id'] for m in self.search(q='LUNCH').json()], [second, first])
+        self.assertEqual([m['id'] for m in self.search(q='lunch noon').json()], [first])
+        self.assertEqual([m['id'] for m in self.search(q='lunch', peer_id=self.bob.id).json()], [first])
+        self.assertEqual(self.search(q='lunch').json()[0]['content'], 'lunch tomorrow at the usual place')
+        # The peer finds it too, nobody else does
+        self.client.force_authenticate(self.bob)
+        self.assertEqual([m['id'] for m in self.search(q='noon').json()], [first])
+        self.client.force_authenticate(self.carol)
+        self.assertEqual(self.search(q='noon').json(), [])
+
+    def test_search_pages_with_cursor(self):
+        ids = [self.send(self.bob, f'report number {n}') for n in range(5)]
+        response = self.search(q='report', limit=3)
+        self.assertEqual([m['id'] for m in response.json()], ids[:1:-1])
+        self.assertEqual(response['X-Has-More'], 'true')
+        response = self.search(q='report', limit=3, before=response['X-Cursor-Before'])
+        self.assertEqual([m['id'] for m in response.json()], ids[1::-1])
+        self.assertEqual(response['X-Has-More'], 'false')
+
+    def test_index_follows_edits_deletes_and_bulk_sends(self):
+        message_id = self.send(self.bob, 'old words')
+        self.client.patch(f'/chat/api/messages/{message_id}/update/', {'content': 'new words'}, format='json')
+        self.assertEqual(self.search(q='old').json(), [])
+        self.assertEqual([m['id'] for m in self.search(q='new').json()], [message_id])
+
+        self.client.delete(f'/chat/api/messages/{message_id}/delete/')
+        self.assertEqual(self.search(q='words').json(), [])
+        self.assertFalse(MessageSearchToken.objects.filter(message_id=message_id).exists())
+
+        self.client.post('/chat/api/bulk-send/', {'messages': [
+            {'receiver': self.bob.id, 'content': 'bulk hello'}, {'receiver': self.carol.id, 'content': 'bulk bye'},
+        ]}, format='json')
+        self.assertEqual([m['content'] for m in self.search(q='bulk').json()], ['bulk bye', 'bulk hello'])
+
+    def test_backfill_indexes_existing_and_archived_messages(self):
+        # A legacy row, archived, and a current one
+        old = Message.objects.create(
+            sender=self.alice, receiver=self.bob, content=get_cipher().encrypt(b'meeting notes').decode()
+        )
+        Message.objects.filter(pk=old.pk).update(timestamp=timezone.now() - timedelta(days=400))
+        recent = Message.objects.create(
+            sender=self.bob, receiver=self.alice, payload=seal(get_cipher(), 'meeting moved')
+        )
+        call_command('archive_messages', older_than_days=180, stdout=StringIO())
+        MessageSearchToken.objects.all().delete()
+
+        call_command('index_messages', rebuild=True, stdout=StringIO())
+        self.assertEqual([m['id'] for m in self.search(q='meeting').json()], [recent.id, old.id])
+        self.assertEqual(self.search(q='notes').json()[0]['content'], 'meeting notes')
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get('/chat/api/search/').status_code, 400)
+
+
+class ConditionalGetTests(TestCase):
+    """
+    ETag / Last-Modified validators on the chat listings.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+
+    def setUp(self):
+        cache.clear()
+        message_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.first = self.send('hello')
+
+    def send(self, content):
+        response = self.client.post('/chat/api/messages/', {
+            'sender': self.alice.id, 'receiver': self.bob.id, 'content': content,
+        }, format='json')
+        return response.json()['id']
+
+    def revalidate(self, url, params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+        return response, len(queries)
+
+    def test_unchanged_listings_answer_304(self):
+        for url, params in [
+            ('/chat/api/conversation/', {'peer_id': self.bob.id}),
+            ('/chat/api/inbox/', {}),
+            ('/chat/api/unread/', {'peer_id': self.bob.id}),
+            ('/chat/api/search/', {'q': 'hello'}),
+        ]:
+            response, queries = self.revalidate(url, params)
+            self.assertEqual(response.status_code, 304, url)
+            # Only the validator query ran
+            self.assertEqual(queries, 1, url)
+            self.assertIn('ETag', response)
+            self.assertEqual(response.content, b'')
+
+    def test_renames_give_a_new_etag(self):
+        listings = [('/chat/api/conversation/', {'peer_id': self.bob.id}), ('/chat/api/inbox/', {})]
+        etags = [self.client.get(url, params)['ETag'] for url, params in listings]
+
+        # Saves that leave the name alone keep the validators
+        self.bob.save(update_fields=['last_login'])
+        for (url, params), etag in zip(listings, etags):
+            self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 304, url)
+
+        self.bob.name = 'robert'
+        self.bob.save()
+        for (url, params), etag in zip(listings, etags):
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200, url)
+        self.assertEqual(response.json()[0]['peer_name'], 'robert')
+
+    def test_changes_give_a_new_etag(self):
+        params = {'peer_id': self.bob.id}
+        etag = self.client.get('/chat/api/conversation/', params)['ETag']
+
+        second = self.send('again')
+        response = self.client.get('/chat/api/conversation/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in response.json()], [self.first, second])
+
+        etag = response['ETag']
+        self.client.patch(f'/chat/api/messages/{second}/update/', {'content': 'edited'}, format='json')
+        response = self.client.get('/chat/api/conversation/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[1]['content'], 'edited')
+
+        # Bob reading changes what alice's inbox shows
+        response = self.client.get('/chat/api/inbox/')
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        self.client.force_authenticate(self.bob)
+        self.client.post('/chat/api/mark-read/', {'peer_id': self.alice.id}, format='json')
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(self.client.get('/chat/api/inbox/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_etag_is_per_user_and_per_query(self):
+        params = {'peer_id': self.bob.id}
+        etag = self.client.get('/chat/api/conversation/', params)['ETag']
+        self.assertEqual(self.client.get('/chat/api/conversation/', {**params, 'limit': 1}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get('/chat/api/conversation/', {'peer_id': self.alice.id}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_long_polls_carry_no_validators(self):
+        # A long poll waits for a change rather than answering 304
+        params = {'peer_id': self.bob.id, 'wait': 1}
+        response = self.client.get('/chat/api/conversation/', params, HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
@@ -1,4 +1,5 @@
 from django.urls import path, include
+from rest_framework.permissions import IsAdminUser
 from rest_framework.routers import DefaultRouter
 from .views import MessageViewSet
 
@@ -12,7 +13,15 @@ urlpatterns = [
     path('api/messages-by-sender/', MessageViewSet.as_view({'get': 'get_messages_by_sender'}), name='messages_by_sender'),
     path('api/messages-by-receiver/', MessageViewSet.as_view({'get': 'get_messages_by_receiver'}), name='messages_by_receiver'),
     path('api/conversation-messages/', MessageViewSet.as_view({'get': 'get_conversation_messages'}), name='conversation_messages'),
+    path('api/conversation/', MessageViewSet.as_view({'get': 'get_conversation'}), name='conversation'),
     path('api/specific-chat/', MessageViewSet.as_view({'get': 'get_specific_chat'}), name='specific_chat'),
+    path('api/search/', MessageViewSet.as_view({'get': 'search'}), name='search_messages'),
+    path('api/inbox/', MessageViewSet.as_view({'get': 'inbox'}), name='inbox'),
+    path('api/mark-read/', MessageViewSet.as_view({'post': 'mark_read'}), name='mark_read'),
+    path('api/unread/', MessageViewSet.as_view({'get': 'unread'}), name='unread'),
+    path('api/bulk-send/', MessageViewSet.as_view({'post': 'bulk_send'}), name='bulk_send'),
+    path('api/push-ticket/', MessageViewSet.as_view({'post': 'push_ticket'}), name='push_ticket'),
+    path('api/cache-stats/', MessageViewSet.as_view({'get': 'cache_stats'}, permission_classes=[IsAdminUser]), name='cache_stats'),
     path('api/messages/<int:pk>/delete/', MessageViewSet.as_view({'delete': 'delete_message'}), name='delete_message'),
     path('api/messages/<int:pk>/update/', MessageViewSet.as_view({'put': 'update_message', 'patch': 'update_message'}), name='update_message'),
 ]
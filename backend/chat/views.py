@@ -1,32 +1,106 @@
+import heapq
+
 from rest_framework import viewsets, status
-from .models import Message
-from .serializers import MessageSerializer
-from rest_framework.permissions import IsAuthenticated
-from cryptography.fernet import Fernet
 from django.conf import settings
+from django.http import Http404
+from .models import Message, Conversation
+from .serializers import MessageSerializer
+from .pagination import paginate_messages, get_page_size, decode_cursor, encode_position, position
+from .cache import message_cache
+from .crypto import get_cipher, decrypt_messages, encrypt_batch
+from .signals import messages_bulk_created
+from .conversations import mark_read as mark_conversation_read, count_unread, pair_state, user_state
+from .archive import conversation_archive, user_archive, find_archived
+from .sharding import (
+    is_sharded, message_database, messages_between, message_querysets, with_users,
+    get_message, get_messages, bulk_create_messages, messages_atomic,
+)
+from .storage import export_token, seal, set_payload, stored_ciphertext
+from .search import search as search_messages, matches as search_matches
+from .parsers import SharedJSONParser
+from .push import issue_ticket, DEFAULT_TICKET_SECONDS
+from .notifier import notifier, get_wait_seconds, conversation_key, sender_key, receiver_key
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.settings import api_settings
+from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
+from users.models import User
+from backend.conditional import check_not_modified
+from backend.routers import pin_to_primary
+
+# Most messages accepted by one bulk-send request
+MAX_BULK_SEND = 5000
 
 class MessageViewSet(viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
-
-    def __init__(self, *args, **kwargs):
-        # Initialize the Fernet cipher with the encryption key
-        self.cipher = Fernet(settings.ENCRYPTION_KEY)
-        super().__init__(*args, **kwargs)
+    # The project parsers, with JSON reusing the body the middleware parsed
+    parser_classes = [SharedJSONParser] + [
+        parser for parser in api_settings.DEFAULT_PARSER_CLASSES if parser.media_type != SharedJSONParser.media_type
+    ]
+
+    @property
+    def cipher(self):
+        # Shared cipher service instead of building a Fernet per request
+        return get_cipher()
+
+    def get_object(self):
+        # The router's detail routes: find the message on whichever shard holds it
+        if not is_sharded():
+            return super().get_object()
+        try:
+            message = get_message(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+        except (Message.DoesNotExist, ValueError):
+            raise Http404
+        self.check_object_permissions(self.request, message)
+        return message
+
+    def list(self, request, *args, **kwargs):
+        if not is_sharded():
+            return super().list(request, *args, **kwargs)
+        # Every shard's messages, merged in (timestamp, id) order
+        messages = heapq.merge(
+            *(queryset.order_by('timestamp', 'id') for queryset in message_querysets()), key=position
+        )
+        return Response(self.get_serializer(list(messages), many=True).data)
 
     def perform_create(self, serializer):
         sender = self.request.user
         receiver = serializer.validated_data['receiver']
-        message_content = serializer.validated_data['content']
-
-        # Encrypt the message content before saving
-        encrypted_content = self.cipher.encrypt(message_content.encode()).decode()
 
-        # Save the encrypted message to the database
-        serializer.save(sender=sender, receiver=receiver, content=message_content)
+        # Save the message (encrypted by MessageSerializer.create) and its Conversation summary together
+        with transaction.atomic(using=message_database(sender.id, receiver.id)), transaction.atomic(savepoint=False):
+            serializer.save(sender=sender, receiver=receiver)
+
+    def check_not_modified(self, request, state):
+        """
+        (304 response or None, validator headers) for a listing summed up by
+        `state`, a (state, last modified) pair from chat.conversations.
+        Long polls are never answered 304, they wait for a change instead.
+        """
+        if request.query_params.get('wait'):
+            return None, {}
+        return check_not_modified(request, *state)
+
+    def get_page(self, request, queryset, keys, archive=()):
+        """
+        Fetch one page of `queryset`, paging into the `archive` sources past
+        the hot table. With `wait=N` and no new messages, hold the request up
+        to N seconds until a message for `keys` is saved.
+        """
+        wait = get_wait_seconds(request)
+        if not wait:
+            return paginate_messages(request, queryset, archive)
+
+        def refetch():
+            # The wake-up follows a commit on the primary that replicas may not have yet
+            pin_to_primary()
+            return paginate_messages(request, queryset, archive)
+
+        return notifier.wait_for_page(keys, wait, lambda: paginate_messages(request, queryset, archive), refetch)
 
     @action(detail=False, methods=['get'], url_path='messages')
     def get_messages_by_sender_receiver(self, request):
@@ -42,22 +116,36 @@ class MessageViewSet(viewsets.ModelViewSet):
         except ValueError:
             return Response({'detail': 'Invalid sender_id or receiver_id format'}, status=400)
 
-        # Retrieve messages for the given sender and receiver IDs
-        messages = Message.objects.filter(sender__id=sender_id, receiver__id=receiver_id)
+        not_modified, validators = self.check_not_modified(request, pair_state(sender_id, receiver_id))
+        if not_modified is not None:
+            return not_modified
+
+        # Retrieve one page of messages for the given sender and receiver IDs
+        messages = with_users(messages_between(sender_id, receiver_id).filter(
+            sender__id=sender_id, receiver__id=receiver_id
+        ))
+        try:
+            messages, headers = self.get_page(
+                request, messages, [conversation_key(sender_id, receiver_id)],
+                conversation_archive(sender_id, receiver_id, sender_id=sender_id),
+            )
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
 
         # Decrypt the message content
         decrypted_messages = []
-        for message in messages:
-            decrypted_content = self.cipher.decrypt(message.content.encode()).decode()
+        contents = decrypt_messages(self.cipher, messages)
+        for message, decrypted_content in zip(messages, contents):
             decrypted_message = {
-                'sender': message.sender.username,
-                'receiver': message.receiver.username,
+                'id': message.id,
+                'sender': message.sender.name,
+                'receiver': message.receiver.name,
                 'content': decrypted_content,
                 'timestamp': message.timestamp,
             }
             decrypted_messages.append(decrypted_message)
 
-        return Response(decrypted_messages)
+        return Response(decrypted_messages, headers={**headers, **validators})
 
     @action(detail=False, methods=['get'], url_path='conversation-messages')
     def get_conversation_messages(self, request):
@@ -73,20 +161,274 @@ class MessageViewSet(viewsets.ModelViewSet):
         except ValueError:
             return Response({'detail': 'Invalid sender_id or receiver_id format'}, status=400)
 
-        # Retrieve messages for the given sender and receiver IDs
-        messages = Message.objects.filter(sender__id=sender_id, receiver__id=receiver_id)
+        # No conditional GET here: key rotation and compaction rewrite the
+        # tokens without touching the conversation's version
+        # Retrieve one page of messages for the given sender and receiver IDs
+        messages = with_users(messages_between(sender_id, receiver_id).filter(
+            sender__id=sender_id, receiver__id=receiver_id
+        ))
+        try:
+            messages, headers = self.get_page(
+                request, messages, [conversation_key(sender_id, receiver_id)],
+                conversation_archive(sender_id, receiver_id, sender_id=sender_id),
+            )
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
 
         # Directly return the message content without decryption
         message_data = []
         for message in messages:
+            # The Fernet token, whichever format it is stored in; `compressed`
+            # tells clients to zlib-decompress after decrypting
+            token, compressed = export_token(stored_ciphertext(message))
             message_data.append({
+                'id': message.id,
                 'sender': message.sender.name,
                 'receiver': message.receiver.name,
-                'content': message.content,  # No decryption, just raw content
+                'content': token,  # No decryption, just raw content
+                'compressed': compressed,
                 'timestamp': message.timestamp,
             })
 
-        return Response(message_data)
+        return Response(message_data, headers=headers)
+
+    @action(detail=False, methods=['get'], url_path='conversation')
+    def get_conversation(self, request):
+        """
+        Both directions of the chat between the authenticated user and a peer,
+        merged and ordered by timestamp in a single query.
+        """
+        peer_id = request.query_params.get('peer_id')
+        if not peer_id:
+            return Response({'detail': 'peer_id parameter is required'}, status=400)
+
+        try:
+            peer_id = int(peer_id)  # Ensure the peer_id is valid (integer)
+        except ValueError:
+            return Response({'detail': 'Invalid peer_id format'}, status=400)
+
+        user_id = request.user.id
+
+        not_modified, validators = self.check_not_modified(request, pair_state(user_id, peer_id))
+        if not_modified is not None:
+            return not_modified
+
+        # Each side of the OR is served by the (sender, receiver, timestamp) index
+        messages = with_users(messages_between(user_id, peer_id).filter(
+            Q(sender__id=user_id, receiver__id=peer_id) | Q(sender__id=peer_id, receiver__id=user_id)
+        ))
+        try:
+            messages, headers = self.get_page(
+                request, messages, [conversation_key(user_id, peer_id)], conversation_archive(user_id, peer_id)
+            )
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
+
+        # Decrypt the message content
+        decrypted_messages = []
+        contents = decrypt_messages(self.cipher, messages)
+        for message, decrypted_content in zip(messages, contents):
+            decrypted_message = {
+                'id': message.id,
+                'sender_id': message.sender_id,
+                'receiver_id': message.receiver_id,
+                'sender': message.sender.name,
+                'receiver': message.receiver.name,
+                'content': decrypted_content,
+                'timestamp': message.timestamp,
+            }
+            decrypted_messages.append(decrypted_message)
+
+        return Response(decrypted_messages, headers={**headers, **validators})
+
+    @action(detail=False, methods=['get'], url_path='inbox')
+    def inbox(self, request):
+        """
+        The authenticated user's conversations, most recent first, read from
+        the Conversation summary table instead of the message history.
+        Paged on (last_message_at, id): `before=<X-Cursor-Before>` fetches
+        the next, older page.
+        """
+        try:
+            limit = get_page_size(request)
+        except ValueError:
+            return Response({'detail': 'Invalid limit format'}, status=400)
+        before = request.query_params.get('before')
+        try:
+            before = decode_cursor(before) if before else None
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
+
+        user_id = request.user.id
+        not_modified, validators = self.check_not_modified(request, user_state(user_id))
+        if not_modified is not None:
+            return not_modified
+
+        # Chats whose every message was deleted are kept for their watermarks, not listed
+        conversations = Conversation.objects.filter(
+            Q(user_low_id=user_id) | Q(user_high_id=user_id), last_message_at__isnull=False
+        )
+        if before:
+            timestamp, conversation_id = before
+            conversations = conversations.filter(
+                Q(last_message_at__lt=timestamp) | Q(last_message_at=timestamp, id__lt=conversation_id)
+            )
+        if is_sharded():
+            conversations = conversations.select_related('user_low', 'user_high')
+        else:
+            conversations = conversations.select_related('user_low', 'user_high', 'last_message')
+        conversations = list(conversations.order_by('-last_message_at', '-id')[:limit + 1])
+        headers = {'X-Has-More': 'true' if len(conversations) > limit else 'false'}
+        conversations = conversations[:limit]
+        if conversations:
+            headers['X-Cursor-Before'] = encode_position(conversations[-1].last_message_at, conversations[-1].id)
+
+        if is_sharded():
+            # The previews live on the shards: one id lookup per shard
+            last_messages = list(get_messages(
+                c.last_message_id for c in conversations if c.last_message_id is not None
+            ).values())
+        else:
+            last_messages = [c.last_message for c in conversations if c.last_message is not None]
+
+        # Conversations that have been idle long enough have their last message archived
+        found = {message.id for message in last_messages}
+        for c in conversations:
+            if c.last_message_id is not None and c.last_message_id not in found:
+                archived = find_archived(c.user_low_id, c.user_high_id, c.last_message_id)
+                if archived is not None:
+                    last_messages.append(archived)
+
+        # Decrypt all previews as one batch
+        previews = dict(zip(
+            [message.id for message in last_messages],
+            decrypt_messages(self.cipher, last_messages),
+        ))
+
+        inbox = []
+        for conversation in conversations:
+            peer = conversation.user_high if user_id == conversation.user_low_id else conversation.user_low
+            inbox.append({
+                'conversation_id': conversation.id,
+                'peer_id': peer.id,
+                'peer_name': peer.name,
+                'last_message_id': conversation.last_message_id,
+                'last_message': previews.get(conversation.last_message_id),
+                'last_message_at': conversation.last_message_at,
+                'message_count': conversation.message_count,
+                'unread': conversation.unread_for(user_id),
+                'last_read_id': conversation.last_read_for(user_id),
+                # Read receipt: the newest message the peer has seen
+                'peer_last_read_id': conversation.last_read_for(peer.id),
+            })
+
+        return Response(inbox, headers={**headers, **validators})
+
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        """
+        The authenticated user's messages containing every word of `q`, newest
+        first, optionally only the chat with `peer_id`. Resolved to ids through
+        the blind index (see chat/search.py); only the page is decrypted.
+        Page back with `before=<X-Cursor-Before>`.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'detail': 'q parameter is required'}, status=400)
+        try:
+            limit = get_page_size(request)
+            peer_id = request.query_params.get('peer_id')
+            peer_id = int(peer_id) if peer_id else None
+            before = request.query_params.get('before')
+            before = int(before) if before else None
+        except ValueError:
+            return Response({'detail': 'Invalid peer_id, before or limit format'}, status=400)
+
+        user_id = request.user.id
+        not_modified, validators = self.check_not_modified(request, user_state(user_id))
+        if not_modified is not None:
+            return not_modified
+
+        hits, has_more = search_messages(user_id, query, peer_id=peer_id, before=before, limit=limit)
+
+        found = get_messages(message_id for message_id, _ in hits)
+        messages = []
+        for message_id, hit_peer_id in hits:
+            # Ids missing from the hot table have been archived
+            message = found.get(message_id) or find_archived(user_id, hit_peer_id, message_id)
+            if message is not None:
+                messages.append(message)
+        prefetch_related_objects(messages, 'sender', 'receiver')
+
+        results = []
+        for message, content in zip(messages, decrypt_messages(self.cipher, messages)):
+            if not search_matches(query, content):
+                continue
+            results.append({
+                'id': message.id,
+                'sender_id': message.sender_id,
+                'receiver_id': message.receiver_id,
+                'sender': message.sender.name,
+                'receiver': message.receiver.name,
+                'content': content,
+                'timestamp': message.timestamp,
+            })
+
+        headers = {'X-Has-More': 'true' if has_more else 'false'}
+        if hits:
+            headers['X-Cursor-Before'] = str(hits[-1][0])
+        return Response(results, headers={**headers, **validators})
+
+    @action(detail=False, methods=['post'], url_path='mark-read')
+    def mark_read(self, request):
+        """
+        Mark the chat with `peer_id` as read up to `message_id` (default: all).
+        Stores a single watermark per user per conversation instead of a flag
+        per message, so the write cost does not depend on how many were read.
+        """
+        try:
+            peer_id = int(request.data.get('peer_id'))
+            message_id = request.data.get('message_id')
+            message_id = int(message_id) if message_id is not None else None
+        except (TypeError, ValueError):
+            return Response({'detail': 'Invalid peer_id or message_id format'}, status=400)
+
+        conversation = mark_conversation_read(request.user.id, peer_id, message_id)
+        if conversation is None:
+            return Response({'detail': 'Conversation not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            'peer_id': peer_id,
+            'last_read_id': conversation.last_read_for(request.user.id),
+            'unread': conversation.unread_for(request.user.id),
+        })
+
+    @action(detail=False, methods=['get'], url_path='unread')
+    def unread(self, request):
+        """
+        Unread messages from `peer_id`, counted live above the read watermark.
+        """
+        peer_id = request.query_params.get('peer_id')
+        try:
+            peer_id = int(peer_id)
+        except (TypeError, ValueError):
+            return Response({'detail': 'Invalid peer_id format'}, status=400)
+
+        user_id = request.user.id
+        not_modified, validators = self.check_not_modified(request, pair_state(user_id, peer_id))
+        if not_modified is not None:
+            return not_modified
+
+        conversation = Conversation.objects.filter(
+            user_low_id=min(user_id, peer_id), user_high_id=max(user_id, peer_id)
+        ).first()
+        last_read_id = conversation.last_read_for(user_id) if conversation else 0
+        return Response({
+            'peer_id': peer_id,
+            'last_read_id': last_read_id,
+            'peer_last_read_id': conversation.last_read_for(peer_id) if conversation else 0,
+            'unread': count_unread(user_id, peer_id, last_read_id),
+        }, headers=validators)
 
     @action(detail=False, methods=['get'], url_path='messages-by-sender')
     def get_messages_by_sender(self, request):
@@ -99,14 +441,25 @@ class MessageViewSet(viewsets.ModelViewSet):
         except ValueError:
             return Response({'detail': 'Invalid sender_id format'}, status=400)
 
-        # Retrieve messages for the given sender ID
-        messages = Message.objects.filter(sender__id=sender_id)
+        not_modified, validators = self.check_not_modified(request, user_state(sender_id))
+        if not_modified is not None:
+            return not_modified
+
+        # Retrieve one page of messages for the given sender ID, merged across shards
+        messages = [with_users(queryset.filter(sender__id=sender_id)) for queryset in message_querysets()]
+        try:
+            messages, headers = self.get_page(
+                request, messages, [sender_key(sender_id)], user_archive(sender_id, 'sender_id')
+            )
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
 
         # Decrypt the message content
         decrypted_messages = []
-        for message in messages:
-            decrypted_content = self.cipher.decrypt(message.content.encode()).decode()
+        contents = decrypt_messages(self.cipher, messages)
+        for message, decrypted_content in zip(messages, contents):
             decrypted_message = {
+                'id': message.id,
                 'sender': message.sender.name,
                 'receiver': message.receiver.name,
                 'content': decrypted_content,
@@ -114,7 +467,7 @@ class MessageViewSet(viewsets.ModelViewSet):
             }
             decrypted_messages.append(decrypted_message)
 
-        return Response(decrypted_messages)
+        return Response(decrypted_messages, headers={**headers, **validators})
 
     @action(detail=False, methods=['get'], url_path='messages-by-receiver')
     def get_messages_by_receiver(self, request):
@@ -127,14 +480,25 @@ class MessageViewSet(viewsets.ModelViewSet):
         except ValueError:
             return Response({'detail': 'Invalid receiver_id format'}, status=400)
 
-        # Retrieve messages for the given receiver ID
-        messages = Message.objects.filter(receiver__id=receiver_id)
+        not_modified, validators = self.check_not_modified(request, user_state(receiver_id))
+        if not_modified is not None:
+            return not_modified
+
+        # Retrieve one page of messages for the given receiver ID, merged across shards
+        messages = [with_users(queryset.filter(receiver__id=receiver_id)) for queryset in message_querysets()]
+        try:
+            messages, headers = self.get_page(
+                request, messages, [receiver_key(receiver_id)], user_archive(receiver_id, 'receiver_id')
+            )
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
 
         # Decrypt the message content
         decrypted_messages = []
-        for message in messages:
-            decrypted_content = self.cipher.decrypt(message.content.encode()).decode()
+        contents = decrypt_messages(self.cipher, messages)
+        for message, decrypted_content in zip(messages, contents):
             decrypted_message = {
+                'id': message.id,
                 'sender': message.sender.name,
                 'receiver': message.receiver.name,
                 'content': decrypted_content,
@@ -142,7 +506,7 @@ class MessageViewSet(viewsets.ModelViewSet):
             }
             decrypted_messages.append(decrypted_message)
 
-        return Response(decrypted_messages)
+        return Response(decrypted_messages, headers={**headers, **validators})
 
     @action(detail=False, methods=['get'], url_path='specific-chat')
     def get_specific_chat(self, request):
@@ -158,29 +522,41 @@ class MessageViewSet(viewsets.ModelViewSet):
         except ValueError:
             return Response({'detail': 'Invalid sender_id or receiver_id format'}, status=400)
 
-        # Retrieve messages for the given sender and receiver IDs
-        messages = Message.objects.filter(
+        not_modified, validators = self.check_not_modified(request, pair_state(sender_id, receiver_id))
+        if not_modified is not None:
+            return not_modified
+
+        # Retrieve one page of messages for the given sender and receiver IDs
+        messages = with_users(messages_between(sender_id, receiver_id).filter(
             sender__id=sender_id, receiver__id=receiver_id
-        ).order_by('timestamp')
+        ))
+        try:
+            messages, headers = self.get_page(
+                request, messages, [conversation_key(sender_id, receiver_id)],
+                conversation_archive(sender_id, receiver_id, sender_id=sender_id),
+            )
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
 
         # Decrypt the message content
         decrypted_messages = []
-        for message in messages:
-            decrypted_content = self.cipher.decrypt(message.content.encode()).decode()
+        contents = decrypt_messages(self.cipher, messages)
+        for message, decrypted_content in zip(messages, contents):
             decrypted_message = {
-                'sender': message.sender.username,
-                'receiver': message.receiver.username,
+                'id': message.id,
+                'sender': message.sender.name,
+                'receiver': message.receiver.name,
                 'content': decrypted_content,
                 'timestamp': message.timestamp,
             }
             decrypted_messages.append(decrypted_message)
 
-        return Response(decrypted_messages)
+        return Response(decrypted_messages, headers={**headers, **validators})
         
     @action(detail=True, methods=['delete'], url_path='delete-message')
     def delete_message(self, request, pk=None):
         try:
-            message = Message.objects.get(pk=pk)
+            message = get_message(pk)
             
             # Check if the user is authorized to delete this message
             if message.sender != request.user:
@@ -189,7 +565,8 @@ class MessageViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_403_FORBIDDEN
                 )
                 
-            # Delete the message
+            # Delete the message and drop its cached plaintext
+            message_cache.invalidate(message.id)
             message.delete()
             return Response(
                 {'detail': 'Message deleted successfully'}, 
@@ -204,7 +581,7 @@ class MessageViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['put', 'patch'], url_path='update-message')
     def update_message(self, request, pk=None):
         try:
-            message = Message.objects.get(pk=pk)
+            message = get_message(pk)
             
             # Check if the user is authorized to update this message
             if message.sender != request.user:
@@ -221,12 +598,11 @@ class MessageViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
                 
-            # Encrypt the new content
-            encrypted_content = self.cipher.encrypt(new_content.encode()).decode()
-            
-            # Update the message
-            message.content = encrypted_content
-            message.save()
+            # Encrypt the new content and update the message
+            set_payload(message, seal(self.cipher, new_content))
+            with transaction.atomic():
+                message.save()
+            message_cache.invalidate(message.id)
             
             return Response(
                 {'detail': 'Message updated successfully'}, 
@@ -237,3 +613,99 @@ class MessageViewSet(viewsets.ModelViewSet):
                 {'detail': 'Message not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
+
+    @action(detail=False, methods=['get'], url_path='cache-stats', permission_classes=[IsAdminUser])
+    def cache_stats(self, request):
+        """
+        Hit/miss/eviction counters of the decrypted message cache.
+        """
+        return Response(message_cache.stats())
+
+    @action(detail=False, methods=['post'], url_path='push-ticket')
+    def push_ticket(self, request):
+        """
+        A short-lived, single-use ticket for opening the push channel
+        (`/ws/chat/?ticket=...` or `/chat/events/?ticket=...`).
+        """
+        return Response({
+            'ticket': issue_ticket(request.user.id),
+            'expires_in': getattr(settings, 'CHAT_PUSH_TICKET_SECONDS', DEFAULT_TICKET_SECONDS),
+        })
+
+    @action(detail=False, methods=['post'], url_path='bulk-send')
+    def bulk_send(self, request):
+        """
+        Send many messages from the authenticated user in one request.
+
+        Body: {"messages": [{"receiver": <id>, "content": "..."}, ...]}
+        Receivers are checked with one query, the batch is encrypted together
+        and inserted with bulk_create in a single transaction (one on each
+        target shard too, see messages_atomic). The response reports the
+        outcome of every item by its index.
+        """
+        items = request.data.get('messages')
+        if not isinstance(items, list) or not items:
+            return Response({'detail': 'messages must be a non-empty list'}, status=400)
+
+        max_items = getattr(settings, 'CHAT_BULK_SEND_MAX', MAX_BULK_SEND)
+        if len(items) > max_items:
+            return Response({'detail': f'At most {max_items} messages per request'}, status=400)
+
+        # Validate the shape of every item first
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[index] = {'index': index, 'status': 'error', 'detail': 'Item must be an object'}
+                continue
+            content = item.get('content')
+            try:
+                receiver_id = int(item.get('receiver'))
+            except (TypeError, ValueError):
+                results[index] = {'index': index, 'status': 'error', 'detail': 'Invalid receiver format'}
+                continue
+            if not isinstance(content, str) or not content:
+                results[index] = {'index': index, 'status': 'error', 'detail': 'Content is required'}
+                continue
+            valid.append((index, receiver_id, content))
+
+        # One query for all receivers
+        existing = set(
+            User.objects.filter(id__in={receiver_id for _, receiver_id, _ in valid}).values_list('id', flat=True)
+        )
+        to_send = []
+        for index, receiver_id, content in valid:
+            if receiver_id in existing:
+                to_send.append((index, receiver_id, content))
+            else:
+                results[index] = {'index': index, 'status': 'error', 'detail': 'Receiver not found'}
+
+        if to_send:
+            payloads = encrypt_batch(self.cipher, [content for _, _, content in to_send])
+            messages = [
+                Message(sender=request.user, receiver_id=receiver_id, payload=payload)
+                for (_, receiver_id, _), payload in zip(to_send, payloads)
+            ]
+            with messages_atomic(messages):
+                messages = bulk_create_messages(messages, batch_size=500)
+                for (index, _, content), message in zip(to_send, messages):
+                    results[index] = {'index': index, 'status': 'created', 'id': message.id}
+
+                def fill_cache():
+                    # The plaintext is known, so readers never need to decrypt these
+                    for (_, _, content), message in zip(to_send, messages):
+                        message_cache.put(message.id, message.payload, content)
+
+                transaction.on_commit(fill_cache)
+                # bulk_create skips post_save; keep notifier/push consumers in sync
+                messages_bulk_created.send(sender=Message, messages=messages)
+
+        created = len(to_send)
+        failed = len(items) - created
+        if not created:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif failed:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response({'created': created, 'failed': failed, 'results': results}, status=response_status)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class FreedomWallConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "freedom_wall"
+
+    def ready(self):
+        # Connect the Post signal handlers
+        from . import signals  # noqa: F401
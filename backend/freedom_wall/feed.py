@@ -0,0 +1,125 @@
+"""
+The wall feed: posts newest first, paged with a (created_at, id) cursor.
+
+The first WALL_FEED_CACHED_PAGES pages are cached in the default cache under
+a feed generation number. Creating, editing or deleting a post bumps the
+generation (see signals.py), as does renaming a user, whose name the posts
+show; this retires every cached page at once and old entries simply expire.
+The feed looks the same to every visitor, so one cached page serves all of
+them.
+
+The generation is only seen by processes sharing the cache: with the
+per-process default (no CACHE_REDIS_URL, see settings.py) a write made
+through one process leaves the others serving their cached pages for up to
+WALL_FEED_CACHE_TTL seconds.
+"""
+import base64
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .models import Post
+
+# Posts per page unless the client sends `limit`
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Pages from the top of the feed that are cached
+CACHED_PAGES = 3
+# Upper bound on how long a cached page lives, e.g. if it was built from a lagging replica
+CACHE_TTL = 60
+
+GENERATION_KEY = 'wall-feed-generation'
+
+
+def encode_cursor(post, depth):
+    """
+    Opaque cursor below `post`; `depth` is the number of the page it leads to.
+    """
+    raw = f"{post.created_at.isoformat()}|{post.id}|{depth}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    (created_at, id, depth) of a cursor. Raises ValueError if it is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, post_id, depth = raw.split('|')
+        return datetime.fromisoformat(created_at), int(post_id), int(depth)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def get_page_size(limit):
+    max_size = getattr(settings, 'WALL_FEED_MAX_PAGE_SIZE', MAX_PAGE_SIZE)
+    if not limit:
+        return min(getattr(settings, 'WALL_FEED_PAGE_SIZE', DEFAULT_PAGE_SIZE), max_size)
+    limit = int(limit)  # Raises ValueError for bad input
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, max_size)
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock so a lost counter never brings back old pages
+        cache.add(GENERATION_KEY, time.time_ns(), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, time.time_ns(), None)
+
+
+def page_key(generation, cursor, limit):
+    return f'wall-feed:{generation}:{limit}:{cursor or "top"}'
+
+
+def load_page(before, limit, depth, serialize):
+    """
+    One page of posts below `before` ((created_at, id) or None), serialized.
+    Returns (data, headers).
+    """
+    posts = Post.objects.select_related('user').order_by('-created_at', '-id')
+    if before is not None:
+        created_at, post_id = before
+        posts = posts.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=post_id))
+    posts = list(posts[:limit + 1])
+    has_more = len(posts) > limit
+    posts = posts[:limit]
+
+    headers = {'X-Has-More': 'true' if has_more else 'false'}
+    if has_more:
+        headers['X-Cursor-Before'] = encode_cursor(posts[-1], depth + 1)
+    return list(serialize(posts)), headers
+
+
+def get_feed_page(cursor, limit, serialize):
+    """
+    The feed page at `cursor` (None for the top), from the cache when it is
+    one of the first pages. `serialize` turns a list of posts into data.
+    Raises ValueError for a bad cursor.
+    """
+    before, depth = None, 0
+    if cursor:
+        created_at, post_id, depth = decode_cursor(cursor)
+        before = (created_at, post_id)
+
+    if depth >= getattr(settings, 'WALL_FEED_CACHED_PAGES', CACHED_PAGES):
+        return load_page(before, limit, depth, serialize)
+
+    key = page_key(get_generation(), cursor, limit)
+    page = cache.get(key)
+    if page is None:
+        page = load_page(before, limit, depth, serialize)
+        cache.set(key, page, getattr(settings, 'WALL_FEED_CACHE_TTL', CACHE_TTL))
+    return page
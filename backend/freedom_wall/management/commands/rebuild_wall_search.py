@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+
+from freedom_wall.models import Post
+from freedom_wall.search import create_index, rebuild_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the wall's full-text search index from the posts table: the "
+        "FTS5 table on SQLite, the GIN index on PostgreSQL. Recreates missing "
+        "SQLite triggers first. Run it after restoring or bulk-loading posts "
+        "behind the ORM's back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=None,
+                            help='Database alias to rebuild. Default: where posts are written.')
+
+    def handle(self, *args, **options):
+        database = options['database'] or router.db_for_write(Post)
+        connection = connections[database]
+        # Idempotent; restores triggers a table rebuild may have dropped
+        create_index(connection)
+        if rebuild_index(connection):
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt the wall search index on {database}"))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f"{database} has no full-text index ({connection.vendor}); search falls back to icontains"
+            ))
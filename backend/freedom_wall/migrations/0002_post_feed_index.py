@@ -0,0 +1,17 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('freedom_wall', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-created_at', '-id'], name='wall_post_feed_idx'),
+        ),
+    ]
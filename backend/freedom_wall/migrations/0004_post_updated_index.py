@@ -0,0 +1,17 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('freedom_wall', '0003_post_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['updated_at'], name='wall_post_updated_idx'),
+        ),
+    ]
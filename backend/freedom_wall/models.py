@@ -19,6 +19,12 @@ class Post(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Backs the (created_at, id) cursor of the wall feed
+            models.Index(fields=['-created_at', '-id'], name='wall_post_feed_idx'),
+            # Max(updated_at) for the list's ETag state
+            models.Index(fields=['updated_at'], name='wall_post_updated_idx'),
+        ]
     
     def __str__(self):
         return self.title
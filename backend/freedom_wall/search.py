@@ -0,0 +1,206 @@
+"""
+Full-text search over wall posts.
+
+SQLite: an external-content FTS5 table, freedom_wall_post_fts, over
+title and content, kept in sync with the posts table by triggers, so
+bulk_create and raw SQL writes are indexed too. Ranked with bm25, with the
+title weighted above the content.
+
+PostgreSQL: a stored generated `search_vector` tsvector column (title
+weight A, content weight B) with a GIN index, ranked with ts_rank_cd.
+
+Both are created by migration 0003 and are invisible to the ORM. Other
+databases, or SQLite builds without FTS5, fall back to an icontains scan.
+On SQLite, a migration that rebuilds freedom_wall_post (most AlterFields)
+drops the triggers: follow it with a RunPython re-creating them, with the
+statements copied into the migration as 0003 does.
+"""
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+
+from .models import Post
+
+FTS_TABLE = 'freedom_wall_post_fts'
+# Relative weight of a title match over a content match (bm25 column weights)
+TITLE_WEIGHT = 10.0
+# Terms used from a query
+MAX_QUERY_TERMS = 16
+
+TERM_RE = re.compile(r'\w+')
+# Attribute of a connection wrapper remembering its search backend
+BACKEND_CACHE_KEY = 'wall_search_backend'
+
+SQLITE_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, content, content='freedom_wall_post', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON freedom_wall_post BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON freedom_wall_post BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    # Only when the indexed columns change, not on every updated_at bump
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, content ON freedom_wall_post BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+]
+
+SQLITE_DROP = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+POSTGRES_SCHEMA = [
+    """ALTER TABLE freedom_wall_post ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(content, '')), 'B')
+        ) STORED""",
+    "CREATE INDEX IF NOT EXISTS wall_post_search_idx ON freedom_wall_post USING GIN (search_vector)",
+]
+
+POSTGRES_DROP = [
+    "DROP INDEX IF EXISTS wall_post_search_idx",
+    "ALTER TABLE freedom_wall_post DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def fts_available(connection):
+    """
+    Whether this SQLite build has FTS5.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if cursor.fetchone()[0]:
+            return True
+        # Builds can also load it as an extension; the pragma tells
+        cursor.execute("SELECT 1 FROM pragma_module_list WHERE name = 'fts5'")
+        return cursor.fetchone() is not None
+
+
+def create_index(connection):
+    """
+    Create the search table or column on `connection`, and fill it.
+    """
+    connection.__dict__.pop(BACKEND_CACHE_KEY, None)
+    if connection.vendor == 'sqlite' and fts_available(connection):
+        with connection.cursor() as cursor:
+            for statement in SQLITE_SCHEMA:
+                cursor.execute(statement)
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            for statement in POSTGRES_SCHEMA:
+                cursor.execute(statement)
+
+
+def drop_index(connection):
+    connection.__dict__.pop(BACKEND_CACHE_KEY, None)
+    statements = {'sqlite': SQLITE_DROP, 'postgresql': POSTGRES_DROP}.get(connection.vendor, [])
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def rebuild_index(connection):
+    """
+    Rebuild the index from the posts table, e.g. after a restore that skipped
+    the triggers. Returns False if `connection` has no search index.
+    """
+    backend = search_backend(connection)
+    with connection.cursor() as cursor:
+        if backend == 'fts5':
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        elif backend == 'tsvector':
+            # The column is generated, only the index can drift (bloat)
+            cursor.execute("REINDEX INDEX wall_post_search_idx")
+            cursor.execute("ANALYZE freedom_wall_post")
+        else:
+            return False
+    return True
+
+
+def search_backend(connection):
+    """
+    'fts5', 'tsvector' or None (icontains fallback) for `connection`.
+    """
+    if BACKEND_CACHE_KEY not in connection.__dict__:
+        backend = None
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+                backend = 'fts5' if cursor.fetchone() else None
+        elif connection.vendor == 'postgresql':
+            backend = 'tsvector'
+        # Cached per connection wrapper; the schema only changes with migrations
+        connection.__dict__[BACKEND_CACHE_KEY] = backend
+    return connection.__dict__[BACKEND_CACHE_KEY]
+
+
+def query_terms(query):
+    return TERM_RE.findall(query)[:MAX_QUERY_TERMS]
+
+
+def fts5_query(terms):
+    # Each term quoted so user input is never parsed as FTS syntax; the last
+    # one is a prefix so results follow the user as they type
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def search_post_ids(query, limit, offset=0, using=None):
+    """
+    ([post id, ...], has more) for posts matching every term of `query`, best
+    match first.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return [], False
+
+    database = using or router.db_for_read(Post)
+    connection = connections[database]
+    backend = search_backend(connection)
+    if backend == 'fts5':
+        sql = (
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+            f"ORDER BY bm25({FTS_TABLE}, %s, 1.0), rowid DESC LIMIT %s OFFSET %s"
+        )
+        params = [fts5_query(terms), TITLE_WEIGHT, limit + 1, offset]
+    elif backend == 'tsvector':
+        sql = (
+            "SELECT id FROM freedom_wall_post, websearch_to_tsquery('english', %s) query "
+            "WHERE search_vector @@ query ORDER BY ts_rank_cd(search_vector, query) DESC, id DESC "
+            "LIMIT %s OFFSET %s"
+        )
+        params = [' '.join(terms), limit + 1, offset]
+    else:
+        posts = Post.objects.using(database)
+        for term in terms:
+            posts = posts.filter(Q(title__icontains=term) | Q(content__icontains=term))
+        ids = list(posts.order_by('-created_at', '-id').values_list('id', flat=True)[offset:offset + limit + 1])
+        return ids[:limit], len(ids) > limit
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        ids = [row[0] for row in cursor.fetchall()]
+    return ids[:limit], len(ids) > limit
+
+
+def search_posts(query, limit, offset=0):
+    """
+    (posts, has more): the matching page of posts with their users, in rank order.
+    """
+    # Both queries on the same database, whichever replica that is
+    database = router.db_for_read(Post)
+    ids, has_more = search_post_ids(query, limit, offset, using=database)
+    found = Post.objects.using(database).select_related('user').in_bulk(ids)
+    return [found[post_id] for post_id in ids if post_id in found], has_more
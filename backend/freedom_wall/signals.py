@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .feed import bump_generation
+from .models import Post
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidate_feed(sender, using, **kwargs):
+    # After commit, so no reader can cache the old feed under the new generation
+    transaction.on_commit(bump_generation, using=using)
+
+
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def remember_name(sender, instance, raw, using, update_fields=None, **kwargs):
+    # Cached pages show author names; look the old one up only when the save
+    # can change it
+    if raw or instance._state.adding or (update_fields is not None and 'name' not in update_fields):
+        return
+    instance._feed_old_name = (
+        sender._default_manager.using(using).filter(pk=instance.pk).values_list('name', flat=True).first()
+    )
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_feed_on_rename(sender, instance, created, raw, using, **kwargs):
+    old_name = instance.__dict__.pop('_feed_old_name', None)
+    if old_name is not None and old_name != instance.name:
+        transaction.on_commit(bump_generation, using=using)
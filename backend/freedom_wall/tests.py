@@ -1,3 +1,197 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from users.models import User
+
+from .models import Post
+from .search import FTS_TABLE, search_backend
+
+
+class FeedTests(TestCase):
+    """
+    The cursor-paginated, cached wall feed.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(name='alice', email='alice@example.com', password=None)
+        cls.posts = [
+            Post.objects.create(title=f'Post {n}', content='x', user=cls.user, author='')
+            for n in range(7)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def feed(self, **params):
+        response = self.client.get('/freedom-wall/api/posts/feed/', params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_pages_follow_the_cursor(self):
+        titles = []
+        params = {'limit': 3}
+        while True:
+            response = self.feed(**params)
+            titles += [post['title'] for post in response.json()]
+            if response['X-Has-More'] != 'true':
+                break
+            params['cursor'] = response['X-Cursor-Before']
+        self.assertEqual(titles, [f'Post {n}' for n in range(6, -1, -1)])
+        # The author's name comes from the joined user row
+        self.assertEqual(response.json()[0]['author_name'], 'alice')
+
+    def test_first_pages_come_from_cache(self):
+        self.feed(limit=3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.feed(limit=3).json()[0]['title'], 'Post 6')
+        self.assertEqual(len(queries), 0)
+
+    def test_writes_invalidate_the_cache(self):
+        self.feed(limit=3)
+        self.client.force_authenticate(self.user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/freedom-wall/api/posts/', {'title': 'Fresh', 'content': 'x'}, format='json')
+        self.assertEqual(self.feed(limit=3).json()[0]['title'], 'Fresh')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/freedom-wall/api/posts/{self.posts[6].id}/update/', {'title': 'Edited'}, format='json')
+        self.assertEqual([post['title'] for post in self.feed(limit=3).json()][1], 'Edited')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/freedom-wall/api/posts/{self.posts[6].id}/delete/')
+        self.assertNotIn('Edited', [post['title'] for post in self.feed(limit=3).json()])
+
+    def test_renames_invalidate_the_cache(self):
+        self.feed(limit=3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save(update_fields=['last_login'])
+        with CaptureQueriesContext(connection) as queries:
+            self.feed(limit=3)
+        self.assertEqual(len(queries), 0)
+
+        self.user.name = 'alicia'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.feed(limit=3).json()[0]['author_name'], 'alicia')
+
+    def test_bad_cursor(self):
+        response = self.client.get('/freedom-wall/api/posts/feed/', {'cursor': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchTests(TestCase):
+    """
+    Full-text search over the wall (FTS5 on the SQLite test database).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Post.objects.bulk_create([
+            Post(title='Lost umbrella', content='Left it in the library on Monday', author='Anonymous'),
+            Post(title='Library hours', content='Is the library open late during exams?', author='Anonymous'),
+            Post(title='Crêpes', content='Best crepes near campus', author='Anonymous'),
+            Post(title='Exams', content='Good luck everyone', author='Anonymous'),
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def search(self, **params):
+        response = self.client.get('/freedom-wall/api/posts/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def titles(self, **params):
+        return [post['title'] for post in self.search(**params).json()]
+
+    def test_ranked_matches(self):
+        self.assertEqual(search_backend(connection), 'fts5')
+        # Title matches rank above content matches
+        self.assertEqual(self.titles(q='library'), ['Library hours', 'Lost umbrella'])
+        self.assertEqual(self.titles(q='library monday'), ['Lost umbrella'])
+        # Case, accents and the last word as a prefix
+        self.assertEqual(self.titles(q='CREPES'), ['Crêpes'])
+        self.assertEqual(self.titles(q='umbr'), ['Lost umbrella'])
+        # FTS syntax in the query is just text
+        self.assertEqual(self.titles(q='"library" OR NOT *'), [])
+
+    def test_pages(self):
+        response = self.search(q='library', limit=1)
+        self.assertEqual(response['X-Has-More'], 'true')
+        self.assertEqual(self.titles(q='library', limit=1, page=2), ['Lost umbrella'])
+        self.assertEqual(self.search(q='library', limit=1, page=2)['X-Has-More'], 'false')
+
+    def test_index_follows_writes(self):
+        post = Post.objects.create(title='Bicycle found', content='Near the gym', author='Anonymous')
+        self.assertEqual(self.titles(q='bicycle'), ['Bicycle found'])
+        post.content = 'Near the pool'
+        post.save()
+        self.assertEqual(self.titles(q='gym'), [])
+        self.assertEqual(self.titles(q='pool'), ['Bicycle found'])
+        post.delete()
+        self.assertEqual(self.titles(q='bicycle'), [])
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')")
+        self.assertEqual(self.titles(q='library'), [])
+        call_command('rebuild_wall_search', stdout=StringIO())
+        self.assertEqual(self.titles(q='library'), ['Library hours', 'Lost umbrella'])
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get('/freedom-wall/api/posts/search/').status_code, 400)
+
+
+class ConditionalGetTests(TestCase):
+    """
+    ETag / Last-Modified validators on the post list and detail.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(name='alice', email='alice@example.com', password=None)
+        cls.post = Post.objects.create(title='Hello', content='x', user=cls.user, author='')
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_list_and_detail_answer_304_until_changed(self):
+        for url in ['/freedom-wall/api/posts/', f'/freedom-wall/api/posts/{self.post.id}/']:
+            response = self.client.get(url)
+            self.assertEqual(response['Cache-Control'], 'no-cache')
+            etag = response['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            if url.endswith('/posts/'):
+                # Deletes move no timestamp the list could send
+                self.assertNotIn('Last-Modified', response)
+            else:
+                self.assertEqual(
+                    self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304
+                )
+
+            Post.objects.filter(pk=self.post.pk).update(title='Edited', updated_at=timezone.now() + timedelta(seconds=5))
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Edited', response.content.decode())
+            # A renamed author changes the posts too
+            etag = response['ETag']
+            self.user.save()
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
 
-# Create your tests here.
+    def test_list_sees_deletes_and_missing_posts_404(self):
+        etag = self.client.get('/freedom-wall/api/posts/')['ETag']
+        Post.objects.create(title='Other', content='x', author='Anonymous').delete()
+        self.post.delete()
+        self.assertEqual(self.client.get('/freedom-wall/api/posts/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get(f'/freedom-wall/api/posts/{self.post.id}/').status_code, 404)
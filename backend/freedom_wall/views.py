@@ -3,14 +3,20 @@ from rest_framework import status, viewsets
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
+from django.db.models import Count, Max
+from backend.conditional import check_not_modified
+from users.models import User
+from .feed import get_feed_page, get_page_size
 from .models import Post
+from .search import search_posts
 from .serializers import PostSerializer
 
 class PostViewSet(viewsets.ModelViewSet):
     """
     ViewSet for handling Post operations
     """
-    queryset = Post.objects.all()
+    # author_name falls back to the user's name; load it with the post
+    queryset = Post.objects.select_related('user')
     serializer_class = PostSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     
@@ -19,6 +25,40 @@ class PostViewSet(viewsets.ModelViewSet):
         context.update({"request": self.request})
         return context
     
+    def list(self, request, *args, **kwargs):
+        # Count and newest id catch deletes and inserts, the newest
+        # updated_at catches edits; author names come from the users. No
+        # Last-Modified: a delete moves no timestamp, only the ETag sees it
+        state = Post.objects.aggregate(count=Count('id'), newest=Max('id'), updated_at=Max('updated_at'))
+        users_updated_at = User.objects.aggregate(updated_at=Max('updated_at'))['updated_at']
+        not_modified, validators = check_not_modified(
+            request, (state['count'], state['newest'], state['updated_at'], users_updated_at), private=False,
+        )
+        if not_modified is not None:
+            return not_modified
+        response = super().list(request, *args, **kwargs)
+        for header, value in validators.items():
+            response[header] = value
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs.get('pk')
+        row = None
+        if str(pk).isdigit():
+            row = Post.objects.filter(pk=pk).values_list('updated_at', 'user__updated_at').first()
+        if row is None:
+            # Let the usual lookup answer 404
+            return super().retrieve(request, *args, **kwargs)
+        not_modified, validators = check_not_modified(
+            request, row, max(filter(None, row)), private=False,
+        )
+        if not_modified is not None:
+            return not_modified
+        response = super().retrieve(request, *args, **kwargs)
+        for header, value in validators.items():
+            response[header] = value
+        return response
+
     def perform_update(self, serializer):
         # Only allow post owners to update their posts
         if self.request.user.is_authenticated:
@@ -40,6 +80,44 @@ class PostViewSet(viewsets.ModelViewSet):
             return Response({"detail": "You do not have permission to delete this post."}, 
                            status=status.HTTP_403_FORBIDDEN)
     
+    @action(detail=False, methods=['get'])
+    def feed(self, request):
+        """
+        The wall, newest first, one page at a time. Follow `X-Cursor-Before`
+        with `?cursor=` while `X-Has-More` is true. The first pages come from
+        the cache (see feed.py).
+        """
+        try:
+            limit = get_page_size(request.query_params.get('limit'))
+            data, headers = get_feed_page(
+                request.query_params.get('cursor'), limit,
+                lambda posts: self.get_serializer(posts, many=True).data,
+            )
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data, headers=headers)
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Posts matching every word of `q` in their title or content, best match
+        first (full-text index, see search.py). Page with `page` and `limit`.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"detail": "q parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = get_page_size(request.query_params.get('limit'))
+            page = int(request.query_params.get('page') or 1)
+            if page < 1:
+                raise ValueError
+        except ValueError:
+            return Response({"detail": "Invalid page or limit."}, status=status.HTTP_400_BAD_REQUEST)
+
+        posts, has_more = search_posts(query, limit, (page - 1) * limit)
+        serializer = self.get_serializer(posts, many=True)
+        return Response(serializer.data, headers={'X-Has-More': 'true' if has_more else 'false'})
+
     @action(detail=False, methods=['get'])
     def user_posts(self, request):
         user_id = request.query_params.get('user_id', None)
@@ -47,7 +125,7 @@ class PostViewSet(viewsets.ModelViewSet):
             return Response({"detail": "User ID is required."}, 
                            status=status.HTTP_400_BAD_REQUEST)
         
-        posts = Post.objects.filter(user_id=user_id)
+        posts = Post.objects.filter(user_id=user_id).select_related('user')
         serializer = self.get_serializer(posts, many=True)
         return Response(serializer.data)
     
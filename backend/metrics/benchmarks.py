@@ -0,0 +1,160 @@
+import math
+import statistics
+import time
+import tracemalloc
+
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from chat.crypto import get_cipher, encrypt_batch
+from chat.models import Message
+from freedom_wall.models import Post
+from users.models import User
+
+# Data volumes used when the command is run without options
+DEFAULT_VOLUMES = {
+    'users': 200,
+    'messages': 20000,
+    'posts': 5000,
+}
+
+SEED_BATCH_SIZE = 2000
+
+# Wall posts are built from these so searches have realistic, uneven hit counts
+WALL_WORDS = (
+    'coffee exam library weekend rain campus lecture midnight crush playlist '
+    'dorm professor deadline festival basketball canteen thesis sunrise bus secret'
+).split()
+
+
+def wall_word(n, salt):
+    # Deterministic but scattered, so every run seeds the same wall
+    h = (n * 0x9E3779B1 + salt * 0x85EBCA6B) & 0xFFFFFFFF
+    h = ((h ^ (h >> 15)) * 0x2C1B3C6D) & 0xFFFFFFFF
+    return WALL_WORDS[(h ^ (h >> 12)) % len(WALL_WORDS)]
+
+
+def seed(users, messages, posts):
+    """
+    Fill the (test) database with `users` users, `messages` messages spread
+    over conversations with the first user, and `posts` wall posts.
+    """
+    accounts = []
+    for i in range(users):
+        user = User(email=f'bench{i}@example.com', name=f'Bench User {i}', is_superuser=(i == 0), is_staff=(i == 0))
+        user.set_unusable_password()  # Hashing real passwords would dominate seeding
+        accounts.append(user)
+    accounts = User.objects.bulk_create(accounts, batch_size=SEED_BATCH_SIZE)
+
+    main = accounts[0]
+    peers = accounts[1:] or accounts
+    cipher = get_cipher()
+    for start in range(0, messages, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, messages - start)
+        payloads = encrypt_batch(cipher, [f'benchmark message {start + i}' for i in range(count)])
+        batch = []
+        for i, payload in enumerate(payloads):
+            peer = peers[(start + i) % len(peers)]
+            # Alternate directions so both sides of every conversation have rows
+            sender, receiver = (main, peer) if (start + i) % 2 else (peer, main)
+            batch.append(Message(sender=sender, receiver=receiver, payload=payload))
+        Message.objects.bulk_create(batch)
+
+    for start in range(0, posts, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, posts - start)
+        Post.objects.bulk_create([
+            Post(title=f'Post {start + i} about {wall_word(start + i, 1)}',
+                 content=f'Benchmark wall post number {start + i}: {wall_word(start + i, 2)} '
+                         f'{wall_word(start + i, 3)} and {wall_word(start + i, 5)}',
+                 user=accounts[(start + i) % len(accounts)], author='Anonymous')
+            for i in range(count)
+        ])
+
+    return main, peers[0]
+
+
+def scenarios(user, peer):
+    """
+    (name, path, query params) for every benchmarked endpoint.
+    """
+    return [
+        ('specific-chat', '/chat/api/specific-chat/', {'sender_id': peer.id, 'receiver_id': user.id}),
+        ('messages-by-receiver', '/chat/api/messages-by-receiver/', {'receiver_id': user.id}),
+        ('messages-by-sender', '/chat/api/messages-by-sender/', {'sender_id': user.id}),
+        ('conversation', '/chat/api/conversation/', {'peer_id': peer.id}),
+        ('users', '/api/users/', {}),
+        ('user-counts', '/api/user-counts/', {}),
+        ('posts', '/freedom-wall/api/posts/', {}),
+        ('wall-feed', '/freedom-wall/api/posts/feed/', {}),
+        ('wall-search', '/freedom-wall/api/posts/search/', {'q': 'coffee exam'}),
+        ('wall-search-prefix', '/freedom-wall/api/posts/search/', {'q': 'lib'}),
+    ]
+
+
+def measure(client, path, params, iterations, warmup):
+    for _ in range(warmup):
+        client.get(path, params)
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = client.get(path, params)
+        timings.append(time.perf_counter() - start)
+
+    # Queries and allocations are deterministic enough to sample once.
+    # The query log is a bounded deque, so empty it first or a full log hides new queries
+    reset_queries()
+    with CaptureQueriesContext(connection) as queries:
+        client.get(path, params)
+
+    tracemalloc.start()
+    try:
+        client.get(path, params)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'status': response.status_code,
+        'p50_ms': round(statistics.median(timings) * 1000, 3),
+        # Nearest rank, so small samples do not report their fastest run as p95
+        'p95_ms': round(timings[math.ceil(len(timings) * 0.95) - 1] * 1000, 3),
+        'queries': len(queries),
+        'peak_alloc_bytes': peak,
+        'response_bytes': len(response.content),
+    }
+
+
+def run(iterations, warmup, only=None, **volumes):
+    user, peer = seed(**volumes)
+    client = APIClient()
+    client.force_authenticate(user)
+    return {
+        name: measure(client, path, params, iterations, warmup)
+        for name, path, params in scenarios(user, peer)
+        if not only or name in only
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    List of human-readable regressions of `results` against `baseline`.
+    Latency and allocations may grow by `threshold` (a fraction); query
+    counts may not grow at all.
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'peak_alloc_bytes'):
+            if previous[metric] and current[metric] > previous[metric] * (1 + threshold):
+                regressions.append(
+                    f"{name}: {metric} {previous[metric]} -> {current[metric]} "
+                    f"(+{(current[metric] / previous[metric] - 1) * 100:.0f}%)"
+                )
+        if current['queries'] > previous['queries']:
+            regressions.append(f"{name}: queries {previous['queries']} -> {current['queries']}")
+    return regressions
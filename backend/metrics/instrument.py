@@ -0,0 +1,57 @@
+import contextvars
+import threading
+import time
+
+from .registry import CRYPTO_OPERATIONS, CRYPTO_TIME
+
+# Label used for work done outside of a request (management commands, pool warm-up)
+BACKGROUND_ROUTE = '<background>'
+
+_current = contextvars.ContextVar('metrics_request_stats', default=None)
+
+
+class RequestStats:
+    """
+    Per-request accumulator. Flushed to the registry once the route is known.
+    Crypto work may run on the shared pool, hence the lock.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.crypto = {}  # operation -> [count, seconds]
+        self._lock = threading.Lock()
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.queries += 1
+                self.db_time += elapsed
+
+    def add_crypto(self, operation, seconds):
+        with self._lock:
+            totals = self.crypto.setdefault(operation, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+
+def start_request():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def record_crypto(operation, seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.add_crypto(operation, seconds)
+    else:
+        CRYPTO_OPERATIONS.inc(1, BACKGROUND_ROUTE, operation)
+        CRYPTO_TIME.inc(seconds, BACKGROUND_ROUTE, operation)
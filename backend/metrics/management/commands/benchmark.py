@@ -0,0 +1,62 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from metrics import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the chat, users and freedom wall endpoints against a freshly "
+        "seeded test database. Saves results as JSON and can fail on regressions "
+        "against a saved baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=benchmarks.DEFAULT_VOLUMES['users'])
+        parser.add_argument('--messages', type=int, default=benchmarks.DEFAULT_VOLUMES['messages'])
+        parser.add_argument('--posts', type=int, default=benchmarks.DEFAULT_VOLUMES['posts'])
+        parser.add_argument('--iterations', type=int, default=20, help='Timed requests per endpoint.')
+        parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per endpoint.')
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help='Only run this scenario (repeatable), e.g. wall-search with --posts 1000000.')
+        parser.add_argument('--output', help='Write the results (JSON) to this file, e.g. a new baseline.')
+        parser.add_argument('--compare', help='Baseline JSON file to compare the results against.')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed growth of latency/allocations over the baseline (0.2 = 20%%).')
+
+    def handle(self, *args, **options):
+        volumes = {key: options[key] for key in ('users', 'messages', 'posts')}
+
+        # Never touch the real database: run against a throwaway test database
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = benchmarks.run(options['iterations'], options['warmup'], only=options['scenarios'], **volumes)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<22} p50 {result['p50_ms']:>9.3f} ms  p95 {result['p95_ms']:>9.3f} ms  "
+                f"queries {result['queries']:>3}  peak alloc {result['peak_alloc_bytes']:>10} B"
+            )
+
+        report = {'volumes': volumes, 'results': results}
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+            if baseline.get('volumes') != volumes:
+                self.stderr.write("Warning: baseline was recorded with different data volumes")
+            regressions = benchmarks.compare(results, baseline['results'], options['threshold'])
+            if regressions:
+                raise CommandError("Performance regressions:\n  " + "\n  ".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
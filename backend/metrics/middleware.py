@@ -0,0 +1,56 @@
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+
+from .instrument import start_request, end_request
+from .registry import (
+    REQUEST_LATENCY, RESPONSE_SIZE, DB_QUERIES, DB_TIME, CRYPTO_OPERATIONS, CRYPTO_TIME,
+)
+
+METRICS_PATH = '/metrics'
+
+
+def route_label(request):
+    # The URL pattern rather than the raw path keeps label cardinality bounded
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.route:
+        return '<unmatched>'
+    # DRF router patterns are regexes; drop the anchors for readability
+    return match.route.replace('^', '').replace('$', '')
+
+
+class MetricsMiddleware:
+    """
+    Records latency, response size, DB queries/time and Fernet work per route.
+    Should sit first in MIDDLEWARE so the latency covers the whole stack.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path_info == METRICS_PATH:
+            return self.get_response(request)
+
+        stats, token = start_request()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats.db_wrapper))
+                response = self.get_response(request)
+        finally:
+            end_request(token)
+        elapsed = time.perf_counter() - start
+
+        route = route_label(request)
+        REQUEST_LATENCY.observe(elapsed, route, request.method, response.status_code)
+        if not response.streaming:
+            RESPONSE_SIZE.observe(len(response.content), route)
+        DB_QUERIES.observe(stats.queries, route)
+        DB_TIME.observe(stats.db_time, route)
+        for operation, (count, seconds) in stats.crypto.items():
+            CRYPTO_OPERATIONS.inc(count, route, operation)
+            CRYPTO_TIME.inc(seconds, route, operation)
+        return response
@@ -0,0 +1,161 @@
+import json
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIClient
+
+from chat.cache import message_cache
+from users.models import User
+
+from . import benchmarks
+from .instrument import BACKGROUND_ROUTE, record_crypto
+from .registry import Counter, Histogram, Registry, registry
+
+
+def sample(name, labels=''):
+    """
+    Current value of one sample in the /metrics exposition, 0 if absent.
+    """
+    prefix = f'{name}{labels} '
+    for line in registry.render().splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return 0
+
+
+class RegistryTests(SimpleTestCase):
+
+    def test_exposition_format(self):
+        local = Registry()
+        counter = local.register(Counter('jobs_total', 'Jobs run.', ('queue',)))
+        histogram = local.register(Histogram('job_seconds', 'Job time.', buckets=(0.1, 1.0)))
+        counter.inc(2, 'mail')
+        counter.inc(1, 'say "hi"\n')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(3)
+
+        self.assertEqual(local.render(), '\n'.join([
+            '# HELP jobs_total Jobs run.',
+            '# TYPE jobs_total counter',
+            'jobs_total{queue="mail"} 2',
+            'jobs_total{queue="say \\"hi\\"\\n"} 1',
+            '# HELP job_seconds Job time.',
+            '# TYPE job_seconds histogram',
+            'job_seconds_bucket{le="0.1"} 1',
+            'job_seconds_bucket{le="1.0"} 2',
+            'job_seconds_bucket{le="+Inf"} 3',
+            'job_seconds_sum 3.55',
+            'job_seconds_count 3',
+        ]) + '\n')
+
+    def test_background_crypto_is_labelled(self):
+        labels = f'{{route="{BACKGROUND_ROUTE}",operation="decrypt"}}'
+        before = sample('crypto_operations_total', labels)
+        record_crypto('decrypt', 0.001)
+        self.assertEqual(sample('crypto_operations_total', labels), before + 1)
+
+
+class MetricsMiddlewareTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(name=name, email=f'{name}@example.com', password=None)
+            for name in ('alice', 'bob')
+        ]
+
+    def test_requests_are_recorded_by_route(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        route = 'chat/api/conversation/'
+        requests = sample('http_request_duration_seconds_count', f'{{route="{route}",method="GET",status="200"}}')
+        queries = sample('db_queries_per_request_count', f'{{route="{route}"}}')
+        decrypts = sample('crypto_operations_total', f'{{route="{route}",operation="decrypt"}}')
+
+        client.post('/chat/api/messages/', {'sender': self.alice.id, 'receiver': self.bob.id, 'content': 'hi'}, format='json')
+        # Cold cache, so the read has to decrypt
+        message_cache.clear()
+        client.get('/chat/api/conversation/', {'peer_id': self.bob.id})
+
+        self.assertEqual(
+            sample('http_request_duration_seconds_count', f'{{route="{route}",method="GET",status="200"}}'), requests + 1
+        )
+        self.assertEqual(sample('db_queries_per_request_count', f'{{route="{route}"}}'), queries + 1)
+        self.assertGreater(sample('db_queries_per_request_sum', f'{{route="{route}"}}'), 0)
+        self.assertEqual(sample('crypto_operations_total', f'{{route="{route}",operation="decrypt"}}'), decrypts + 1)
+
+    def test_unmatched_paths_share_a_label(self):
+        before = sample('http_request_duration_seconds_count', '{route="<unmatched>",method="GET",status="404"}')
+        self.client.get('/no/such/page/1')
+        self.client.get('/no/such/page/2')
+        self.assertEqual(
+            sample('http_request_duration_seconds_count', '{route="<unmatched>",method="GET",status="404"}'), before + 2
+        )
+
+    def test_scrape_token(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', response.content.decode())
+
+        with self.settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+
+
+class BenchmarkTests(TestCase):
+    """
+    The benchmark scenarios and the regression check of `manage.py benchmark`.
+    """
+
+    def test_scenarios_run_on_seeded_data(self):
+        results = benchmarks.run(iterations=2, warmup=0, users=5, messages=40, posts=30)
+        self.assertEqual(list(results), [name for name, _, _ in benchmarks.scenarios(*User.objects.order_by('id')[:2])])
+        for name, result in results.items():
+            self.assertEqual(result['status'], 200, name)
+            self.assertGreater(result['response_bytes'], 0, name)
+            self.assertLessEqual(result['p50_ms'], result['p95_ms'], name)
+
+    def test_compare(self):
+        baseline = {'feed': {'p50_ms': 10.0, 'p95_ms': 20.0, 'peak_alloc_bytes': 1000, 'queries': 2}}
+        same = {'feed': {'p50_ms': 11.0, 'p95_ms': 20.0, 'peak_alloc_bytes': 1000, 'queries': 2}}
+        self.assertEqual(benchmarks.compare(same, baseline, 0.2), [])
+
+        slower = {'feed': {'p50_ms': 13.0, 'p95_ms': 20.0, 'peak_alloc_bytes': 1000, 'queries': 3}}
+        self.assertEqual(benchmarks.compare(slower, baseline, 0.2), [
+            'feed: p50_ms 10.0 -> 13.0 (+30%)',
+            'feed: queries 2 -> 3',
+        ])
+        # Scenarios missing from the baseline are not compared
+        self.assertEqual(benchmarks.compare({'new': slower['feed']}, baseline, 0.2), [])
+
+    def test_command_saves_and_compares_results(self):
+        result = {'status': 200, 'p50_ms': 1.0, 'p95_ms': 2.0, 'queries': 1, 'peak_alloc_bytes': 100, 'response_bytes': 10}
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        baseline = Path(tmp.name) / 'baseline.json'
+        command = 'metrics.management.commands.benchmark'
+
+        # The command sets up its own test database; here the test run's is used
+        with mock.patch(f'{command}.setup_test_environment'), mock.patch(f'{command}.teardown_test_environment'), \
+                mock.patch(f'{command}.connection') as connection, \
+                mock.patch.object(benchmarks, 'run', return_value={'feed': result}):
+            stdout = StringIO()
+            call_command('benchmark', output=str(baseline), stdout=stdout)
+            self.assertIn('feed', stdout.getvalue())
+            self.assertTrue(connection.creation.destroy_test_db.called)
+            saved = json.loads(baseline.read_text())
+            self.assertEqual(saved['results'], {'feed': result})
+
+            stdout = StringIO()
+            call_command('benchmark', compare=str(baseline), stdout=stdout)
+            self.assertIn('No regressions', stdout.getvalue())
+
+            saved['results']['feed']['queries'] = 0
+            baseline.write_text(json.dumps(saved))
+            with self.assertRaisesMessage(CommandError, 'feed: queries 0 -> 1'):
+                call_command('benchmark', compare=str(baseline), stdout=StringIO())
@@ -0,0 +1,173 @@
+"""
+Dashboard statistics, kept up to date as rows are written so that reading
+them never scans a table.
+
+Counter rows hold the running totals: USERS, ADMINS (superusers), MESSAGES
+(hot and archived) and POSTS. DailyStats holds the per-day rollups. The
+receivers in signals.py apply each delta once the write it counts has
+committed on its own database (a message shard included), so a rolled back
+write is never counted. The delta is a single-row UPDATE in its own short
+transaction: the few hot rows are not locked while a send is still open.
+
+A process dying between a commit and its delta loses the delta.
+`manage.py rebuild_stats` recomputes everything from the tables: run it
+after that, after writes that skip signals (raw deletes, such as a sharded
+user's messages), and now and then for active_senders, which deletes do not
+decrement.
+"""
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Counter, DailySender, DailyStats
+
+USERS = 'users'
+ADMINS = 'admins'
+MESSAGES = 'messages'
+POSTS = 'posts'
+COUNTERS = (USERS, ADMINS, MESSAGES, POSTS)
+
+# Most days the dashboard serves at once
+MAX_DAYS = 366
+
+
+def stats_database():
+    return router.db_for_write(Counter)
+
+
+def bump(model, database, lookup, **deltas):
+    """
+    Add `deltas` to the fields of the row matching `lookup`, creating it if
+    needed.
+    """
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    rows = model.objects.using(database).filter(**lookup)
+    if rows.update(**{field: F(field) + delta for field, delta in deltas.items()}):
+        return
+    try:
+        with transaction.atomic(using=database):
+            model.objects.using(database).create(**lookup, **deltas)
+    except IntegrityError:
+        # Created by a concurrent writer in the meantime
+        rows.update(**{field: F(field) + delta for field, delta in deltas.items()})
+
+
+def add(name, delta):
+    bump(Counter, stats_database(), {'name': name}, value=delta)
+
+
+def add_daily(day, **deltas):
+    bump(DailyStats, stats_database(), {'day': day}, **deltas)
+
+
+def day_of(moment):
+    return timezone.localdate(moment) if moment else timezone.localdate()
+
+
+class KnownSenders:
+    """
+    Process-local memo of today's (day, user) pairs already in DailySender,
+    so a user's every message after their first of the day costs no lookup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.day = None
+        self.users = set()
+
+    def __contains__(self, pair):
+        day, user_id = pair
+        with self._lock:
+            return day == self.day and user_id in self.users
+
+    def add(self, day, user_id):
+        with self._lock:
+            if day != self.day:
+                if self.day is not None and day < self.day:
+                    return  # Only today's are worth keeping
+                self.day, self.users = day, set()
+            self.users.add(user_id)
+
+    def clear(self):
+        with self._lock:
+            self.day, self.users = None, set()
+
+
+known_senders = KnownSenders()
+
+
+def record_senders(pairs):
+    """
+    {day: users new to DailySender} for (day, user id) `pairs`.
+    """
+    database = stats_database()
+    new = defaultdict(int)
+    for day, user_id in pairs:
+        if (day, user_id) in known_senders:
+            continue
+        _, created = DailySender.objects.using(database).get_or_create(day=day, user_id=user_id)
+        new[day] += created
+        # Remembered once committed, should this run inside a transaction
+        transaction.on_commit(lambda day=day, user_id=user_id: known_senders.add(day, user_id), using=database)
+    return new
+
+
+def record_messages(messages):
+    if not messages:
+        return
+    per_day = defaultdict(int)
+    senders = set()
+    for message in messages:
+        day = day_of(message.timestamp)
+        per_day[day] += 1
+        senders.add((day, message.sender_id))
+
+    add(MESSAGES, len(messages))
+    new_senders = record_senders(sorted(senders))
+    for day, count in per_day.items():
+        add_daily(day, messages=count, active_senders=new_senders.get(day, 0))
+
+
+def record_deleted_message(message):
+    add(MESSAGES, -1)
+    add_daily(day_of(message.timestamp), messages=-1)
+
+
+def record_post(post, delta):
+    add(POSTS, delta)
+    add_daily(day_of(post.created_at), posts=delta)
+
+
+def get_counters():
+    """
+    {counter name: value}, one primary key lookup.
+    """
+    values = dict(Counter.objects.using(router.db_for_read(Counter)).values_list('name', 'value'))
+    return {name: values.get(name, 0) for name in COUNTERS}
+
+
+def get_daily(days):
+    """
+    Rollups of the last `days` days, oldest first, zeros for quiet days.
+    """
+    today = timezone.localdate()
+    first = today - timedelta(days=days - 1)
+    rows = DailyStats.objects.using(router.db_for_read(DailyStats)).filter(day__gte=first, day__lte=today)
+    found = {row.day: row for row in rows}
+    daily = []
+    for offset in range(days):
+        day = first + timedelta(days=offset)
+        row = found.get(day) or DailyStats(day=day)
+        daily.append({
+            'day': day,
+            'messages': row.messages,
+            'active_senders': row.active_senders,
+            'posts': row.posts,
+        })
+    return daily
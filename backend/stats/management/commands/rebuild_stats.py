@@ -0,0 +1,78 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+from chat.archive import archive_databases, unpack
+from chat.models import Message, MessageArchiveSegment
+from chat.sharding import shard_aliases
+from freedom_wall.models import Post
+from stats.counters import ADMINS, MESSAGES, POSTS, USERS, day_of, known_senders, stats_database
+from stats.models import Counter, DailySender, DailyStats
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the dashboard counters and daily rollups (see stats/counters.py) "
+        "from the users, posts and messages tables, archived messages included. "
+        "Writes made while it runs may be counted twice or not at all: run it when "
+        "traffic is quiet, or run it again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rollup rows written per INSERT.')
+
+    def handle(self, *args, **options):
+        # (day, sender id) -> messages
+        sent = defaultdict(int)
+        for database in shard_aliases() or [router.db_for_write(Message)]:
+            rows = (
+                Message.objects.using(database).annotate(day=TruncDate('timestamp'))
+                .values('day', 'sender_id').annotate(count=Count('id')).order_by()
+            )
+            for row in rows.iterator():
+                sent[row['day'], row['sender_id']] += row['count']
+        for database in archive_databases():
+            for segment in MessageArchiveSegment.objects.using(database).order_by('id').iterator(chunk_size=10):
+                for message in unpack(segment):
+                    sent[day_of(message.timestamp), message.sender_id] += 1
+
+        daily = defaultdict(DailyStats)
+        for (day, _), count in sent.items():
+            daily[day].messages += count
+            daily[day].active_senders += 1
+        posts = (
+            Post.objects.annotate(day=TruncDate('created_at')).values('day')
+            .annotate(count=Count('id')).order_by()
+        )
+        for row in posts:
+            daily[row['day']].posts = row['count']
+        for day, stats in daily.items():
+            stats.day = day
+
+        counters = {
+            USERS: User.objects.count(),
+            ADMINS: User.objects.filter(is_superuser=True).count(),
+            MESSAGES: sum(sent.values()),
+            POSTS: Post.objects.count(),
+        }
+
+        database = stats_database()
+        with transaction.atomic(using=database):
+            DailySender.objects.using(database).all().delete()
+            DailyStats.objects.using(database).all().delete()
+            DailyStats.objects.using(database).bulk_create(daily.values(), batch_size=options['batch_size'])
+            DailySender.objects.using(database).bulk_create(
+                (DailySender(day=day, user_id=user_id) for day, user_id in sent),
+                batch_size=options['batch_size'],
+            )
+            for name, value in counters.items():
+                Counter.objects.using(database).update_or_create(name=name, defaults={'value': value})
+        known_senders.clear()
+
+        summary = ', '.join(f"{value} {name}" for name, value in counters.items())
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(daily)} days of statistics ({summary})"))
@@ -0,0 +1,42 @@
+from django.db import migrations
+from django.db.models import Sum
+
+
+def seed_counters(apps, schema_editor):
+    """
+    Start the counters from the tables of this database. Sharded deployments,
+    and the daily rollups, need `manage.py rebuild_stats` afterwards.
+    """
+    database = schema_editor.connection.alias
+    User = apps.get_model('users', 'User')
+    Post = apps.get_model('freedom_wall', 'Post')
+    Message = apps.get_model('chat', 'Message')
+    MessageArchiveSegment = apps.get_model('chat', 'MessageArchiveSegment')
+    Counter = apps.get_model('stats', 'Counter')
+
+    archived = MessageArchiveSegment.objects.using(database).aggregate(total=Sum('message_count'))['total'] or 0
+    counters = {
+        'users': User.objects.using(database).count(),
+        'admins': User.objects.using(database).filter(is_superuser=True).count(),
+        'messages': Message.objects.using(database).count() + archived,
+        'posts': Post.objects.using(database).count(),
+    }
+    Counter.objects.using(database).bulk_create(Counter(name=name, value=value) for name, value in counters.items())
+
+
+def drop_counters(apps, schema_editor):
+    apps.get_model('stats', 'Counter').objects.using(schema_editor.connection.alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0001_initial'),
+        ('chat', '0010_conversation_version'),
+        ('freedom_wall', '0004_post_updated_index'),
+        ('users', '0004_user_directory_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_counters, drop_counters),
+    ]
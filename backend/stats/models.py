@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.db import models
+
+
+class Counter(models.Model):
+    """
+    A running total (see stats/counters.py for the names), moved by signal
+    deltas instead of being counted.
+    """
+    name = models.CharField(max_length=32, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+class DailyStats(models.Model):
+    """
+    Per-day rollup. Days are in TIME_ZONE.
+    """
+    day = models.DateField(primary_key=True)
+    messages = models.BigIntegerField(default=0)
+    # Distinct users who sent a message that day
+    active_senders = models.IntegerField(default=0)
+    posts = models.BigIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-day']
+
+    def __str__(self):
+        return f"{self.day}: {self.messages} messages, {self.active_senders} senders, {self.posts} posts"
+
+
+class DailySender(models.Model):
+    """
+    A user who sent a message on `day`: the first one counts them in
+    DailyStats.active_senders.
+    """
+    day = models.DateField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'user'], name='stats_daily_sender_uniq'),
+        ]
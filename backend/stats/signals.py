@@ -0,0 +1,84 @@
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from chat.models import Message
+from chat.signals import messages_bulk_created
+from freedom_wall.models import Post
+
+from .counters import ADMINS, USERS, add, record_deleted_message, record_messages, record_post
+
+# Every delta is applied once the write it counts has committed, on the
+# database it went to (see counters.py)
+
+
+def add_on_commit(using, name, delta):
+    if delta:
+        transaction.on_commit(partial(add, name, delta), using=using)
+
+
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def remember_superuser(sender, instance, raw, using, update_fields=None, **kwargs):
+    # The admins counter moves when is_superuser changes; look it up only
+    # when the save can change it
+    if raw or instance._state.adding or (update_fields is not None and 'is_superuser' not in update_fields):
+        return
+    instance._stats_was_superuser = (
+        sender._default_manager.using(using).filter(pk=instance.pk).values_list('is_superuser', flat=True).first()
+    )
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def count_saved_user(sender, instance, created, raw, using, **kwargs):
+    if raw:
+        return
+    if created:
+        add_on_commit(using, USERS, 1)
+        add_on_commit(using, ADMINS, int(instance.is_superuser))
+        return
+    was_superuser = instance.__dict__.pop('_stats_was_superuser', None)
+    if was_superuser is not None:
+        add_on_commit(using, ADMINS, int(instance.is_superuser) - int(was_superuser))
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def count_deleted_user(sender, instance, using, **kwargs):
+    add_on_commit(using, USERS, -1)
+    add_on_commit(using, ADMINS, -int(instance.is_superuser))
+
+
+@receiver(post_save, sender=Message)
+def count_saved_message(sender, instance, created, raw, using, **kwargs):
+    # Edits change no statistic
+    if created and not raw:
+        transaction.on_commit(partial(record_messages, [instance]), using=using)
+
+
+@receiver(messages_bulk_created)
+def count_bulk_created_messages(sender, messages, **kwargs):
+    # With shards one batch can span several databases
+    by_database = defaultdict(list)
+    for message in messages:
+        by_database[message._state.db].append(message)
+    for database, batch in by_database.items():
+        transaction.on_commit(partial(record_messages, batch), using=database)
+
+
+@receiver(post_delete, sender=Message)
+def count_deleted_message(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(record_deleted_message, instance), using=using)
+
+
+@receiver(post_save, sender=Post)
+def count_saved_post(sender, instance, created, raw, using, **kwargs):
+    if created and not raw:
+        transaction.on_commit(partial(record_post, instance, 1), using=using)
+
+
+@receiver(post_delete, sender=Post)
+def count_deleted_post(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(record_post, instance, -1), using=using)
@@ -0,0 +1,126 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from chat.crypto import get_cipher
+from chat.models import Message
+from chat.storage import seal
+from freedom_wall.models import Post
+from users.models import User
+
+from .counters import get_counters, known_senders
+from .models import DailySender, DailyStats
+
+
+class StatsTests(TestCase):
+    """
+    Signal-maintained counters and rollups, the dashboard and the rebuild.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # Counted when the writes commit, which the test transaction never does
+        with cls.captureOnCommitCallbacks(execute=True):
+            cls.alice = User.objects.create_superuser(name='alice', email='alice@example.com', password=None)
+            cls.bob = User.objects.create_user(name='bob', email='bob@example.com', password=None)
+
+    def setUp(self):
+        known_senders.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, sender, receiver, content='hi'):
+        return Message.objects.create(sender=sender, receiver=receiver, payload=seal(get_cipher(), content))
+
+    def dashboard(self, **params):
+        response = self.client.get('/stats/api/dashboard/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def today(self):
+        return DailyStats.objects.get(day=timezone.localdate())
+
+    def test_counters_follow_writes(self):
+        self.assertEqual(get_counters(), {'users': 2, 'admins': 1, 'messages': 0, 'posts': 0})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.send(self.alice, self.bob)
+        self.assertEqual(get_counters()['messages'], 1)
+        # Nothing moves before the commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(self.alice, self.bob)
+            self.assertEqual(get_counters()['messages'], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(self.bob, self.alice)
+            self.client.post('/chat/api/bulk-send/', {'messages': [
+                {'receiver': self.bob.id, 'content': 'one'}, {'receiver': self.bob.id, 'content': 'two'},
+            ]}, format='json')
+            first.delete()
+            post = Post.objects.create(title='Hello', content='x', author='Anonymous')
+            self.bob.is_superuser = True
+            self.bob.save()
+
+        self.assertEqual(get_counters(), {'users': 2, 'admins': 2, 'messages': 4, 'posts': 1})
+        today = self.today()
+        self.assertEqual((today.messages, today.active_senders, today.posts), (4, 2, 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.delete()
+            self.bob.delete()  # Cascades to every message he sent or received
+        self.assertEqual(get_counters(), {'users': 1, 'admins': 1, 'messages': 0, 'posts': 0})
+        self.assertEqual((self.today().messages, self.today().posts), (0, 0))
+
+    def test_rolled_back_writes_leave_no_trace(self):
+        with transaction.atomic():
+            self.send(self.alice, self.bob)
+            User.objects.create_user(name='carol', email='carol@example.com', password=None)
+            transaction.set_rollback(True)
+        self.assertEqual(get_counters()['messages'], 0)
+        self.assertEqual(get_counters()['users'], 2)
+        self.assertFalse(DailySender.objects.exists())
+
+    def test_dashboard_reads_only_the_summaries(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(self.alice, self.bob)
+            Post.objects.create(title='Hello', content='x', author='Anonymous')
+
+        with self.assertNumQueries(2):
+            data = self.dashboard(days=7)
+        self.assertEqual(data['total_messages'], 1)
+        self.assertEqual(len(data['daily']), 7)
+        self.assertEqual(data['daily'][-1], {
+            'day': timezone.localdate().isoformat(), 'messages': 1, 'active_senders': 1, 'posts': 1,
+        })
+        self.assertEqual(data['daily'][0]['messages'], 0)
+        self.assertEqual(self.client.get('/stats/api/dashboard/', {'days': 0}).status_code, 400)
+
+        response = self.client.get('/api/user-counts/')
+        self.assertEqual(response.json(), {'total_users': 2, 'total_admins': 1})
+
+    def test_rebuild(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            old = self.send(self.alice, self.bob)
+            Message.objects.filter(pk=old.pk).update(timestamp=timezone.now() - timedelta(days=400))
+            self.send(self.alice, self.bob)
+            self.send(self.bob, self.alice)
+            call_command('archive_messages', older_than_days=180, stdout=StringIO())
+            Post.objects.create(title='Hello', content='x', author='Anonymous')
+        expected = get_counters()
+
+        # Drift, as after raw deletes
+        DailyStats.objects.all().delete()
+        DailySender.objects.all().delete()
+        User.objects.filter(pk=self.bob.pk).update(is_superuser=True)
+
+        call_command('rebuild_stats', stdout=StringIO())
+        self.assertEqual(get_counters(), {**expected, 'admins': 2})
+        self.assertEqual(get_counters()['messages'], 3)
+        today = self.today()
+        self.assertEqual((today.messages, today.active_senders, today.posts), (2, 2, 1))
+        old_day = DailyStats.objects.get(day=timezone.localdate(timezone.now() - timedelta(days=400)))
+        self.assertEqual((old_day.messages, old_day.active_senders), (1, 1))
@@ -0,0 +1,7 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path('api/dashboard/', views.dashboard, name='stats-dashboard'),
+]
@@ -0,0 +1,31 @@
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+
+from .counters import ADMINS, MAX_DAYS, MESSAGES, POSTS, USERS, get_counters, get_daily
+
+# Days of rollups unless the client sends `days`
+DEFAULT_DAYS = 30
+
+
+@api_view(['GET'])
+def dashboard(request):
+    """
+    Totals and the last `days` days of activity, read from the maintained
+    counters and rollups (see counters.py): constant work however large
+    the tables grow.
+    """
+    try:
+        days = min(int(request.query_params.get('days') or DEFAULT_DAYS), MAX_DAYS)
+        if days < 1:
+            raise ValueError
+    except ValueError:
+        return Response({'detail': 'Invalid days format'}, status=400)
+
+    counters = get_counters()
+    return Response({
+        'total_users': counters[USERS],
+        'total_admins': counters[ADMINS],
+        'total_messages': counters[MESSAGES],
+        'total_posts': counters[POSTS],
+        'daily': get_daily(days),
+    })
@@ -1,4 +1,3 @@
-from django.http import JsonResponse
 from django.contrib.auth import authenticate
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.authtoken.models import Token
@@ -6,11 +5,20 @@ from .forms import SignupForm
 from .serializers import UserSerializer
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from django.db.models import Count, Max
+from backend.conditional import check_not_modified
 from .models import User
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])  # Ensure only authenticated users can access this
 def get_all_users(request):
+    # One aggregate tells whether the list changed since the client's copy.
+    # No Last-Modified: deleting a user moves no timestamp, only the ETag sees it
+    state = User.objects.aggregate(count=Count('id'), newest=Max('id'), updated_at=Max('updated_at'))
+    not_modified, validators = check_not_modified(request, (state['count'], state['newest'], state['updated_at']))
+    if not_modified is not None:
+        return not_modified
+
     # Query all users from the User model
     users = User.objects.all()
     
@@ -24,19 +32,26 @@ def get_all_users(request):
         'data': {
             'users': serializer.data
         }
-    })
+    }, headers=validators)
 
 @api_view(['GET'])
 def me(request):
     if request.user.is_authenticated:
-        return JsonResponse({
+        data = {
             'id': request.user.id,  # Now an integer (BigAutoField)
             'name': request.user.name,
             'email': request.user.email,
             'is_superuser': request.user.is_superuser,
             'is_staff': request.user.is_staff,
-        })
-    return JsonResponse({'error': 'User not authenticated'}, status=401)
+        }
+        # The user row is already loaded by authentication, no extra query
+        not_modified, validators = check_not_modified(
+            request, (tuple(data.values()), request.user.updated_at), request.user.updated_at,
+        )
+        if not_modified is not None:
+            return not_modified
+        return Response(data, headers=validators)
+    return Response({'error': 'User not authenticated'}, status=401)
 
 @api_view(['POST'])
 @authentication_classes([])  # No authentication for signup
@@ -62,9 +77,12 @@ def signup(request):
         user.save()
     else:
         message = 'error'
-        return JsonResponse({'message': message, 'errors': form.errors})
+        # ErrorList keeps its items outside the list it subclasses; orjson
+        # needs plain lists
+        errors = {field: list(field_errors) for field, field_errors in form.errors.items()}
+        return Response({'message': message, 'errors': errors})
 
-    return JsonResponse({'message': message})
+    return Response({'message': message})
 
 @api_view(['POST'])
 @authentication_classes([])  # No authentication for login
@@ -77,13 +95,13 @@ def login(request):
     user = authenticate(username=email, password=password)
     if user is not None:
         if login_as == 'superuser' and not user.is_superuser:
-            return JsonResponse({'message': 'User is not a superuser'}, status=403)
+            return Response({'message': 'User is not a superuser'}, status=403)
         if login_as == 'staff' and not user.is_staff:
-            return JsonResponse({'message': 'User is not staff'}, status=403)
+            return Response({'message': 'User is not staff'}, status=403)
         
         # Generate or retrieve the token for the user
         token, created = Token.objects.get_or_create(user=user)
-        return JsonResponse({
+        return Response({
             'message': 'success',
             'token': token.key,
             'user': {
@@ -92,4 +110,4 @@ def login(request):
                 'email': user.email,
             }
         })
-    return JsonResponse({'message': 'Invalid credentials'}, status=401)
+    return Response({'message': 'Invalid credentials'}, status=401)
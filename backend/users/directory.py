@@ -0,0 +1,76 @@
+"""
+The user directory: users ordered by name, paged with a (name_key, id)
+cursor, optionally narrowed to a name or email prefix.
+
+Prefixes are matched on the normalized name_key / email_key columns,
+written as a key range (`key >= prefix AND key < prefix + U+10FFFF`) that
+the (key, id) indexes serve directly on every backend; LIKE / startswith
+would scan, on PostgreSQL too unless the index has varchar_pattern_ops. The
+range relies on code point order: SQLite's default, and PostgreSQL's under
+the C collation.
+"""
+import base64
+import json
+
+from django.conf import settings
+from django.db import router
+from django.db.models import Q
+
+from .models import User, directory_key
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Sorts after every character a key can continue with
+PREFIX_END = '\U0010ffff'
+
+
+def get_page_size(limit):
+    max_size = getattr(settings, 'USER_DIRECTORY_MAX_PAGE_SIZE', MAX_PAGE_SIZE)
+    if not limit:
+        return min(getattr(settings, 'USER_DIRECTORY_PAGE_SIZE', DEFAULT_PAGE_SIZE), max_size)
+    limit = int(limit)  # Raises ValueError for bad input
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, max_size)
+
+
+def encode_cursor(user):
+    raw = json.dumps([user.name_key, user.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    (name_key, id) of a cursor. Raises ValueError if it is malformed.
+    """
+    try:
+        name_key, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(name_key, str) or not isinstance(user_id, int):
+            raise ValueError
+        return name_key, user_id
+    except (ValueError, TypeError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def prefix_q(field, prefix):
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': prefix + PREFIX_END})
+
+
+def directory_page(query='', cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    (users, next cursor or None): one page of users whose name or email
+    starts with `query` (all users when empty), by name then id. Raises
+    ValueError for a bad cursor.
+    """
+    database = router.db_for_read(User)
+    users = User.objects.using(database).order_by('name_key', 'id')
+    prefix = directory_key(query.strip())
+    if prefix:
+        users = users.filter(prefix_q('name_key', prefix) | prefix_q('email_key', prefix))
+    if cursor:
+        name_key, user_id = decode_cursor(cursor)
+        users = users.filter(Q(name_key__gt=name_key) | Q(name_key=name_key, id__gt=user_id))
+
+    users = list(users[:limit + 1])
+    next_cursor = encode_cursor(users[limit - 1]) if len(users) > limit else None
+    return users[:limit], next_cursor
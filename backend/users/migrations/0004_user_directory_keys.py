@@ -0,0 +1,63 @@
+# Generated by Django 4.2.17 on 2026-10-18 12:49
+
+import unicodedata
+
+from django.db import migrations, models, transaction
+
+# Rows read and written per batch, keeps memory and lock time bounded
+BATCH_SIZE = 1000
+
+
+def directory_key(value):
+    # users.models.directory_key as of this migration, copied so later
+    # changes to the app code cannot change what this migration does
+    return unicodedata.normalize('NFKC', value or '').casefold()
+
+
+def fill_keys(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    database = schema_editor.connection.alias
+    users = User.objects.using(database)
+    last_id = 0
+    while True:
+        batch = list(users.filter(id__gt=last_id).order_by('id').only('id', 'name', 'email')[:BATCH_SIZE])
+        if not batch:
+            break
+        for user in batch:
+            user.name_key = directory_key(user.name)[:255]
+            user.email_key = directory_key(user.email)[:254]
+        with transaction.atomic(using=database):
+            users.bulk_update(batch, ['name_key', 'email_key'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    # One transaction per batch rather than one for the whole table
+    atomic = False
+
+    dependencies = [
+        ('users', '0003_user_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='email_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=254),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='name_key',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        # Before the indexes, so the backfill does not maintain them row by row
+        migrations.RunPython(fill_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['name_key', 'id'], name='user_name_key_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['email_key', 'id'], name='user_email_key_idx'),
+        ),
+    ]
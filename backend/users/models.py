@@ -1,8 +1,17 @@
+import unicodedata
+
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, UserManager
 from django.db import models
 from django.utils import timezone
 
 
+def directory_key(value):
+    """
+    Normalized form of a name or email for prefix search: NFKC, casefolded.
+    """
+    return unicodedata.normalize('NFKC', value or '').casefold()
+
+
 class CustomUserManager(UserManager):
     def _create_user(self, name, email, password, **extra_fields):
         if not email:
@@ -38,9 +47,31 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     date_joined = models.DateTimeField(default=timezone.now)
     last_login = models.DateTimeField(blank=True, null=True)
+    # Validator for the user endpoints' conditional GET; not bumped by logins
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    # directory_key() of name and email, kept by save(); indexed for the
+    # directory's prefix search (see users/directory.py)
+    name_key = models.CharField(max_length=255, blank=True, default='', editable=False)
+    email_key = models.CharField(max_length=254, blank=True, default='', editable=False)
 
     objects = CustomUserManager()
 
     USERNAME_FIELD = 'email'
     EMAIL_FIELD = 'email'
     REQUIRED_FIELDS = []
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['name_key', 'id'], name='user_name_key_idx'),
+            models.Index(fields=['email_key', 'id'], name='user_email_key_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Casefolding can lengthen a string (ß -> ss); the keys are cut to fit
+        self.name_key = directory_key(self.name)[:255]
+        self.email_key = directory_key(self.email)[:254]
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'name', 'email'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'name_key', 'email_key'}
+        super().save(*args, **kwargs)
@@ -0,0 +1,21 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import User
+from .typeahead import typeahead
+
+
+@receiver(post_save, sender=User)
+def index_user(sender, instance, raw, using, **kwargs):
+    if raw:
+        return
+    # After commit, so a rolled back signup never shows up
+    transaction.on_commit(partial(typeahead.update, instance), using=using)
+
+
+@receiver(post_delete, sender=User)
+def unindex_user(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(typeahead.remove, instance.pk), using=using)
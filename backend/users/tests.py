@@ -1,3 +1,178 @@
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from . import typeahead as typeahead_module
+from .models import User
+from .typeahead import TypeaheadIndex, typeahead
+
+
+class ConditionalGetTests(TestCase):
+    """
+    ETag / Last-Modified validators on the user endpoints.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(name='alice', email='alice@example.com', password=None)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_user_list(self):
+        response = self.client.get('/api/users/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/api/users/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        User.objects.create_user(name='bob', email='bob@example.com', password=None)
+        response = self.client.get('/api/users/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.json()['data']['users']), 2)
+
+    def test_me(self):
+        response = self.client.get('/api/me/')
+        self.assertEqual(response.json()['name'], 'alice')
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/me/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.alice.name = 'Alice'
+        self.alice.save()
+        self.assertEqual(self.client.get('/api/me/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class SignupTests(TestCase):
+
+    def test_form_errors_are_listed(self):
+        response = APIClient().post('/api/signup/', {
+            'email': 'not-an-email', 'name': 'x', 'password1': 'one', 'password2': 'two',
+        }, format='json')
+        self.assertEqual(response.json()['message'], 'error')
+        self.assertEqual(response.json()['errors']['email'], ['Enter a valid email address.'])
+
+
+class DirectoryTests(TestCase):
+    """
+    The paged, prefix-searchable directory and the in-memory typeahead.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(name=name, email=email, password=None)
+            for name, email in [
+                ('Ánna Lee', 'anna@example.com'), ('andrew', 'drew@example.com'), ('Bob', 'bob@example.com'),
+                ('Straße', 'strasse@example.com'), ('Carol', 'annex@example.com'),
+            ]
+        ]
+
+    def setUp(self):
+        typeahead.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def names(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return [user['name'] for user in response.json()]
+
+    def test_keys_follow_saves(self):
+        user = self.users[2]
+        self.assertEqual((user.name_key, user.email_key), ('bob', 'bob@example.com'))
+        user.name = 'ROBERT'
+        user.save(update_fields=['name'])
+        user.refresh_from_db()
+        self.assertEqual(user.name_key, 'robert')
+
+    def test_directory_pages_and_prefixes(self):
+        names = []
+        params = {'limit': 2}
+        while True:
+            response = self.client.get('/api/users/directory/', params)
+            names += [user['name'] for user in response.json()]
+            if response['X-Has-More'] != 'true':
+                break
+            params['cursor'] = response['X-Cursor-After']
+        self.assertEqual(names, ['andrew', 'Bob', 'Carol', 'Straße', 'Ánna Lee'])
+
+        # Name or email prefix, case- and width-insensitive
+        self.assertEqual(self.names('/api/users/directory/', q='AN'), ['andrew', 'Carol', 'Ánna Lee'])
+        self.assertEqual(self.names('/api/users/directory/', q='strass'), ['Straße'])
+        self.assertEqual(self.names('/api/users/directory/', q='ｂｏ'), ['Bob'])
+        self.assertEqual(self.client.get('/api/users/directory/', {'cursor': 'nope'}).status_code, 400)
+
+    def test_typeahead(self):
+        # Name matches first, then email matches
+        self.assertEqual(self.names('/api/users/typeahead/', q='an'), ['andrew', 'Ánna Lee', 'Carol'])
+        self.assertEqual(self.names('/api/users/typeahead/', q='án'), ['Ánna Lee'])
+        self.assertEqual(self.names('/api/users/typeahead/', q='an', limit=1), ['andrew'])
+        self.assertEqual(self.names('/api/users/typeahead/', q=''), [])
+
+    def test_typeahead_follows_writes(self):
+        # 'andrew' by email (drew@...)
+        self.assertEqual(self.names('/api/users/typeahead/', q='d'), ['andrew'])
+        with self.captureOnCommitCallbacks(execute=True):
+            dave = User.objects.create_user(name='Dave', email='dave@example.com', password=None)
+        self.assertEqual(self.names('/api/users/typeahead/', q='d'), ['Dave', 'andrew'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            dave.name = 'Zed'
+            dave.save()
+        self.assertEqual(self.names('/api/users/typeahead/', q='da'), ['Zed'])
+        self.assertEqual(self.names('/api/users/typeahead/', q='ze'), ['Zed'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            dave.delete()
+        self.assertEqual(self.names('/api/users/typeahead/', q='ze'), [])
+
+    def test_changes_during_a_load_are_kept(self):
+        index = TypeaheadIndex()
+        bob, carol = self.users[2], self.users[4]
+        robert = SimpleNamespace(pk=bob.pk, name_key='robert', email_key=bob.email_key)
+        build = typeahead_module.SortedKeys
+        changed = []
+
+        def build_after_changes(pairs):
+            # The rows are read, the changes land before the new index is in place
+            if not changed:
+                changed.append(True)
+                index.update(robert)
+                index.remove(carol.pk)
+            return build(pairs)
+
+        with mock.patch.object(typeahead_module, 'SortedKeys', side_effect=build_after_changes):
+            index.load()
+        self.assertEqual(index.search('ro', 5), [bob.pk])
+        self.assertEqual(index.search('ca', 5), [])
+
+    def test_one_thread_reloads(self):
+        index = TypeaheadIndex()
+        index.load()
+        current = index.fields()
+        index._loaded_at = 0.0
+        started, finish = threading.Event(), threading.Event()
+        fresh = {}
+
+        def slow_load():
+            # No queries: the thread would not see the test's transaction
+            started.set()
+            finish.wait(5)
+            index._fields, index._loaded_at = fresh, time.monotonic()
 
-# Create your tests here.
+        with mock.patch.object(index, 'load', side_effect=slow_load) as reload:
+            reloader = threading.Thread(target=index.fields)
+            reloader.start()
+            self.assertTrue(started.wait(5))
+            # Served the current index rather than waiting or loading again
+            self.assertIs(index.fields(), current)
+            finish.set()
+            reloader.join(5)
+        self.assertEqual(reload.call_count, 1)
+        self.assertIs(index.fields(), fresh)
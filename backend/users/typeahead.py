@@ -0,0 +1,203 @@
+"""
+In-memory typeahead over user names and emails.
+
+Two sorted arrays per field, keys and ids, searched with bisect: a prefix
+lookup is a binary search plus a walk over the matches, without a query
+(tens of microseconds). Roughly 300 bytes per user with the key strings,
+so 300,000 accounts take about 90 MB.
+
+The index is loaded on first use and kept current in this process by the
+User signals (see signals.py), one insort or delete per change. Other
+processes pick up changes when they reload, every USER_TYPEAHEAD_TTL
+seconds. Until then they can be briefly stale; the directory endpoint reads
+the database.
+
+One thread reloads at a time while the others keep searching the current
+index (or, before the first load, wait for it). Changes made in this process
+during a reload are recorded and re-applied to the new index, which may have
+read the rows before them.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+
+from .models import User, directory_key
+
+# Seconds between full reloads, which pick up other processes' writes
+DEFAULT_TTL = 300
+# Rows read per query while loading
+LOAD_BATCH_SIZE = 10000
+FIELDS = ('name_key', 'email_key')
+
+
+class SortedKeys:
+    """
+    (key, id) pairs kept sorted by key then id, in two parallel arrays.
+    """
+
+    def __init__(self, pairs=()):
+        pairs = sorted(pairs)
+        self.keys = [key for key, _ in pairs]
+        self.ids = array('q', [user_id for _, user_id in pairs])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def position(self, key, user_id):
+        # Among equal keys the ids are ascending, so bisect them too
+        low, high = bisect_left(self.keys, key), bisect_right(self.keys, key)
+        return low + bisect_left(self.ids[low:high], user_id)
+
+    def add(self, key, user_id):
+        index = self.position(key, user_id)
+        self.keys.insert(index, key)
+        self.ids.insert(index, user_id)
+
+    def remove(self, key, user_id):
+        index = self.position(key, user_id)
+        if index < len(self.keys) and self.keys[index] == key and self.ids[index] == user_id:
+            del self.keys[index]
+            del self.ids[index]
+
+    def prefix(self, prefix, limit):
+        """
+        Ids of up to `limit` keys starting with `prefix`, in key order.
+        """
+        found = []
+        index = bisect_left(self.keys, prefix)
+        while index < len(self.keys) and len(found) < limit and self.keys[index].startswith(prefix):
+            found.append(self.ids[index])
+            index += 1
+        return found
+
+
+def apply(fields, keys, user_id, new):
+    """
+    Index `new` (name_key, email_key), or nothing if None, for `user_id`,
+    replacing what it had.
+    """
+    old = keys.get(user_id)
+    if old == new:
+        return
+    if old is not None:
+        for field, key in zip(FIELDS, old):
+            fields[field].remove(key, user_id)
+        del keys[user_id]
+    if new is not None:
+        for field, key in zip(FIELDS, new):
+            fields[field].add(key, user_id)
+        keys[user_id] = new
+
+
+class TypeaheadIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held by the one thread (re)loading
+        self._load_lock = threading.Lock()
+        self._fields = None  # field -> SortedKeys, None until loaded
+        self._keys = {}  # user id -> (name_key, email_key) as indexed
+        self._loaded_at = 0.0
+        # (user id, keys or None) changes seen during a load, else None
+        self._pending = None
+
+    def load(self):
+        """
+        (Re)build from the users table.
+        """
+        with self._lock:
+            self._pending = []
+        try:
+            self._load()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _load(self):
+        pairs = {field: [] for field in FIELDS}
+        keys = {}
+        last_id = 0
+        while True:
+            rows = list(
+                User.objects.filter(id__gt=last_id).order_by('id').values_list('id', *FIELDS)[:LOAD_BATCH_SIZE]
+            )
+            if not rows:
+                break
+            for user_id, *row in rows:
+                keys[user_id] = tuple(row)
+                for field, key in zip(FIELDS, row):
+                    pairs[field].append((key, user_id))
+            last_id = rows[-1][0]
+
+        fields = {field: SortedKeys(field_pairs) for field, field_pairs in pairs.items()}
+        with self._lock:
+            for user_id, new in self._pending:
+                apply(fields, keys, user_id, new)
+            self._fields, self._keys = fields, keys
+            self._loaded_at = time.monotonic()
+
+    def stale(self):
+        ttl = getattr(settings, 'USER_TYPEAHEAD_TTL', DEFAULT_TTL)
+        return self._fields is None or time.monotonic() - self._loaded_at > ttl
+
+    def fields(self):
+        fields = self._fields
+        if not self.stale():
+            return fields
+        # Someone else is reloading: search the current index meanwhile
+        if not self._load_lock.acquire(blocking=fields is None):
+            return fields
+        try:
+            # They may have finished while this thread waited
+            if self.stale():
+                self.load()
+            return self._fields
+        finally:
+            self._load_lock.release()
+
+    def change(self, user_id, new):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((user_id, new))
+            # Before the first load there is nothing to change
+            if self._fields is not None:
+                apply(self._fields, self._keys, user_id, new)
+
+    def update(self, user):
+        """
+        Index `user`'s current name and email, replacing what it had.
+        """
+        self.change(user.pk, tuple(getattr(user, field) for field in FIELDS))
+
+    def remove(self, user_id):
+        self.change(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._fields, self._keys = None, {}
+
+    def search(self, query, limit):
+        """
+        Ids of up to `limit` users whose name or email starts with `query`,
+        name matches first.
+        """
+        prefix = directory_key(query.strip())
+        if not prefix:
+            return []
+        fields = self.fields()
+        with self._lock:
+            found = fields['name_key'].prefix(prefix, limit)
+            if len(found) < limit:
+                seen = set(found)
+                # Users already found by name may match again, skip past them
+                for user_id in fields['email_key'].prefix(prefix, limit + len(found)):
+                    if user_id not in seen and len(found) < limit:
+                        found.append(user_id)
+        return found
+
+
+# Shared by the views and the User signals
+typeahead = TypeaheadIndex()
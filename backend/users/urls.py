@@ -11,6 +11,8 @@ urlpatterns = [
     path('users/', api.get_all_users, name='get_all_users'),
     path('user-counts/', views.user_counts, name='user-counts'),
     path('users/create/', views.create_user, name='create-user'),
+    path('users/directory/', views.user_directory, name='user-directory'),
+    path('users/typeahead/', views.user_typeahead, name='user-typeahead'),
     path('users/<int:pk>/', views.get_user_detail, name='user-detail'),
     path('users/<int:pk>/update/', views.update_user, name='update-user'),
     path('users/<int:pk>/delete/', views.delete_user, name='delete-user'),
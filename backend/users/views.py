@@ -2,16 +2,23 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
+from stats.counters import ADMINS, USERS, get_counters
+from .directory import directory_page, get_page_size
 from .models import User
 from .serializers import UserSerializer
+from .typeahead import typeahead
+
+# Suggestions returned by the typeahead unless the client sends `limit`
+TYPEAHEAD_LIMIT = 10
+MAX_TYPEAHEAD_LIMIT = 50
 
 @api_view(['GET'])
 def user_counts(request):
-    total_users = User.objects.count()
-    total_admins = User.objects.filter(is_superuser=True).count()
+    # Maintained counters (see stats/counters.py) rather than two COUNT(*) scans
+    counters = get_counters()
     return Response({
-        'total_users': total_users,
-        'total_admins': total_admins,
+        'total_users': counters[USERS],
+        'total_admins': counters[ADMINS],
     })
 
 @api_view(['GET'])
@@ -21,6 +28,42 @@ def get_users(request):
     serializer = UserSerializer(users, many=True)
     return Response(serializer.data)
 
+@api_view(['GET'])
+def user_directory(request):
+    """
+    Users by name, one page at a time, narrowed to a name or email prefix
+    with `q`. Follow `X-Cursor-After` with `?cursor=` while `X-Has-More` is
+    true.
+    """
+    try:
+        limit = get_page_size(request.query_params.get('limit'))
+        users, cursor = directory_page(
+            request.query_params.get('q', ''), request.query_params.get('cursor'), limit
+        )
+    except ValueError as e:
+        return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    headers = {'X-Has-More': 'true' if cursor else 'false'}
+    if cursor:
+        headers['X-Cursor-After'] = cursor
+    return Response(UserSerializer(users, many=True).data, headers=headers)
+
+@api_view(['GET'])
+def user_typeahead(request):
+    """Recipient suggestions: users whose name or email starts with `q`, from memory"""
+    try:
+        limit = min(int(request.query_params.get('limit') or TYPEAHEAD_LIMIT), MAX_TYPEAHEAD_LIMIT)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return Response({'detail': 'Invalid limit format'}, status=status.HTTP_400_BAD_REQUEST)
+
+    ids = typeahead.search(request.query_params.get('q', ''), limit)
+    # The index may briefly hold users deleted by another process
+    found = User.objects.in_bulk(ids)
+    users = [found[user_id] for user_id in ids if user_id in found]
+    return Response(UserSerializer(users, many=True).data)
+
 @api_view(['GET'])
 def get_user_detail(request, pk):
     """Get a specific user by id"""